@@ -0,0 +1,50 @@
+"""
+Reports how long each driver keeps the radio busy per command,
+compared to the old byte-aligned frames with their padding
+
+Run from the repository root:
+	python -m benchmarks.air_time
+"""
+from restful_rfcat.drivers.feit import FeitElectric
+from restful_rfcat.drivers.hamptonbay import HamptonCeiling
+from restful_rfcat.drivers.hunter import HunterCeiling
+
+def padded_hunter(bin_key):
+	# 8 right-aligned bytes plus a trailing 0 byte, repeated by the radio
+	frame = HunterCeiling._encode_frame(bin_key).tobytes(align='right', block=8) + '\x00'
+	return frame * HunterCeiling.FRAME_COUNT
+
+def padded_hampton(bin_key):
+	# 22 extra 0 bits, right-aligned to 8 bytes, repeated by the radio
+	pwm_key = HamptonCeiling._encode_pwm_symbols(bin_key + '0' * 22)
+	return pwm_key.strip().tobytes(align='right', block=8) * HamptonCeiling.FRAME_COUNT
+
+def padded_feit(bin_key):
+	# the frame and gap copied until they line up to a byte, repeated by the radio
+	pwm_key = FeitElectric._encode_pwm(bin_key).strip().append_run(0, 24)
+	copies = 1
+	while (copies * len(pwm_key)) % 8 != 0 and copies < 6:
+		copies = copies + 1
+	return pwm_key.repeat(copies).tobytes() * FeitElectric.FRAME_COUNT
+
+def main():
+	hunter = HunterCeiling(name='bench', label='Bench', dip_switch='1011')
+	hampton = HamptonCeiling(name='bench', label='Bench', dip_switch='1011')
+	feit = FeitElectric(name='bench', label='Bench', address='0110110111110101011110101111')
+	drivers = [
+		('hunter', hunter, padded_hunter, sorted(HunterCeiling.commands.keys())),
+		('hampton', hampton, padded_hampton, sorted(set(HamptonCeiling.commands.values()))),
+		('feit', feit, padded_feit, sorted(FeitElectric.commands.keys())),
+	]
+	print("%-8s %-10s %10s %10s %10s" % ('driver', 'command', 'old ms', 'new ms', 'saved ms'))
+	for name, device, padded, commands in drivers:
+		klass = device.__class__
+		baudrate = float(klass.radio.baudrate)
+		for command in commands:
+			bin_key = device._get_bin_key(command)
+			old = len(padded(bin_key)) * 8 / baudrate * 1000
+			new = len(klass._encode(bin_key, klass.FRAME_COUNT)) * 8 / baudrate * 1000
+			print("%-8s %-10s %10.1f %10.1f %10.1f" % (name, command, old, new, old - new))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,49 @@
+"""
+Measures how much memory each device takes in a large config
+
+Run from the repository root:
+	python -m benchmarks.device_memory
+"""
+import gc
+import resource
+import sys
+from restful_rfcat.drivers import FakeFan, FakeLight
+
+def resident_bytes():
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		# only the peak is available, which is fine while memory only grows
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def object_bytes(device):
+	""" The objects each device keeps for itself, not counting shared strings """
+	objects = [device] + list(device.subdevices.values())
+	size = sys.getsizeof(device.subdevices)
+	for o in objects:
+		size = size + sys.getsizeof(o)
+		if hasattr(o, '__dict__'):
+			size = size + sys.getsizeof(o.__dict__)
+	return size
+
+def main(count=10000):
+	for klass in [FakeFan, FakeLight]:
+		gc.collect()
+		before = resident_bytes()
+		devices = []
+		for i in range(count):
+			device = klass(name='device%d' % i, label='Device %d' % i)
+			# the paths and subdevices that a running server would use
+			device._state_path()
+			for subdevice in device.subdevices.values():
+				subdevice._state_path()
+			devices.append(device)
+		gc.collect()
+		after = resident_bytes()
+		print("%-10s %6d devices: %6.0f bytes resident, %6d bytes of objects per device" % (
+			klass.__name__, count, (after - before) * 1.0 / count, object_bytes(devices[0])))
+		del devices
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,33 @@
+"""
+Measures how many commands per second each driver can encode into radio bytes
+
+Run from the repository root:
+	python -m benchmarks.encode_throughput
+"""
+import timeit
+
+SETUP = """
+from restful_rfcat.drivers.feit import FeitElectric
+from restful_rfcat.drivers.hamptonbay import HamptonCeiling
+from restful_rfcat.drivers.hunter import HunterCeiling
+from restful_rfcat.drivers.lirc import Lirc
+hunter = HunterCeiling(name='bench', label='Bench', dip_switch='1011')
+hampton = HamptonCeiling(name='bench', label='Bench', dip_switch='1011')
+feit = FeitElectric(name='bench', label='Bench', address='0110110111110101011110101111')
+lirc = Lirc(name='bench', label='Bench', config_filename='hampton_bay_UC7078T', radio_frequency=303875000)
+"""
+
+ENCODERS = [
+	('hunter', "HunterCeiling._encode(hunter._get_bin_key('fan2'))"),
+	('hampton', "HamptonCeiling._encode(hampton._get_bin_key('1011'))"),
+	('feit', "FeitElectric._encode(feit._get_bin_key('on'))"),
+	('lirc', "Lirc._encode(lirc._get_bin_key('FAN_HIGH'))"),
+]
+
+def main(number=5000, repeat=9):
+	for name, statement in ENCODERS:
+		best = min(timeit.repeat(statement, setup=SETUP, number=number, repeat=repeat))
+		print("%-8s %10.0f commands/s" % (name, number / best))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,39 @@
+"""
+Measures how quickly a FakeFan looks up and applies states
+
+Run from the repository root:
+	python -m benchmarks.fan_dispatch
+"""
+import timeit
+
+SETUP = """
+from restful_rfcat import config
+from restful_rfcat.drivers import FakeFan
+
+class MemoryStore(object):
+	# keeps the benchmark from measuring disk writes
+	# or the background writer threads
+	write_behind = False
+	def __init__(self):
+		self.values = {}
+	def set(self, key, value):
+		self.values[key] = value
+	def get(self, key, default=None):
+		return self.values.get(key, default)
+
+config.PERSISTENCE = [MemoryStore()]
+fan = FakeFan(name='bench', label='Bench')
+"""
+
+STATEMENTS = [
+	('set_state', "fan.set_state('HIGH')"),
+	('get_acceptable_states', "fan.get_acceptable_states()"),
+]
+
+def main(number=20000, repeat=9):
+	for name, statement in STATEMENTS:
+		best = min(timeit.repeat(statement, setup=SETUP, number=number, repeat=repeat))
+		print("%-22s %10.0f calls/s" % (name, number / best))
+
+if __name__ == '__main__':
+	main()
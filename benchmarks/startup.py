@@ -0,0 +1,38 @@
+"""
+Measures how long the service takes to load, before it starts serving,
+and which of the slow optional libraries were imported to get there
+
+Run from the repository root:
+	python -m benchmarks.startup
+"""
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['rflib', 'paho', 'redis', 'markup', 'raven', 'mock']
+
+# importing main loads the config, drivers and web routes without running the server
+STARTUP = """
+import sys
+import restful_rfcat.main
+heavy = %r
+print('loaded:' + ','.join(sorted(m for m in heavy if m in sys.modules)))
+""" % (HEAVY_MODULES,)
+
+def start():
+	began = time.time()
+	process = subprocess.Popen([sys.executable, '-c', STARTUP], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output = process.communicate()[0]
+	loaded = [l for l in output.splitlines() if l.startswith('loaded:')][-1]
+	return time.time() - began, loaded[len('loaded:'):]
+
+def main(repeat=9):
+	timings = []
+	for i in range(repeat):
+		elapsed, loaded = start()
+		timings.append(elapsed)
+	print("startup                %8.1f ms" % (min(timings) * 1000,))
+	print("heavy modules loaded   %s" % (loaded or 'none',))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,47 @@
+"""
+Counts how many subdevice objects a FakeFan creates while handling commands
+
+Run from the repository root:
+	python -m benchmarks.subdevice_allocations
+"""
+import gc
+import time
+from restful_rfcat import config
+from restful_rfcat.drivers import FakeFan
+from restful_rfcat.drivers._utils import SubDeviceDriver
+
+class MemoryStore(object):
+	# keeps the benchmark from measuring disk writes
+	# or the background writer threads
+	write_behind = False
+	def __init__(self):
+		self.values = {}
+	def set(self, key, value):
+		self.values[key] = value
+	def get(self, key, default=None):
+		return self.values.get(key, default)
+
+def main(commands=20000):
+	config.PERSISTENCE = [MemoryStore()]
+	created = [0]
+	original_init = SubDeviceDriver.__init__
+	def counting_init(self, parent):
+		created[0] = created[0] + 1
+		original_init(self, parent)
+	SubDeviceDriver.__init__ = counting_init
+	try:
+		fan = FakeFan(name='bench', label='Bench')
+		states = ['LOW', 'MED', 'HIGH', 'OFF', 'ON']
+		gc.collect()
+		start = time.time()
+		for i in range(commands):
+			fan.set_state(states[i % len(states)])
+			fan.get_state()
+		elapsed = time.time() - start
+	finally:
+		SubDeviceDriver.__init__ = original_init
+	print("%d commands in %.2fs, %.0f commands/s" % (commands, elapsed, commands / elapsed))
+	print("%.2f subdevice objects created per command" % (created[0] * 1.0 / commands))
+
+if __name__ == '__main__':
+	main()
@@ -3,3 +3,4 @@ import drivers
 import persistence
 import pubsub
 import radio
+import state
@@ -1,25 +1,52 @@
-# All of the available drivers to use in config files
-from restful_rfcat.drivers.hunter import HunterCeilingFan, HunterCeilingLight, HunterCeilingEavesdropper
-from restful_rfcat.drivers.hamptonbay import HamptonCeilingFan, HamptonCeilingLight
-from restful_rfcat.drivers.feit import FeitElectricLights
-from restful_rfcat.drivers.lirc import LircLight, LircThreeWayFan
+"""
+All of the available drivers to use in config files
 
-# example implementation
-from restful_rfcat.drivers._utils import DeviceDriver, LightMixin, ThreeSpeedFanMixin
-class FakeDevice(DeviceDriver):
-	def get_class(self):
-		return self.CLASS
-	def _send_command(self, command):
-		# nop
-		pass
-	def set_state(self, state):
-		return self._set(state)
+Each driver is registered by name with the module that holds it,
+and that module is only imported once the driver is first used,
+such as by `from restful_rfcat.drivers import HunterCeilingFan`,
+so a config only pays to load the drivers that it uses
+Other packages can add their own drivers with register()
+"""
+import sys
+import types
 
-class FakeLight(LightMixin, FakeDevice):
-	pass
+DRIVERS = {
+	'HunterCeilingFan': 'restful_rfcat.drivers.hunter',
+	'HunterCeilingLight': 'restful_rfcat.drivers.hunter',
+	'HunterCeilingEavesdropper': 'restful_rfcat.drivers.hunter',
+	'HamptonCeilingFan': 'restful_rfcat.drivers.hamptonbay',
+	'HamptonCeilingLight': 'restful_rfcat.drivers.hamptonbay',
+	'FeitElectricLights': 'restful_rfcat.drivers.feit',
+	'LircLight': 'restful_rfcat.drivers.lirc',
+	'LircThreeWayFan': 'restful_rfcat.drivers.lirc',
+	'LircEavesdropper': 'restful_rfcat.drivers.lirc',
+	'LircLibrary': 'restful_rfcat.drivers.lirc',
+	# example implementation
+	'FakeLight': 'restful_rfcat.drivers.fake',
+	'FakeFan': 'restful_rfcat.drivers.fake',
+}
 
-class FakeFan(ThreeSpeedFanMixin, FakeDevice):
-	pass
+def register(name, module_name):
+	""" Make the driver called name, from the module module_name,
+	    available to import from restful_rfcat.drivers
+	"""
+	DRIVERS[name] = module_name
+	_registry.__all__ = sorted(DRIVERS.keys())
 
-# clean up the namespace
-del DeviceDriver, FakeDevice, LightMixin, ThreeSpeedFanMixin
+class _DriverRegistry(types.ModuleType):
+	""" Stands in for this package, to import drivers as they are used """
+	def __getattr__(self, name):
+		module_name = DRIVERS.get(name)
+		if module_name is None:
+			raise AttributeError(name)
+		# fromlist makes __import__ return the module itself, not the top package
+		driver = getattr(__import__(module_name, fromlist=[name]), name)
+		setattr(self, name, driver)
+		return driver
+
+_registry = _DriverRegistry(__name__, __doc__)
+_registry.__dict__.update(globals())
+_registry.__all__ = sorted(DRIVERS.keys())
+# keep this module alive, because Python 2 empties the globals of discarded modules
+_registry._package = sys.modules[__name__]
+sys.modules[__name__] = _registry
@@ -1,17 +1,110 @@
+import binascii
+import collections
 import inspect
-import itertools
+import logging
 import re
-from restful_rfcat import persistence, pubsub
+import sys
+import threading
+import time
+from restful_rfcat import pubsub
+from restful_rfcat.state import store
+
+logger = logging.getLogger(__name__)
 
 # Useful utilities or classes for drivers
+class DispatchTables(type):
+	""" Works out the state lookups of each driver class once, as it is created
+
+	Classes with STATE_COMMANDS get their sorted _ACCEPTABLE_STATES
+	and _AVAILABLE_STATES, and classes with SUBDEVICES get a
+	_STATE_SUBDEVICES dict of which subdevice first claims each state,
+	along with the sorted _SUBDEVICE_STATES that any of them accept
+	"""
+	def __init__(klass, name, bases, attrs):
+		super(DispatchTables, klass).__init__(name, bases, attrs)
+		state_commands = getattr(klass, 'STATE_COMMANDS', None)
+		if state_commands is not None:
+			klass._ACCEPTABLE_STATES = tuple(sorted(state_commands.keys()))
+			klass._AVAILABLE_STATES = tuple(sorted(set(state_commands.values())))
+		subdevices = getattr(klass, 'SUBDEVICES', None)
+		if subdevices is not None:
+			dispatch = {}
+			for device in subdevices:
+				for state in device._ACCEPTABLE_STATES:
+					dispatch.setdefault(state, device)
+			klass._STATE_SUBDEVICES = dispatch
+			klass._SUBDEVICE_STATES = tuple(sorted(dispatch.keys()))
+
+class FrozenMapping(collections.Mapping):
+	""" A read-only view of a dict
+
+	>>> mapping = FrozenMapping({'power': 1})
+	>>> mapping['power'], mapping.get('speed'), 'power' in mapping
+	(1, None, True)
+	>>> mapping['speed'] = 2
+	Traceback (most recent call last):
+	    ...
+	TypeError: 'FrozenMapping' object does not support item assignment
+	"""
+	def __init__(self, data):
+		self._data = data
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+	def __iter__(self):
+		return iter(self._data)
+
+	def __len__(self):
+		return len(self._data)
+
+	def __repr__(self):
+		return 'FrozenMapping(%r)' % (self._data,)
+
+def _cached_subdevices(device):
+	""" Create the subdevices of a device the first time they are used,
+	    and keep the same ones for the rest of the device's life
+	"""
+	subdevices = getattr(device, '_subdevices', None)
+	if subdevices is None:
+		subdevices = FrozenMapping(dict(((dev.get_name(), dev(device)) for dev in device.SUBDEVICES)))
+		device._subdevices = subdevices
+	return subdevices
+
+# guards creating each device's mailbox
+_mailbox_lock = threading.Lock()
+
+def _intern_path(path):
+	""" Share one copy of each state path string between all of its users """
+	if isinstance(path, str):
+		return intern(path)
+	return path
+
 class DeviceDriver(object):
+	__metaclass__ = DispatchTables
+	# drivers are created by the thousand in big configs,
+	# so every subclass should list its own attributes in __slots__
+	__slots__ = ('name', 'label', 'macros', '_path', '_subdevices', '_compiled_macros', '_mailbox')
+
 	# a list of subdevice classes to expose
 	SUBDEVICES = []
+	# milliseconds between the presses of a macro, unless given
+	MACRO_GAP = 100
+	# drivers with idempotent commands can skip setting the state that
+	# the device already has, if it was last set within this many seconds
+	# None always sends, which toggle buttons need
+	RESEND_INTERVAL = None
 
-	def __init__(self, name, label):
-		""" Save a name and display label """
+	def __init__(self, name, label, macros=None):
+		""" Save a name and display label
+		    macros are named lists of commands to send in a single transmission,
+		    each either a command or a (command, milliseconds of silence after it)
+		"""
 		self.name = name
 		self.label = label
+		self.macros = macros or {}
+		self._compiled_macros = {}
+		self._check_macros()
 
 	def get_name(self):
 		return self.name
@@ -34,24 +127,121 @@ class DeviceDriver(object):
 
 	def _state_path(self):
 		""" Where to save the device in persistence layers """
-		return '%s/%s' % (self.get_class(), self.name)
+		try:
+			return self._path
+		except AttributeError:
+			self._path = _intern_path('%s/%s' % (self.get_class(), self.name))
+			return self._path
 
 	def _get(self):
-		""" Loads the current state from persistence """
-		return persistence.get(self._state_path())
-	def _set(self, state):
-		""" Saves the given state to persistence """
-		persistence.set(self._state_path(), state)
-		pubsub.publish({'device':self, 'state':state})
+		""" Loads the current state from the state store """
+		return store.get(self._state_path())
+	def _set(self, new_state, source='command'):
+		""" Saves the given state to the state store, which persists it """
+		store.set(self._state_path(), new_state, source=source)
+		pubsub.publish({'device':self, 'state':new_state})
 
 	def get_state(self):
 		return self._get()
 	def set_state(self, state):	# pragma: no cover
 		raise NotImplementedError('%s.%s' % (self.__class__.__name__, inspect.currentframe().f_code.co_name))
 
+	def _resend_interval(self):
+		return self.RESEND_INTERVAL
+
+	def _record_path(self):
+		""" Which record of the state store holds this device's state """
+		return self._state_path()
+
+	def _is_resend(self, current, command):
+		""" Whether sending this command can be skipped, because the device
+		    already has it as its current command, set within the RESEND_INTERVAL
+		"""
+		interval = self._resend_interval()
+		if interval is None or current is None or current != command:
+			return False
+		updated = store.record(self._record_path()).updated
+		if updated is None or time.time() - updated >= interval:
+			return False
+		logger.info("%s is already %s, not sending it again" % (self._state_path(), command))
+		return True
+
 	@property
 	def subdevices(self):
-		return dict(((dev.get_name(), dev(self)) for dev in self.SUBDEVICES))
+		return _cached_subdevices(self)
+
+	@property
+	def mailbox(self):
+		""" Where changes to this device and its subdevices wait their turn """
+		mailbox = getattr(self, '_mailbox', None)
+		if mailbox is None:
+			with _mailbox_lock:
+				mailbox = getattr(self, '_mailbox', None)
+				if mailbox is None:
+					mailbox = self._mailbox = Mailbox(self._state_path())
+		return mailbox
+
+	def get_mailbox_depth(self):
+		mailbox = getattr(self, '_mailbox', None)
+		return mailbox.depth() if mailbox is not None else 0
+
+	def _press_symbols(self, command):	# pragma: no cover
+		""" The radio symbols of a whole button press of a command,
+		    such as every frame that _send_command would transmit
+		"""
+		raise NotImplementedError('%s.%s' % (self.__class__.__name__, inspect.currentframe().f_code.co_name))
+
+	def _has_command(self, command):
+		""" Whether the remote has a button for this command """
+		return command in getattr(self, 'commands', {})
+
+	def _pressed(self, command):	# pragma: no cover
+		""" Save the states that a button press of this command leaves
+		    the device in, such as after a macro sends it
+		"""
+		raise NotImplementedError('%s.%s' % (self.__class__.__name__, inspect.currentframe().f_code.co_name))
+
+	def get_macros(self):
+		return sorted(self.macros.keys())
+
+	def _macro_steps(self, name):
+		""" The (command, milliseconds of silence after it) of each press of a macro """
+		return [(step, self.MACRO_GAP) if isinstance(step, basestring) else tuple(step)
+		        for step in self.macros[name]]
+
+	def _check_macros(self):
+		""" Make sure that every command of every macro can be sent """
+		for name in self.macros:
+			for command, gap in self._macro_steps(name):
+				if not self._has_command(command):
+					raise ValueError("Unknown command %s in macro %s" % (command, name))
+
+	def compile_macro(self, name):
+		""" Build the bytes to send for all of the presses of a macro
+		    They are built once for each baudrate that the radio is set to
+		"""
+		if name not in self.macros:
+			raise ValueError("Invalid macro: %s" % (name,))
+		baudrate = self.radio.baudrate
+		key = (name, baudrate)
+		if key not in self._compiled_macros:
+			symbols = BitBuffer()
+			steps = self._macro_steps(name)
+			for index, (command, gap) in enumerate(steps):
+				symbols.extend(self._press_symbols(command))
+				if index < len(steps) - 1:
+					symbols.append_run(0, int(round(gap * baudrate / 1000.0)))
+			self._compiled_macros[key] = symbols.tobytes()
+		return self._compiled_macros[key]
+
+	def run_macro(self, name):
+		""" Send all of the presses of a macro in one transmission,
+		    and then save the states that the presses changed
+		"""
+		logger.info("Sending macro %s to %s" % (name, self.name))
+		self.radio.send(self.compile_macro(name), repeat=0)
+		for command, gap in self._macro_steps(name):
+			self._pressed(command)
 
 class SubDeviceDriver(DeviceDriver):
 	""" Common functionality to make it easy to implement subdevices
@@ -60,6 +250,8 @@ class SubDeviceDriver(DeviceDriver):
 	maps a POSTed state to the actual command to run
 	This allows for multiple state aliases
 	"""
+	__slots__ = ('parent',)
+
 	STATE_COMMANDS = {}
 
 	@classmethod
@@ -92,7 +284,32 @@ class SubDeviceDriver(DeviceDriver):
 		return "color"
 
 	def _state_path(self):
-		return '%s/%s' % (self.parent._state_path(), self.get_name())
+		try:
+			return self._path
+		except AttributeError:
+			self._path = _intern_path('%s/%s' % (self.parent._state_path(), self.get_name()))
+			return self._path
+
+	@property
+	def mailbox(self):
+		return self.parent.mailbox
+
+	def get_mailbox_depth(self):
+		return self.parent.get_mailbox_depth()
+
+	def _resend_interval(self):
+		return self.parent._resend_interval()
+
+	def _record_path(self):
+		return self.parent._state_path()
+
+	def _get(self):
+		""" Loads the current state from the parent's record in the state store """
+		return store.get(self.parent._state_path(), self.get_name())
+	def _set(self, new_state, source='command'):
+		""" Saves the given state to the parent's record in the state store """
+		store.set(self.parent._state_path(), new_state, field=self.get_name(), source=source)
+		pubsub.publish({'device':self, 'state':new_state})
 
 	def get_acceptable_states(self):
 		"""
@@ -107,7 +324,7 @@ class SubDeviceDriver(DeviceDriver):
 		>>> ThreeSpeedFanMixinCommand(None).get_acceptable_states()
 		['0', '1', '2', '3', 'H', 'HI', 'HIGH', 'L', 'LO', 'LOW', 'M', 'MED', 'MID', 'O', 'OFF']
 		"""
-		return sorted(self.STATE_COMMANDS.keys())
+		return list(self._ACCEPTABLE_STATES)
 
 	def get_available_states(self):
 		"""
@@ -117,33 +334,646 @@ class SubDeviceDriver(DeviceDriver):
 		>>> ThreeSpeedFanMixinPower(None).get_available_states()
 		['OFF', 'ON']
 		"""
-		return sorted(list(set(self.STATE_COMMANDS.values())))
+		return list(self._AVAILABLE_STATES)
+
+class EavesdropLimiter(object):
+	""" Protects device state from storms of eavesdropped remote presses
+
+	A stuck button or radio noise can decode as hundreds of valid presses
+	Each device may only accept an event that differs from its previous one,
+	or the same event after `window` seconds have passed,
+	and at most `rate` events every `period` seconds
+	Repeating a toggle undoes it, so toggles are only held to the rate
+	Anything else is counted in `suppressed` and dropped
+
+	>>> now = [0]
+	>>> limiter = EavesdropLimiter(window=2, rate=2, period=10, _time=lambda: now[0])
+	>>> limiter.allow('fans/test', '1')
+	True
+	>>> limiter.allow('fans/test', '1')
+	False
+	>>> now[0] = 3
+	>>> limiter.allow('fans/test', '1')
+	True
+	>>> limiter.allow('fans/test', '2')
+	False
+	>>> limiter.allow('lights/test', 'light', toggle=True)
+	True
+	>>> limiter.allow('lights/test', 'light', toggle=True)
+	True
+	>>> limiter.suppressed == {'fans/test': {'duplicate': 1, 'rate': 1}}
+	True
+	"""
+	def __init__(self, window=2.0, rate=3, period=10.0, _time=time.time):
+		self.window = window
+		self.rate = rate
+		self.period = period
+		self._time = _time
+		self.lock = threading.Lock()
+		# the last accepted (event, timestamp) for each device
+		self.last_events = {}
+		# the timestamps of recently accepted events for each device
+		self.accepted = {}
+		# how many events were dropped for each device
+		self.suppressed = {}
+
+	def _suppress(self, path, reason):
+		counts = self.suppressed.setdefault(path, {'duplicate': 0, 'rate': 0})
+		counts[reason] = counts[reason] + 1
+		logger.debug("Suppressing %s eavesdropped event for %s" % (reason, path))
+		return False
+
+	def allow(self, path, event, toggle=False):
+		""" Decides whether an eavesdropped event for a device should be handled
+		    path is the device's _state_path, and event is the decoded command
+		    toggle is whether the event flips the device's state
+		"""
+		now = self._time()
+		with self.lock:
+			last_event = self.last_events.get(path)
+			if not toggle and last_event is not None and last_event[0] == event and \
+			   now < last_event[1] + self.window:
+				return self._suppress(path, 'duplicate')
+			accepted = self.accepted.setdefault(path, collections.deque(maxlen=self.rate))
+			if len(accepted) == self.rate and now < accepted[0] + self.period:
+				return self._suppress(path, 'rate')
+			accepted.append(now)
+			self.last_events[path] = (event, now)
+			return True
+
+	def get_suppressed_count(self):
+		""" The total number of dropped events, across all devices """
+		with self.lock:
+			return sum((sum(c.values()) for c in self.suppressed.values()))
+
+class MailboxReply(object):
+	""" The result of a message, once the mailbox has run it """
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+	def run(self, function, args, kwargs):
+		""" Run the function, saving what it returned or raised,
+		    but leave it to the mailbox to mark it as done
+		"""
+		try:
+			self.result = function(*args, **kwargs)
+		except Exception:
+			self.error = sys.exc_info()
+
+	def get(self, timeout=None):
+		""" Wait for the result, raising anything that the function raised """
+		self.done.wait(timeout)
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.result
+
+class Mailbox(object):
+	""" Runs the messages sent to one device in order, one at a time
+
+	A worker thread is started when a message arrives, and stops
+	once the mailbox is empty, so that idle devices don't hold threads
+	Messages sent from the worker itself run straight away,
+	such as a device setting the state of its own subdevices
+
+	>>> mailbox = Mailbox('test')
+	>>> mailbox.call(lambda x: x * 2, 21)
+	42
+	>>> mailbox.call(lambda: mailbox.call(lambda: 'nested'))
+	'nested'
+	>>> mailbox.call(int, 'BLUE')
+	Traceback (most recent call last):
+	    ...
+	ValueError: invalid literal for int() with base 10: 'BLUE'
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.lock = threading.Lock()
+		self.messages = collections.deque()
+		self.worker = None
+
+	def depth(self):
+		""" How many messages are waiting, including the one that is running """
+		return len(self.messages)
+
+	def send(self, function, *args, **kwargs):
+		""" Queue up a function to run, and return its MailboxReply """
+		reply = MailboxReply()
+		if threading.current_thread() is self.worker:
+			reply.run(function, args, kwargs)
+			reply.done.set()
+			return reply
+		with self.lock:
+			self.messages.append((reply, function, args, kwargs))
+			if self.worker is None:
+				self.worker = threading.Thread(target=self._work, name='mailbox-%s' % (self.name,))
+				self.worker.daemon = True
+				self.worker.start()
+		return reply
+
+	def call(self, function, *args, **kwargs):
+		""" Run a function in turn, and wait for its result """
+		return self.send(function, *args, **kwargs).get()
+
+	def _work(self):
+		while True:
+			with self.lock:
+				if not self.messages:
+					self.worker = None
+					return
+				reply, function, args, kwargs = self.messages[0]
+			reply.run(function, args, kwargs)
+			if reply.error is not None:
+				logger.debug("Mailbox %s message failed: %s" % (self.name, reply.error[1]))
+			with self.lock:
+				self.messages.popleft()
+			reply.done.set()
+
+class ToggleReconciler(object):
+	""" Works out what a light with only a toggle button needs to be sent
+
+	Requests within `window` seconds of each other are collected,
+	and once the window has passed, the light is toggled if the last
+	requested state differs from what the light is believed to be,
+	so ON, OFF, ON quickly becomes a single toggle, and ON, OFF none at all
+	A lone request for the state that the light should already be in,
+	more than `insist_after` seconds after it last changed, calls `force`
+	in case the light got out of step
+	If sending fails, the light is still believed to be in its old state,
+	which is passed to `on_failure` so that the saved state can be put back
+	The timer hands the flush to `dispatch`, such as the device's mailbox,
+	so that it runs in order with the device's other changes
+
+	>>> sent = []
+	>>> reconciler = ToggleReconciler(lambda: sent.append('toggle'), _timer=None, _time=lambda: 100)
+	>>> reconciler.request('ON', believed='OFF')
+	>>> reconciler.request('OFF', believed='ON')
+	>>> reconciler.request('ON', believed='OFF')
+	>>> reconciler.flush()
+	>>> sent
+	['toggle']
+	>>> reconciler.request('OFF', believed='ON')
+	>>> reconciler.request('ON', believed='OFF')
+	>>> reconciler.flush()
+	>>> sent
+	['toggle']
+	"""
+	def __init__(self, toggle, force=None, on_failure=None, dispatch=None, window=0.5, insist_after=5.0, _timer=threading.Timer, _time=time.time):
+		self.toggle = toggle
+		self.force = force
+		self.on_failure = on_failure
+		self.dispatch = dispatch
+		self.window = window
+		self.insist_after = insist_after
+		self._timer = _timer
+		self._time = _time
+		self.lock = threading.Lock()
+		self.physical = None	# what the light is believed to be
+		self.changed = 0	# when the light last changed
+		self.desired = None
+		self.requests = 0
+		self.timer = None
+
+	def request(self, state, believed=None):
+		""" Ask for the light to end up in this state
+		    believed is the last saved state, if the light hasn't been seen yet
+		"""
+		with self.lock:
+			if self.physical is None:
+				self.physical = believed
+			self.desired = state
+			self.requests = self.requests + 1
+			if self.timer is None and self._timer is not None:
+				self.timer = self._timer(self.window, self._dispatch_flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+	def _dispatch_flush(self):
+		if self.dispatch is None:
+			self.flush()
+		else:
+			self.dispatch(self.flush)
+
+	def observe(self, state):
+		""" The light was seen to change, such as by an eavesdropped remote """
+		with self.lock:
+			self.physical = state
+			self.changed = self._time()
+
+	def flush(self):
+		""" Send whatever the collected requests add up to """
+		now = self._time()
+		with self.lock:
+			self.timer = None
+			desired = self.desired
+			action = None
+			if self.requests == 0:
+				pass
+			elif desired != self.physical:
+				action = self.toggle
+			elif self.requests == 1 and self.force is not None and \
+			     now > self.changed + self.insist_after:
+				action = lambda: self.force(desired)
+			self.requests = 0
+			physical = self.physical
+		if action is None:
+			return
+		try:
+			action()
+		except Exception as e:
+			logger.warning("Failure to send %s: %s" % (desired, e))
+			with self.lock:
+				# unless something newer has been asked for meanwhile
+				rollback = self.requests == 0
+			if rollback and self.on_failure is not None:
+				self.on_failure(physical)
+			return
+		with self.lock:
+			self.physical = desired
+			self.changed = now
+
+def bit_length(value):
+	""" How many bits it takes to write value, like int.bit_length() in python 2.7
+
+	>>> bit_length(0), bit_length(1), bit_length(0x0b), bit_length(-4)
+	(0, 1, 4, 3)
+	"""
+	return len(bin(value).lstrip('-0b'))
+
+class BitBuffer(object):
+	""" A compact sequence of radio symbols, shared by all the encoders
+
+	The bits are kept in a single integer, with the first symbol to
+	send in the most significant position, so appending and repeating
+	are a few shifts instead of building strings of '0' and '1'
+
+	>>> buffer = BitBuffer.from_string('001')
+	>>> buffer.append(0b11, 2).append_run(0, 3)
+	BitBuffer('00111000')
+	>>> buffer.repeat(2)
+	BitBuffer('0011100000111000')
+	>>> buffer.reverse()
+	BitBuffer('00011100')
+	>>> buffer.strip()
+	BitBuffer('111')
+	>>> list(buffer.runs())
+	[(0, 2), (1, 3), (0, 3)]
+	>>> buffer.tobytes()
+	'8'
+	>>> BitBuffer.from_string('1').tobytes(align='right', block=2)
+	'\\x00\\x01'
+	"""
+	def __init__(self, value=0, length=0):
+		self.value = value
+		self.length = length
+		self._packed = None
+
+	@classmethod
+	def from_string(klass, bits):
+		""" Load a string of '0' and '1' characters """
+		if len(bits) == 0:
+			return klass()
+		return klass(int(bits, 2), len(bits))
+
+	def append(self, value, length):
+		""" Add the lowest `length` bits of value to the end """
+		self.value = (self.value << length) | (value & ((1 << length) - 1))
+		self.length = self.length + length
+		self._packed = None
+		return self
+
+	def append_symbols(self, bit_string, table):
+		""" Add each bit of a string of '0' and '1' as the radio symbols
+		    given by a SymbolTable, looking up a whole byte at a time
+		"""
+		remaining = len(bit_string)
+		if remaining == 0:
+			return self
+		bits = int(bit_string, 2)
+		width = table.width
+		encoded = 0
+		while remaining > 0:
+			chunk = remaining % 8 or 8
+			remaining = remaining - chunk
+			byte = (bits >> remaining) & 0xff
+			chunk_width = chunk * width
+			encoded = (encoded << chunk_width) | (table.bytes[byte] & ((1 << chunk_width) - 1))
+		return self.append(encoded, len(bit_string) * width)
+
+	def append_run(self, bit, count):
+		""" Add `count` copies of the given bit to the end """
+		if bit and bit != '0':
+			return self.append((1 << count) - 1, count)
+		return self.append(0, count)
+
+	def extend(self, other):
+		""" Add the bits of another BitBuffer to the end """
+		return self.append(other.value, other.length)
+
+	def copy(self):
+		return BitBuffer(self.value, self.length)
+
+	def repeat(self, times):
+		""" Returns a new buffer of this one sent `times` times in a row """
+		result = BitBuffer()
+		chunk = self.copy()
+		while times > 0:
+			if times & 1:
+				result.extend(chunk)
+			chunk.extend(chunk)
+			times = times >> 1
+		return result
+
+	def reverse(self):
+		""" Returns a new buffer with the bits in the opposite order """
+		return BitBuffer.from_string(str(self)[::-1])
+
+	def strip(self):
+		""" Returns a new buffer without the leading or trailing 0 bits """
+		if self.value == 0:
+			return BitBuffer()
+		trailing = bit_length(self.value & -self.value) - 1
+		return BitBuffer(self.value >> trailing, bit_length(self.value) - trailing)
+
+	def runs(self):
+		""" Run-length emit: yields (bit, count) for each run of identical bits """
+		for run in re.findall('0+|1+', str(self)):
+			yield (int(run[0]), len(run))
+
+	def tobytes(self, align='left', block=1):
+		""" Pack the bits into a byte string for rflib to send
+
+		Left aligned buffers are padded with 0 bits at the end,
+		right aligned buffers are padded with 0 bits at the start
+		and the result is padded out to a multiple of `block` bytes
+		The packed bytes are remembered until the buffer changes again
+		"""
+		key = (align, block)
+		if self._packed is not None and self._packed[0] == key:
+			return self._packed[1]
+		byte_count = (self.length + 7) // 8
+		byte_count = ((byte_count + block - 1) // block) * block
+		value = self.value
+		if align == 'left':
+			value = value << (byte_count * 8 - self.length)
+		packed = binascii.unhexlify('%0*x' % (byte_count * 2, value))
+		self._packed = (key, packed)
+		return packed
+
+	def __len__(self):
+		return self.length
+
+	def __str__(self):
+		if self.length == 0:
+			return ''
+		bits = bin(self.value)[2:]
+		return '0' * (self.length - len(bits)) + bits
+
+	def __repr__(self):
+		return 'BitBuffer(%r)' % (str(self),)
+
+	def __add__(self, other):
+		return self.copy().extend(other)
+
+	def __eq__(self, other):
+		return isinstance(other, BitBuffer) and \
+		       self.value == other.value and self.length == other.length
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((self.value, self.length))
+
+class SymbolTable(object):
+	""" How each logical bit gets sent as radio symbols
+
+	The symbols for every possible byte are precomputed,
+	so that BitBuffer.append_symbols can expand 8 bits at a time
+
+	>>> BitBuffer().append_symbols('0110', SymbolTable(zero=0b001, one=0b011, width=3))
+	BitBuffer('001011011001')
+	>>> BitBuffer().append_symbols('110011001', SymbolTable(zero=0b00, one=0b10, width=2))
+	BitBuffer('101000001010000010')
+	"""
+	def __init__(self, zero, one, width):
+		self.width = width
+		self.bytes = []
+		for byte in range(256):
+			encoded = 0
+			for position in range(7, -1, -1):
+				symbol = one if (byte >> position) & 1 else zero
+				encoded = (encoded << width) | symbol
+			self.bytes.append(encoded)
+
+	@classmethod
+	def from_pulses(klass, zero, one, symbol_length):
+		""" Build the table from the (level, microseconds) pulses of each bit
+
+		>>> table = SymbolTable.from_pulses([(0, 380), (1, 190)], [(0, 190), (1, 380)], 190)
+		>>> BitBuffer().append_symbols('01', table)
+		BitBuffer('001011')
+		"""
+		zero = synthesize(zero, symbol_length)
+		one = synthesize(one, symbol_length)
+		if len(zero) != len(one):
+			raise ValueError("Zero and one must be the same number of symbols: %r %r" % (zero, one))
+		return klass(zero.value, one.value, len(zero))
+
+class PulseTiming(object):
+	""" The pulse and space lengths of a protocol, in microseconds,
+	and how precisely the radio needs to reproduce them
+
+	weights is a dict of each length to about how many times it is sent
+	per frame, eps is the allowed error in percent and aeps in microseconds,
+	as in LIRC configs, and distinct is a list of pulse length sequences,
+	such as the zero and one bits, that must still be told apart
+
+	>>> timing = PulseTiming({190: 19, 380: 12, 6650: 1}, distinct=[(380, 190), (190, 380)])
+	>>> timing.cost(190)
+	78
+	>>> timing.cost(380)
+	"""
+	# only use this much of the tolerance,
+	# leaving the rest for the real remote's own timing error
+	MARGIN = 0.5
+
+	def __init__(self, weights, eps=30, aeps=100, distinct=()):
+		self.weights = weights
+		self.eps = eps
+		self.aeps = aeps
+		self.distinct = [tuple(d) for d in distinct]
+
+	@classmethod
+	def from_pulses(klass, pulses, **kwargs):
+		""" Count the lengths in a typical frame of (level, microseconds) pulses
+
+		>>> sorted(PulseTiming.from_pulses([(0, 380), (1, 190), (0, 190), (1, 380), (0, 6650)]).weights.items())
+		[(190, 2), (380, 2), (6650, 1)]
+		"""
+		weights = {}
+		for level, length in pulses:
+			weights[length] = weights.get(length, 0) + 1
+		return klass(weights, **kwargs)
+
+	def key(self):
+		return (tuple(sorted(self.weights.items())), self.eps, self.aeps, tuple(self.distinct))
+
+	def cost(self, symbol_length):
+		""" How costly it is to send this protocol with this many microseconds per symbol
+		It is the number of symbols in a typical frame, scaled up by how much
+		of the allowed timing error is used, or None if the error is too large
+		"""
+		symbols = 0
+		worst_error = 0
+		for time, weight in self.weights.items():
+			periods = max(1, int(round(time * 1.0 / symbol_length)))
+			allowed = max(time * self.eps / 100.0, self.aeps) * self.MARGIN
+			error = abs(periods * symbol_length - time) / allowed
+			if error > 1:
+				return None
+			worst_error = max(worst_error, error)
+			symbols = symbols + weight * periods
+		encoded = set()
+		for times in self.distinct:
+			encoded.add(tuple([int(round(t * 1.0 / symbol_length)) for t in times]))
+		if len(encoded) < len(self.distinct):
+			return None
+		return symbols * (1 + worst_error)
+
+_solved_symbol_lengths = {}
+
+def solve_symbol_length(timings, min_baudrate=600, max_baudrate=250000):
+	"""
+	Find the microseconds per symbol that sends all of the given PulseTimings
+	in the fewest symbols, while keeping within each one's timing error
+	Protocols that are sent by the same radio can be solved together
+
+	>>> solve_symbol_length([PulseTiming({300: 1, 600: 1})])
+	300
+	>>> solve_symbol_length([PulseTiming({300: 1, 600: 1}), PulseTiming({190: 1})])
+	150
+	>>> solve_symbol_length([PulseTiming({300: 1, 301: 1}, eps=0, aeps=0.01)])
+	Traceback (most recent call last):
+	...
+	ValueError: No symbol length between 4us and 600us keeps within the timing error of every protocol
+	"""
+	key = (tuple([t.key() for t in timings]), min_baudrate, max_baudrate)
+	if key in _solved_symbol_lengths:
+		return _solved_symbol_lengths[key]
+	times = [time for t in timings for time in t.weights]
+	shortest = max(1, int(1000000 / max_baudrate))
+	longest = int(1000000 / min_baudrate)
+	if len(times) > 0:
+		# the shortest time needs at least one symbol
+		longest = min(longest, 2 * min(times))
+	best_length = None
+	best_cost = None
+	for symbol_length in range(shortest, longest + 1):
+		cost = 0
+		for timing in timings:
+			timing_cost = timing.cost(symbol_length)
+			if timing_cost is None:
+				break
+			cost = cost + timing_cost
+		else:
+			if best_cost is None or cost <= best_cost:
+				best_length = symbol_length
+				best_cost = cost
+	if best_length is None:
+		raise ValueError("No symbol length between %ius and %ius keeps within the timing error of every protocol" % (shortest, longest))
+	_solved_symbol_lengths[key] = best_length
+	return best_length
+
+def synthesize(pulses, symbol_length):
+	"""
+	Turn a list of (level, microseconds) pulses into radio symbols
+
+	Each edge is placed at the symbol nearest to its real time,
+	so rounding errors don't add up over a long frame,
+	and every pulse lasts for at least one symbol
+
+	>>> synthesize([(1, 300), (0, 600), (1, 300)], 300)
+	BitBuffer('1001')
+	>>> synthesize([(1, 250), (0, 250), (1, 250), (0, 250)], 200)
+	BitBuffer('10010')
+	>>> synthesize([(1, 50), (0, 1000)], 200)
+	BitBuffer('10000')
+	"""
+	symbols = BitBuffer()
+	elapsed = 0
+	for level, length in pulses:
+		elapsed = elapsed + length
+		count = max(1, int(round(elapsed * 1.0 / symbol_length)) - len(symbols))
+		symbols.append_run(level, count)
+	return symbols
+
+class FrameBurst(object):
+	""" A protocol's frame sent several times in one transmission
+
+	The frame is trimmed down to its first and last pulse, and each
+	copy follows the previous one after exactly `gap` symbols of silence,
+	without any padding to line the frames up to byte boundaries
+	Only the end of the whole burst is padded out to a full byte
+
+	>>> burst = FrameBurst(BitBuffer.from_string('0011011'), gap=3, count=3)
+	>>> burst.symbols()
+	BitBuffer('110110001101100011011')
+	>>> len(burst)
+	21
+	>>> burst.tobytes()
+	'\\xd8\\xd8\\xd8'
+	>>> burst.air_time(1000)
+	0.024
+	"""
+	def __init__(self, frame, gap, count):
+		self.frame = frame.strip()
+		self.gap = gap
+		self.count = count
+		self._symbols = None
+
+	def symbols(self):
+		if self._symbols is None:
+			spaced = self.frame.copy().append_run(0, self.gap)
+			self._symbols = spaced.repeat(self.count - 1).extend(self.frame)
+		return self._symbols
+
+	def tobytes(self):
+		return self.symbols().tobytes()
+
+	def air_time(self, baudrate):
+		""" Seconds that the radio spends sending the packed bytes """
+		return len(self.tobytes()) * 8.0 / baudrate
+
+	def __len__(self):
+		return len(self.symbols())
 
 class PWMThreeSymbolMixin(object):
+	__slots__ = ()
+
+	PWM_SYMBOLS = SymbolTable(
+		zero=0b001,	#  A zero is encoded as a longer low pulse (low-low-high)
+		one=0b011,	# and a one is encoded as a shorter low pulse (low-high-high)
+		width=3
+	)
+
 	@staticmethod
 	def _encode_pwm_symbols(bit_string):
 		"""
 		>>> PWMThreeSymbolMixin._encode_pwm_symbols("00110011")
-		'001001011011001001011011'
-		"""
-		pwm_str_key = []
-		for k in bit_string:
-			x = ""
-			if(k == "0"):
-				x = "001" #  A zero is encoded as a longer low pulse (low-low-high)
-			if(k == "1"):
-				x = "011" # and a one is encoded as a shorter low pulse (low-high-high)
-			pwm_str_key.append(x)
-		return ''.join(pwm_str_key)
+		BitBuffer('001001011011001001011011')
+		"""
+		return BitBuffer().append_symbols(bit_string, PWMThreeSymbolMixin.PWM_SYMBOLS)
 
 	@staticmethod
 	def _decode_pwm_symbols(symbols):
 		""" Turns a string of radio symbols into a PCM-decoded packet
 		>>> PWMThreeSymbolMixin._decode_pwm_symbols("001011001011")
 		'0101'
-		>>> PWMThreeSymbolMixin._decode_pwm_symbols( \
+		>>> PWMThreeSymbolMixin._decode_pwm_symbols(str( \
 			PWMThreeSymbolMixin._encode_pwm_symbols("001001110101") \
-		)
+		))
 		'001001110101'
 
 		# sometimes the 0 bits get held a little longer
@@ -175,6 +1005,8 @@ class ThreeSpeedFanMixinPower(SubDeviceDriver):
 	>>> ThreeSpeedFanMixinPower(None).get_available_states()
 	['OFF', 'ON']
 	"""
+	__slots__ = ()
+
 	STATE_COMMANDS = {
 		'ON': 'ON',
 		'OFF': 'OFF',
@@ -210,6 +1042,7 @@ class ThreeSpeedFanMixinSpeed(SubDeviceDriver):
 	>>> ThreeSpeedFanMixinSpeed(None).get_available_states()
 	['1', '2', '3']
 	"""
+	__slots__ = ()
 
 	# advertise these STATE_COMMANDS here
 	# so that this subdevice gets the speed commands
@@ -250,6 +1083,7 @@ class ThreeSpeedFanMixinCommand(SubDeviceDriver):
 	>>> ThreeSpeedFanMixinCommand(None).get_available_states()
 	['0', '1', '2', '3']
 	"""
+	__slots__ = ()
 
 	STATE_COMMANDS = {
 		'0': '0',
@@ -273,26 +1107,28 @@ class ThreeSpeedFanMixinCommand(SubDeviceDriver):
 	def get_name(klass):
 		return "command"
 
-	def _handle_state_update(self, state):
+	def _handle_state_update(self, state, source='eavesdrop'):
 		""" Handle the state update from an eavesdropper
 		Takes care of distributing state updates to other subdevs
 		"""
 		command = self._state_to_command(state)
-		self._set(command)  # command sudevice
+		self._set(command, source)  # command sudevice
 		if command != '0':
-			self.parent._set('ON')
-			self.parent.subdevices['power']._set('ON')
-			self.parent.subdevices['speed']._set(state)
+			self.parent._set('ON', source)
+			self.parent.subdevices['power']._set('ON', source)
+			self.parent.subdevices['speed']._set(state, source)
 		else:
-			self.parent._set('OFF')
-			self.parent.subdevices['power']._set('OFF')
+			self.parent._set('OFF', source)
+			self.parent.subdevices['power']._set('OFF', source)
 
 	def set_state(self, state):
 		""" Actually controls the fan, and the distributes state updates """
 		command = self._state_to_command(state)
+		if self._is_resend(self._get(), command):
+			return state
 		self.parent._send_command(command)
 		# save the updated state, as the numeric command
-		self._handle_state_update(state)
+		self._handle_state_update(state, source='command')
 		return state
 
 class ThreeSpeedFanMixin(object):
@@ -307,6 +1143,9 @@ class ThreeSpeedFanMixin(object):
 		It also lets you directly see what the current fan speed is
 		instead of needing to calculate it from /power and /speed
 	"""
+	__metaclass__ = DispatchTables
+	__slots__ = ()
+
 	CLASS = 'fans'
 
 	SUBDEVICES = [
@@ -324,23 +1163,21 @@ class ThreeSpeedFanMixin(object):
 
 	@property
 	def subdevices(self):
-		return dict(((dev.get_name(), dev(self)) for dev in self.SUBDEVICES))
+		return _cached_subdevices(self)
 
 	def get_acceptable_states(self):
 		"""
 		>>> ThreeSpeedFanMixin().get_acceptable_states()
 		['0', '1', '2', '3', 'FALSE', 'H', 'HI', 'HIGH', 'L', 'LO', 'LOW', 'M', 'MED', 'MID', 'O', 'OFF', 'ON', 'TRUE']
 		"""
-		all_states = itertools.chain.from_iterable((d.get_acceptable_states() for d in self.subdevices.values()))
-		return sorted(list(set(all_states)))
+		return list(self._SUBDEVICE_STATES)
 
 	def get_available_states(self):
 		"""
 		>>> ThreeSpeedFanMixin().get_available_states()
 		['OFF', 'ON']
 		"""
-		returnable_states = self.subdevices['power'].get_available_states()
-		return sorted(list(set(returnable_states)))
+		return list(ThreeSpeedFanMixinPower._AVAILABLE_STATES)
 
 	def get_state(self):
 		d = self.subdevices['power']
@@ -348,18 +1185,20 @@ class ThreeSpeedFanMixin(object):
 
 	def set_state(self, state):
 		# find the first subdevice that claims the given state
-		for device in self.SUBDEVICES:
-			d = device(self)
-			if state in d.get_acceptable_states():
-				return d.set_state(state)
-		raise ValueError(state)
+		device = self._STATE_SUBDEVICES.get(state)
+		if device is None:
+			raise ValueError(state)
+		return self.subdevices[device.get_name()].set_state(state)
 
-	def _handle_state_update(self, state):
+	def _handle_state_update(self, state, source='eavesdrop'):
 		# eavesdropped from a remote
-		self.subdevices['command']._handle_state_update(state)
+		self.subdevices['command']._handle_state_update(state, source)
 
 class LightMixin(object):
 	""" A simple ON/OFF light switch """
+	__metaclass__ = DispatchTables
+	__slots__ = ()
+
 	CLASS = 'lights'
 
 	STATE_COMMANDS = {
@@ -398,16 +1237,23 @@ class LightMixin(object):
 		>>> LightMixin().get_acceptable_states()
 		['0', '1', 'FALSE', 'OFF', 'ON', 'TRUE']
 		"""
-		return sorted(self.STATE_COMMANDS.keys())
+		return list(self._ACCEPTABLE_STATES)
 
 	def get_available_states(self):
 		"""
 		>>> LightMixin().get_available_states()
 		['OFF', 'ON']
 		"""
-		return sorted(list(set(self.STATE_COMMANDS.values())))
+		return list(self._AVAILABLE_STATES)
+
+	def _current_command(self):
+		""" The command of the saved state, which is saved as it was given """
+		return self.STATE_COMMANDS.get((self._get() or '').upper())
 
 	def set_state(self, state):
-		self._send_command(self._state_to_command(state))
+		command = self._state_to_command(state)
+		if self._is_resend(self._current_command(), command):
+			return state
+		self._send_command(command)
 		self._set(state)
 		return state
@@ -0,0 +1,18 @@
+# Example drivers that don't send anything, for testing
+from restful_rfcat.drivers._utils import DeviceDriver, LightMixin, ThreeSpeedFanMixin
+
+class FakeDevice(DeviceDriver):
+	__slots__ = ()
+	def get_class(self):
+		return self.CLASS
+	def _send_command(self, command):
+		# nop
+		pass
+	def set_state(self, state):
+		return self._set(state)
+
+class FakeLight(LightMixin, FakeDevice):
+	__slots__ = ()
+
+class FakeFan(ThreeSpeedFanMixin, FakeDevice):
+	__slots__ = ()
@@ -4,11 +4,13 @@ import logging
 import struct
 import re
 from restful_rfcat import radio
-from restful_rfcat.drivers._utils import DeviceDriver, SubDeviceDriver
+from restful_rfcat.drivers._utils import BitBuffer, DeviceDriver, FrameBurst, PulseTiming, SubDeviceDriver, SymbolTable, solve_symbol_length
 
 logger = logging.getLogger(__name__)
 
 class FeitElectric(DeviceDriver):
+	__slots__ = ('address',)
+
 	devices = {}
 	commands = {
 		'on': '11110100',
@@ -22,7 +24,28 @@ class FeitElectric(DeviceDriver):
 		'blue': '10110101',
 		'white': '10111010'
 	}
-	radio = radio.OOKRadio(433920000, 4880)
+	# the (level, microseconds) pulses of the protocol
+	#  A zero is encoded as a longer low pulse (low-low)
+	# and a one is encoded as a shorter low pulse (high-low)
+	ZERO_PULSES = [(0, 410)]
+	ONE_PULSES = [(1, 205), (0, 205)]
+	# Each command bitstring has a gap of 22.5 0s, measured to be 20
+	GAP = 4920
+	# the lights are picky about the gap, so keep to 10%
+	PULSE_TIMING = PulseTiming.from_pulses(
+		(ZERO_PULSES + ONE_PULSES) * 18 + [(0, GAP)],
+		eps=10, aeps=50
+	)
+	SYMBOL_LENGTH = solve_symbol_length([PULSE_TIMING])
+	PWM_SYMBOLS = SymbolTable.from_pulses(ZERO_PULSES, ONE_PULSES, SYMBOL_LENGTH)
+	FRAME_GAP = int(round(GAP * 1.0 / SYMBOL_LENGTH))
+	radio = radio.OOKRadio(433920000, 1000000 / SYMBOL_LENGTH)
+	# how many frames to send for each command
+	FRAME_COUNT = 6
+	# 50ms of silence between separate button presses in one transmission
+	PRESS_GAP = int(round(50000.0 / SYMBOL_LENGTH))
+	# on, off and the colors are idempotent
+	RESEND_INTERVAL = 600
 
 	def __init__(self, address, **kwargs):
 		""" address is the prefix before the command string
@@ -48,63 +71,64 @@ class FeitElectric(DeviceDriver):
 	def _encode_pwm(bin_key):
 		"""
 		>>> FeitElectric._encode_pwm("00110011")
-		'0000101000001010'
+		BitBuffer('0000101000001010')
 		"""
-		pwm_str_key = []
-		for k in bin_key:
-			x = ""
-			if(k == "0"):
-				x = "00" #  A zero is encoded as a longer low pulse (low-low-high)
-			if(k == "1"):
-				x = "10" # and a one is encoded as a shorter low pulse (low-high-high)
-			pwm_str_key.append(x)
-		return ''.join(pwm_str_key)
+		return BitBuffer().append_symbols(bin_key, FeitElectric.PWM_SYMBOLS)
 
 	@staticmethod
-	def _encode(bin_key):
+	def _encode(bin_key, count=1):
 		"""
 		FeitElectric lights have a precise gap of 22.5-24 zeros between each command
-		Which is hard to line up to byte boundaries
+		Which is hard to line up to byte boundaries, so the frames are packed
+		back to back and only the end of the burst is padded out
 
 		>>> FeitElectric._encode("01100110")
-		'\\xa0\\xa0\\x00\\x00\\x14\\x14\\x00\\x00\\x02\\x82\\x80\\x00\\x00PP\\x00\\x00\\n\\n\\x00\\x00\\x01A@\\x00\\x00\\x00'
+		'\\xa0\\xa0'
+		>>> FeitElectric._encode("01100110", 3)
+		'\\xa0\\xa0\\x00\\x00\\x14\\x14\\x00\\x00\\x02\\x82\\x80'
+		"""
+		pwm_key = FeitElectric._encode_pwm(bin_key)
+		#print "Binary (PWM) key:",pwm_key
+		return FrameBurst(pwm_key, FeitElectric.FRAME_GAP, count).tobytes()
+
+	@staticmethod
+	def _encode_presses(bin_keys, count=1):
 		"""
-		pwm_str_key = FeitElectric._encode_pwm(bin_key)
-		# Each command bitstring has a gap of 22.5 0s, measured to be 20
-		pwm_str_key = pwm_str_key.strip('0') + '0' * 24
-		#print "Binary (PWM) key:",pwm_str_key
-		key_packed = ''
-		pwm_index = 0
-		iterations = 5
-		while pwm_index != len(pwm_str_key) and iterations >= 0:
-			str_byte = pwm_str_key[pwm_index:pwm_index+8]
-			pwm_index = pwm_index + 8
-			if len(str_byte) < 8:
-				if iterations > 0:
-					# wrap around the string
-					pwm_index = pwm_index - len(pwm_str_key)
-					str_byte = str_byte + pwm_str_key[0:pwm_index]
-					# make sure we don't get stuck
-					iterations = iterations - 1
-				else:
-					# fill out with 0s
-					pwm_index = pwm_index - len(pwm_str_key)
-					str_byte = str_byte + '0'*pwm_index
-					# make sure we don't get stuck
-					iterations = iterations - 1
-			int_byte = int(str_byte, 2)
-			key_packed = key_packed + struct.pack(">B", int_byte)
-		return key_packed
+		Several button presses, each its own burst of frames,
+		sent back to back as one transmission
+
+		>>> FeitElectric._encode_presses(["01100110"]) == FeitElectric._encode("01100110")
+		True
+		>>> FeitElectric._encode_presses(["01100110", "01100110"]) == '\\xa0\\xa0' + '\\x00' * 29 + '\\x01A@'
+		True
+		"""
+		symbols = BitBuffer()
+		for index, bin_key in enumerate(bin_keys):
+			if index > 0:
+				symbols.append_run(0, FeitElectric.PRESS_GAP)
+			burst = FrameBurst(FeitElectric._encode_pwm(bin_key), FeitElectric.FRAME_GAP, count)
+			symbols.extend(burst.symbols())
+		return symbols.tobytes()
 
 	@classmethod
 	def _send(klass, bits):
-		symbols = klass._encode(bits)
-		klass.radio.send(symbols, repeat=5)
+		symbols = klass._encode(bits, klass.FRAME_COUNT)
+		klass.radio.send(symbols, repeat=0)
 
 	def _send_command(self, command):
 		logger.info("Sending command %s to %s" % (command, self.address))
 		self._send(self._get_bin_key(command))
 
+	def _send_commands(self, commands):
+		""" Send several commands in a single transmission """
+		logger.info("Sending commands %s to %s" % (','.join(commands), self.address))
+		bin_keys = [self._get_bin_key(command) for command in commands]
+		self.radio.send(self._encode_presses(bin_keys, self.FRAME_COUNT), repeat=0)
+
+	def _press_symbols(self, command):
+		pwm_key = self._encode_pwm(self._get_bin_key(command))
+		return FrameBurst(pwm_key, self.FRAME_GAP, self.FRAME_COUNT).symbols()
+
 	def _get_bin_key(self, command):
 		"""
 		>>> FeitElectric(name='test', label='Test', address='0110110111110101011110101111')._get_bin_key('on')
@@ -124,6 +148,8 @@ class FeitElectric(DeviceDriver):
 		return self._get()
 
 class FeitElectricLightsColor(SubDeviceDriver):
+	__slots__ = ()
+
 	STATE_COMMANDS = {
 		"RED": "RED",
 		"GREEN": "GREEN",
@@ -137,26 +163,104 @@ class FeitElectricLightsColor(SubDeviceDriver):
 
 	def set_state(self, state):
 		command = self._state_to_command(state)
+		if self._is_resend(self._get(), command):
+			return state
 		self.parent._send_command(command.lower())
 		self._set(state)
 		return state
 
+class FeitElectricLightsBrightness(SubDeviceDriver):
+	""" Steps the brightness up and down with the plus and minus buttons
+
+	The lights only have relative brightness buttons, which stop
+	at the dimmest and brightest levels, so the current level is
+	tracked and each change sends the fewest presses to reach it
+	"""
+	__slots__ = ()
+
+	LEVELS = 10
+	STATE_COMMANDS = dict((str(level), str(level)) for level in range(1, LEVELS + 1))
+
+	@classmethod
+	def get_name(klass):
+		return "brightness"
+
+	def get_available_states(self):
+		"""
+		>>> FeitElectricLightsBrightness(None).get_available_states()
+		['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']
+		"""
+		return sorted(self._AVAILABLE_STATES, key=int)
+
+	@classmethod
+	def plan_steps(klass, current, target):
+		""" The button presses to go from the current level to the target
+		    If the current level is unknown, the brightness is first pushed
+		    to whichever end of the range is closer to the target
+
+		>>> FeitElectricLightsBrightness.plan_steps(3, 5)
+		['plus', 'plus']
+		>>> FeitElectricLightsBrightness.plan_steps(5, 4)
+		['minus']
+		>>> FeitElectricLightsBrightness.plan_steps(7, 7)
+		[]
+		>>> FeitElectricLightsBrightness.plan_steps(None, 2)
+		['minus', 'minus', 'minus', 'minus', 'minus', 'minus', 'minus', 'minus', 'minus', 'plus']
+		>>> FeitElectricLightsBrightness.plan_steps(None, 9)
+		['plus', 'plus', 'plus', 'plus', 'plus', 'plus', 'plus', 'plus', 'plus', 'minus']
+		"""
+		if current is None:
+			from_bottom = ['minus'] * (klass.LEVELS - 1) + ['plus'] * (target - 1)
+			from_top = ['plus'] * (klass.LEVELS - 1) + ['minus'] * (klass.LEVELS - target)
+			return min(from_bottom, from_top, key=len)
+		if target > current:
+			return ['plus'] * (target - current)
+		return ['minus'] * (current - target)
+
+	def set_state(self, state):
+		command = self._state_to_command(state)
+		current = self._get()
+		steps = self.plan_steps(int(current) if current else None, int(command))
+		if steps:
+			self.parent._send_commands(steps)
+		self._set(command)
+		return command
+
 class FeitElectricLights(FeitElectric):
+	__slots__ = ()
+
 	CLASS = 'lights'
 
-	SUBDEVICES = [FeitElectricLightsColor]
+	SUBDEVICES = [FeitElectricLightsColor, FeitElectricLightsBrightness]
 
 	def get_acceptable_states(self):
-		return ["OFF", "ON"] + FeitElectricLightsColor.get_acceptable_states()
+		return ["OFF", "ON"] + list(self._SUBDEVICE_STATES)
 
 	def get_available_states(self):
 		return ["OFF", "ON"]
 
+	def _pressed(self, command):
+		if command in ('on', 'off'):
+			self._set(command.upper())
+		elif command.upper() in FeitElectricLightsColor.STATE_COMMANDS:
+			self.subdevices['color']._set(command.upper())
+		elif command in ('plus', 'minus'):
+			brightness = self.subdevices['brightness']
+			current = brightness._get()
+			if current:
+				# the buttons stop at the dimmest and brightest levels
+				level = int(current) + (1 if command == 'plus' else -1)
+				level = max(1, min(brightness.LEVELS, level))
+				brightness._set(str(level))
+		# up and down change the effect speed, which isn't saved
+
 	def set_state(self, state):
-		if state in self.subdevices['color'].get_acceptable_states():
-			return self.subdevices['color'].set_state(state)
+		if state in self._STATE_SUBDEVICES:
+			return self.subdevices[self._STATE_SUBDEVICES[state].get_name()].set_state(state)
 		if state not in self.get_available_states():
 			raise ValueError("Invalid state: %s" % (state,))
+		if self._is_resend(self._get(), state):
+			return state
 		self._send_command(state.lower())
 		self._set(state)
 		return state
@@ -3,12 +3,16 @@ from operator import itemgetter
 import logging
 import struct
 import re
+import threading
 from restful_rfcat import radio
-from restful_rfcat.drivers._utils import DeviceDriver, PWMThreeSymbolMixin, ThreeSpeedFanMixin, LightMixin
+from restful_rfcat.state import store
+from restful_rfcat.drivers._utils import BitBuffer, DeviceDriver, FrameBurst, PulseTiming, PWMThreeSymbolMixin, SymbolTable, ThreeSpeedFanMixin, LightMixin, solve_symbol_length
 
 logger = logging.getLogger(__name__)
 
 class HamptonCeiling(DeviceDriver, PWMThreeSymbolMixin):
+	__slots__ = ('dip_switch',)
+
 	devices = {}
 	commands = {
 		'fan0': '1111',
@@ -18,7 +22,30 @@ class HamptonCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		'lighton': '0011',
 		'lightoff': '1011'
 	}
-	radio = radio.OOKRadio(303700000, 3324)
+	# the (level, microseconds) pulses of the protocol
+	ZERO_PULSES = [(0, 600), (1, 300)]
+	ONE_PULSES = [(0, 300), (1, 600)]
+	# 12000us of silence between frames, as in the UC7078T LIRC config
+	GAP = 12000
+	PULSE_TIMING = PulseTiming.from_pulses(
+		(ZERO_PULSES + ONE_PULSES) * 11 + [(0, GAP)],
+		distinct=[[t for l, t in ZERO_PULSES], [t for l, t in ONE_PULSES]]
+	)
+	SYMBOL_LENGTH = solve_symbol_length([PULSE_TIMING])
+	PWM_SYMBOLS = SymbolTable.from_pulses(ZERO_PULSES, ONE_PULSES, SYMBOL_LENGTH)
+	FRAME_GAP = int(round(GAP * 1.0 / SYMBOL_LENGTH))
+	radio = radio.OOKRadio(303700000, 1000000 / SYMBOL_LENGTH)
+	# how many frames the radio sent for each command, by default
+	FRAME_COUNT = 11
+	# the combined packets set the light and fan exactly, so repeating them is harmless
+	RESEND_INTERVAL = 600
+	# seconds to wait for the other subdevice to change too,
+	# so that a scene setting both sends a single combined packet
+	COALESCE_WINDOW = 0.05
+	_timer = threading.Timer
+	# the light and fan states waiting to be sent, by dip_switch
+	pending = {}
+	pending_lock = threading.Lock()
 
 	def __init__(self, dip_switch, **kwargs):
 		""" dip_switch is the jumper settings from the remote
@@ -42,42 +69,90 @@ class HamptonCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		return klass.devices.get(device_name)
 
 	@staticmethod
-	def _encode(bin_key):
+	def _encode(bin_key, count=1):
 		"""
-		>>> print(HamptonCeiling._encode("00110011"))
-		\x00\x00\x00\x00\x00%\xb2[
+		>>> HamptonCeiling._encode("00110011")
+		'\\x96\\xc9l'
+		>>> len(HamptonCeiling._encode("0111110111111110111010", 3))
+		34
 		"""
-		pwm_str_key = HamptonCeiling._encode_pwm_symbols(bin_key)
-		pwm_str_key = "" + pwm_str_key #added leading 0 for clock
-		#print "Binary (PWM) key:",pwm_str_key
-		dec_pwm_key = int(pwm_str_key, 2);
-		#print "Decimal (PWN) key:",dec_pwm_key
-		key_packed = ''
-		while dec_pwm_key > 0:
-			key_packed = struct.pack(">Q", dec_pwm_key & (2**64-1)) + key_packed
-			dec_pwm_key = dec_pwm_key >> 64
-		return key_packed
+		pwm_key = BitBuffer().append_symbols(bin_key, HamptonCeiling.PWM_SYMBOLS)
+		#print "Binary (PWM) key:",pwm_key
+		return FrameBurst(pwm_key, HamptonCeiling.FRAME_GAP, count).tobytes()
 
 	@classmethod
 	def _send(klass, bits):
-		symbols = klass._encode(bits)
-		klass.radio.send(symbols)
+		symbols = klass._encode(bits, klass.FRAME_COUNT)
+		klass.radio.send(symbols, repeat=0)
+
+	def _press_symbols(self, command):
+		""" command is one of the commands, such as lighton or fan2 """
+		bin_key = self._get_bin_key(self.commands[command])
+		pwm_key = BitBuffer().append_symbols(bin_key, self.PWM_SYMBOLS)
+		return FrameBurst(pwm_key, self.FRAME_GAP, self.FRAME_COUNT).symbols()
+
+	def _pressed(self, command):
+		# every command sets both the light and the fan
+		bits = self.commands[command]
+		light = self._get_device(device_type='Light', dip_switch=self.dip_switch)
+		if light is not None:
+			light._set('ON' if bits[0] == '0' else 'OFF')
+		fan = self._get_device(device_type='Fan', dip_switch=self.dip_switch)
+		if fan is not None:
+			for speed in '0123':
+				if self.commands['fan%s' % (speed,)][1:] == bits[1:]:
+					fan._handle_state_update(speed, source='command')
 
 	def _get_bin_key(self, bits):
 		"""
 		>>> HamptonCeiling(name='test', label='Test', dip_switch='1011')._get_bin_key('1011')
-		'01111101111111101110100000000000000000000000'
+		'0111110111111110111010'
 		>>> HamptonCeiling(name='test', label='Test', dip_switch='0010')._get_bin_key('0011')
-		'01110100111111001110100000000000000000000000'
+		'0111010011111100111010'
 		"""
 		bin_key = '0111%s111111%s1010' % (self.dip_switch[::-1], bits)
-		bin_key = bin_key + '0'*22
 		return bin_key
 
 	def set_state_combined(self, light=None, fan=None):
 		""" light should be on or off
 		    fan should be 0,1,2,3
+		    Changes to the same remote within COALESCE_WINDOW are sent together
 		"""
+		if not self.COALESCE_WINDOW:
+			self._send_combined(light, fan)
+			return
+		with self.pending_lock:
+			batch = self.pending.get(self.dip_switch)
+			if batch is None:
+				batch = self.pending[self.dip_switch] = {}
+				timer = self._timer(self.COALESCE_WINDOW, self._dispatch_flush)
+				timer.daemon = True
+				timer.start()
+			if light is not None:
+				batch['light'] = light
+			if fan is not None:
+				batch['fan'] = fan
+
+	def _dispatch_flush(self):
+		# send in order with the device's other changes
+		self.mailbox.send(self._flush_combined)
+
+	def _flush_combined(self):
+		with self.pending_lock:
+			batch = self.pending.pop(self.dip_switch, {})
+		try:
+			self._send_combined(batch.get('light'), batch.get('fan'))
+		except Exception as e:
+			# the states were already saved, so flag them as not sent
+			logger.warning("Failure to send to %s: %s" % (self.dip_switch, e))
+			for device_type in ('Light', 'Fan'):
+				if device_type.lower() not in batch:
+					continue
+				device = self._get_device(device_type=device_type, dip_switch=self.dip_switch)
+				if device is not None:
+					store.mark_unsent(device._state_path())
+
+	def _send_combined(self, light, fan):
 		if light is None:
 			device = self._get_device(device_type='Light', dip_switch=self.dip_switch)
 			light = device.get_state()
@@ -94,14 +169,20 @@ class HamptonCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		self._send(self._get_bin_key(command))
 
 class HamptonCeilingFan(ThreeSpeedFanMixin, HamptonCeiling):
+	__slots__ = ()
+
 	def _send_command(self, command, repeat=None):
 		# ThreeSpeedFanMixin will send a command of 0,1,2,3
 		# Properly integrate it into HamptonCeiling's combined commands
 		super(HamptonCeilingFan, self).set_state_combined(light=None, fan=command)
 
 class HamptonCeilingLight(LightMixin, HamptonCeiling):
+	__slots__ = ()
+
 	def set_state(self, state):
 		command = self._state_to_command(state)
+		if self._is_resend(self._current_command(), command):
+			return state
 		super(HamptonCeilingLight, self).set_state_combined(light=command.lower(), fan=None)
 		self._set(state)
 		return state
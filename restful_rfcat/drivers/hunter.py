@@ -4,13 +4,14 @@ import threading
 import logging
 import re
 import struct
-import time
 from restful_rfcat import radio
-from restful_rfcat.drivers._utils import DeviceDriver, PWMThreeSymbolMixin, ThreeSpeedFanMixin, LightMixin
+from restful_rfcat.drivers._utils import DeviceDriver, EavesdropLimiter, FrameBurst, PulseTiming, PWMThreeSymbolMixin, SymbolTable, ThreeSpeedFanMixin, LightMixin, ToggleReconciler, solve_symbol_length, synthesize
 
 logger = logging.getLogger(__name__)
 
 class HunterCeiling(DeviceDriver, PWMThreeSymbolMixin):
+	__slots__ = ('dip_switch',)
+
 	devices = {}
 	commands = {
 		'fan0': '1001',
@@ -20,7 +21,22 @@ class HunterCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		'light': '1000'
 	}
 	commands_rev = dict([(v,k) for k,v in commands.items()])
-	radio = radio.OOKRadioChannelHack(347999900, 5280, 2)
+	# the (level, microseconds) pulses of the protocol, as in the TX28 LIRC config
+	CLOCK_PULSES = [(0, 380), (1, 190)]
+	ZERO_PULSES = [(0, 380), (1, 190)]
+	ONE_PULSES = [(0, 190), (1, 380)]
+	GAP = 6650
+	PULSE_TIMING = PulseTiming.from_pulses(
+		CLOCK_PULSES + (ZERO_PULSES + ONE_PULSES) * 6 + [(0, GAP)],
+		distinct=[[t for l, t in ZERO_PULSES], [t for l, t in ONE_PULSES]]
+	)
+	SYMBOL_LENGTH = solve_symbol_length([PULSE_TIMING])
+	PWM_SYMBOLS = SymbolTable.from_pulses(ZERO_PULSES, ONE_PULSES, SYMBOL_LENGTH)
+	CLOCK_SYMBOLS = synthesize(CLOCK_PULSES, SYMBOL_LENGTH)
+	FRAME_GAP = int(round(GAP * 1.0 / SYMBOL_LENGTH))
+	radio = radio.OOKRadioChannelHack(347999900, 1000000 / SYMBOL_LENGTH, 2)
+	# how many frames the radio sent for each command, by default
+	FRAME_COUNT = 11
 
 	def __init__(self, dip_switch, **kwargs):
 		""" dip_switch is the jumper settings from the remote
@@ -39,31 +55,85 @@ class HunterCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		self.devices[device_name] = self
 
 	@staticmethod
-	def _encode(bin_key):
+	def _encode_frame(bin_key):
+		"""
+		>>> HunterCeiling._encode_frame("00110011")
+		BitBuffer('001001001011011001001011011')
+		"""
+		pwm_key = HunterCeiling.CLOCK_SYMBOLS.copy() #added leading 0 for clock
+		pwm_key.append_symbols(bin_key, HunterCeiling.PWM_SYMBOLS)
+		#print "Binary (PWM) key:",pwm_key
+		return pwm_key
+
+	@staticmethod
+	def _encode(bin_key, count=1):
 		"""
-		>>> print(HunterCeiling._encode("00110011"))
-		\x00\x00\x00\x00\x01%\xb2[
+		>>> HunterCeiling._encode("00110011")
+		'\\x92\\xd9-\\x80'
+		>>> len(HunterCeiling._encode("001001110100", 3))
+		23
 		"""
-		pwm_str_key = HunterCeiling._encode_pwm_symbols(bin_key)
-		pwm_str_key = "001" + pwm_str_key #added leading 0 for clock
-		#print "Binary (PWM) key:",pwm_str_key
-		dec_pwm_key = int(pwm_str_key, 2);
-		#print "Decimal (PWN) key:",dec_pwm_key
-		key_packed = struct.pack(">Q", dec_pwm_key)
-		return key_packed
+		frame = HunterCeiling._encode_frame(bin_key)
+		return FrameBurst(frame, HunterCeiling.FRAME_GAP, count).tobytes()
 
 	@classmethod
 	def _send(klass, bits, repeat=None):
-		symbols = klass._encode(bits)
-		if repeat is None:
-			klass.radio.send(symbols + '\x00')
-		else:
-			klass.radio.send(symbols + '\x00', repeat)
+		count = klass.FRAME_COUNT if repeat is None else repeat + 1
+		symbols = klass._encode(bits, count)
+		klass.radio.send(symbols, repeat=0)
 
 	def _send_command(self, command, repeat=None):
 		logger.info("Sending command %s to %s" % (command, self.dip_switch))
 		self._send(self._get_bin_key(command), repeat)
 
+	def _press_symbols(self, command):
+		frame = self._encode_frame(self._get_bin_key(command))
+		return FrameBurst(frame, self.FRAME_GAP, self.FRAME_COUNT).symbols()
+
+	def _pressed(self, command):
+		device_type = 'fan' if command.startswith('fan') else 'light'
+		device = self.devices.get('%s-%s' % (self.dip_switch, device_type))
+		if device is not None:
+			self._update_device(device, command, source='command')
+
+	@staticmethod
+	def _update_device(device, command, dim=False, source='eavesdrop'):
+		""" Save the state that a button press left the device in
+		    Runs in the device's mailbox, after any changes that were
+		    waiting, so that a toggle starts from the latest state
+		"""
+		# find new state
+		state = None
+		if command.startswith('fan'):
+			# idempotent state set
+			state = command[3]
+			if state == '0':
+				state = 'OFF'
+		elif command.startswith('light'):
+			# toggle light
+			old_state = device._get()
+			available_states = device.get_available_states()
+			try:
+				old_state_index = available_states.index(old_state)
+				new_state_index = len(available_states) - 1 - old_state_index
+				state = available_states[new_state_index]
+			except ValueError:
+				# don't know current state, don't guess new state
+				pass
+			if dim:
+				# dim command, not a toggle
+				# so assume that the light was turned on
+				state = 'ON'
+		if state is None:
+			return
+		logger.info("Button %s turned %s to %s" % (command, device._state_path(), state))
+		if hasattr(device, '_handle_state_update'):
+			device._handle_state_update(state, source)
+		else:
+			device._set(state, source=source)
+		if hasattr(device, 'reconciler'):
+			device.reconciler.observe(state)
+
 	def _get_bin_key(self, command):
 		"""
 		>>> HunterCeiling(name='test', label='Test', dip_switch='1011')._get_bin_key('fan2')
@@ -75,39 +145,55 @@ class HunterCeiling(DeviceDriver, PWMThreeSymbolMixin):
 		return bin_key
 
 class HunterCeilingFan(ThreeSpeedFanMixin, HunterCeiling):
+	__slots__ = ()
+
+	# each speed has its own button, unlike the light's toggle
+	RESEND_INTERVAL = 600
+
 	def _send_command(self, command, repeat=None):
 		# ThreeSpeedFanMixin will send a command of 0,1,2,3
 		# Change this to fan0, fan1, fan2, fan3 for HunterCeiling
 		super(HunterCeilingFan, self)._send_command('fan' + command, repeat)
 
 class HunterCeilingLight(LightMixin, HunterCeiling):
-	last_set = 0
+	__slots__ = ('reconciler',)
+
+	def __init__(self, **kwargs):
+		super(HunterCeilingLight, self).__init__(**kwargs)
+		self.reconciler = ToggleReconciler(self._toggle, self._force,
+		                                   on_failure=self._rollback, dispatch=self._in_mailbox)
+
+	def _toggle(self):
+		self._send_command('light')
+
+	def _force(self, state):
+		if state == "ON":
+			logger.info("%s light should already be on, forcing on" % (self.name,))
+			self._send_command('light', 100)	# send a dim command to force on
+
+	def _in_mailbox(self, function):
+		self.mailbox.send(function)
+
+	def _rollback(self, state):
+		# the toggle wasn't sent, so the light is still in this state
+		self._set(state)
 
 	def set_state(self, state):
 		""" Hunter ceiling lights don't have an idempotent ON/OFF
-		    so we just always send the toggle command, and save the
-		    user's intended state, assuming the user knows what he wants changed
+		    so the reconciler collects quick changes and only sends
+		    a toggle if the light needs to change, and the user's
+		    intended state is saved straight away
 		"""
 		if state not in self.get_available_states():
 			raise ValueError("Invalid state: %s" % (state,))
-		if time.time() < self.last_set + 5 and \
-		   self._get() == state:
-			# debounce duplicate light settings for 5 seconds
-			# in case something was slow and the user clicked twice
-			# very important with Hunter because it's a toggle light
-			logger.info("Ignoring quickly-repeated light command")
-			return self._get()
-		self.last_set = time.time()
-		repeat = None
-		if state == "ON" and self._get() == "ON":
-			logger.info("%s light should already be on, forcing on" % (self.name,))
-			repeat = 100	# send a dim command to force on
-		self._send_command('light', repeat)
+		# a light that has never been set is assumed to be off
+		self.reconciler.request(state, believed=self._get() or 'OFF')
 		self._set(state)
 		return state
 
 class HunterCeilingEavesdropper(HunterCeiling):
-	radio = radio.OOKRadioChannelHack(347999900, 5280, 2.1, 250000)
+	radio = radio.OOKRadioChannelHack(347999900, 1000000 / HunterCeiling.SYMBOL_LENGTH, 2.1, 250000)
+	limiter = EavesdropLimiter()
 	def __init__(self):
 		# don't register as a device with the regular super constractor
 		# which packets we saw
@@ -123,7 +209,7 @@ class HunterCeilingEavesdropper(HunterCeiling):
 		>>> HunterCeilingEavesdropper._decode_pwm_symbols("1001011001011")
 		'0101'
 		>>> HunterCeilingEavesdropper._decode_pwm_symbols( \
-		        '1'+HunterCeiling._encode_pwm_symbols("001001110101") \
+		        '1'+str(HunterCeiling._encode_pwm_symbols("001001110101")) \
 		)
 		'001001110101'
 
@@ -175,35 +261,13 @@ class HunterCeilingEavesdropper(HunterCeiling):
 				device_type = 'light'
 			device_name = '%s-%s' % (dip_switch, device_type)
 			found_device = klass.devices.get(device_name)
-			# find new state
-			state = None
-			if command.startswith('fan'):
-				# idempotent state set
-				state = command[3]
-				if state == '0':
-					state = 'OFF'
-			elif command.startswith('light'):
-				if found_device is not None:
-					# toggle light
-					old_state = found_device._get()
-					available_states = found_device.get_available_states()
-					try:
-						old_state_index = available_states.index(old_state)
-						new_state_index = len(available_states) - 1 - old_state_index
-						state = available_states[new_state_index]
-					except ValueError:
-						# don't know current state, don't guess new state
-						pass
-				if count > 47:
-					# dim command, not a toggle
-					# so assume that the light was turned on
-					state = 'ON'
-			if found_device is not None and state is not None:
-				logger.info("Eavesdropped command to turn %s-%s to %s" % (found_device.name, device_type, state))
-				if hasattr(found_device, '_handle_state_update'):
-					found_device._handle_state_update(state)
-				else:
-					found_device._set(state)
+			# a long dim press is a different event than a quick toggle
+			event = command if count <= 47 else command + '-dim'
+			toggle = event == 'light'
+			if found_device is not None and \
+			   klass.limiter.allow(found_device._state_path(), event, toggle):
+				# don't hold up receiving while the device is busy
+				found_device.mailbox.send(klass._update_device, found_device, command, count > 47)
 
 	def eavesdrop(self):
 		packets = self.radio.receive_packets(20)
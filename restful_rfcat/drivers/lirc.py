@@ -1,16 +1,24 @@
 # A device driver to interact with devices with LIRC definitions
+from collections import namedtuple
 from operator import itemgetter
 import itertools
+import json
 import logging
+import os
 import os.path
 import struct
 import re
+import threading
 from restful_rfcat import radio
-from restful_rfcat.drivers._utils import DeviceDriver, SubDeviceDriver, LightMixin, ThreeSpeedFanMixin
+from restful_rfcat.drivers._utils import BitBuffer, DeviceDriver, EavesdropLimiter, PulseTiming, SubDeviceDriver, LightMixin, ThreeSpeedFanMixin, bit_length, solve_symbol_length
 
 logger = logging.getLogger(__name__)
 
-def _parse_lirc_config(config_filename, config_file=None):
+def _parse_lirc_config(config_filename, config_file=None, first_only=False):
+	""" Parse a LIRC config file into nested dicts of strings
+	If first_only is set, stop after the first remote block,
+	such as when the file is already seeked to a remote in the middle
+	"""
 	def parse(config_file):
 		blank_line_matcher = re.compile(r'^\s*(#.*)?$')
 		clean_line_matcher = re.compile(r'^\s*([^#]*)(?:#.*)?$')
@@ -18,17 +26,29 @@ def _parse_lirc_config(config_filename, config_file=None):
 		data = {}
 		parent_contexts = []
 		context = data
+		context_name = None
+		raw_code_name = None
 		for line in config_file:
 			if blank_line_matcher.match(line):
 				continue
 			line = clean_line_matcher.sub(r'\1', line).strip()
 			if line.startswith('begin'):
-				parent_contexts.append(context)
+				parent_contexts.append((context, context_name))
 				context_name = line[6:]
 				context[context_name] = {}
 				context = context[context_name]
 			elif line.startswith('end'):
-				context = parent_contexts.pop()
+				context, context_name = parent_contexts.pop()
+				if first_only and len(parent_contexts) == 0:
+					break
+			elif context_name == 'raw_codes':
+				# each raw code has a name line, followed by lines of timings
+				splits = whitespace_splitter.split(line, 1)
+				if splits[0] == 'name' and len(splits) == 2:
+					raw_code_name = splits[1].strip()
+					context[raw_code_name] = ''
+				elif raw_code_name is not None:
+					context[raw_code_name] = (context[raw_code_name] + ' ' + line).strip()
 			else:
 				splits = whitespace_splitter.split(line, 1)
 				if len(splits) == 2:
@@ -36,9 +56,7 @@ def _parse_lirc_config(config_filename, config_file=None):
 		return data
 
 	if config_file is None:
-		current_dir = os.path.dirname(os.path.realpath(__file__))
-		config_dir = os.path.join(current_dir, '..', '..', 'lirc_remotes')
-		abs_config_filename = os.path.join(config_dir, config_filename)
+		abs_config_filename = os.path.join(LIRC_REMOTES_DIR, config_filename)
 		with open(abs_config_filename, 'r') as config_file:
 			# automatically close this file after parsing
 			return parse(config_file)
@@ -47,6 +65,123 @@ def _parse_lirc_config(config_filename, config_file=None):
 	else:
 		raise ValueError("Must pass a config file to parse")
 
+LIRC_REMOTES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'lirc_remotes')
+
+class LircLibrary(object):
+	""" A directory of LIRC remote configs, such as the LIRC remotes database
+
+	The first lookup walks the directory and indexes where each remote
+	begins in each file, which can hold several remotes
+	If a cache_filename is given, the index is saved there and only
+	files with a changed mtime are scanned again the next time
+	Each remote is only parsed when it is first used
+
+	Remotes can be looked up by the file's path in the directory, which
+	gives the first remote in that file, by the remote's name, or by
+	path:name to pick one remote out of a file
+	"""
+	remote_matcher = re.compile(r'^[ \t]*begin[ \t]+remote\b', re.MULTILINE)
+	name_matcher = re.compile(r'^[ \t]*name[ \t]+(\S+)', re.MULTILINE)
+
+	def __init__(self, directory, cache_filename=None):
+		self.directory = directory
+		self.cache_filename = cache_filename
+		self._index = None
+		self._configs = {}
+		self._lock = threading.Lock()
+
+	def _load_cache(self):
+		if self.cache_filename is None or not os.path.exists(self.cache_filename):
+			return {}
+		try:
+			with open(self.cache_filename, 'r') as cache_file:
+				return json.load(cache_file)
+		except (IOError, ValueError) as e:
+			logger.warning("Could not load LIRC remote index %s: %s" % (self.cache_filename, e))
+			return {}
+
+	def _save_cache(self, files):
+		if self.cache_filename is None:
+			return
+		temp_filename = self.cache_filename + '.tmp'
+		try:
+			with open(temp_filename, 'w') as cache_file:
+				json.dump(files, cache_file)
+			os.rename(temp_filename, self.cache_filename)
+		except (IOError, OSError) as e:
+			logger.warning("Could not save LIRC remote index %s: %s" % (self.cache_filename, e))
+
+	def _index_file(self, filename):
+		""" Returns a list of [name, offset] of the remotes in a file """
+		with open(filename, 'rb') as config_file:
+			contents = config_file.read()
+		remotes = []
+		for match in self.remote_matcher.finditer(contents):
+			name = self.name_matcher.search(contents, match.end())
+			remotes.append([name.group(1) if name else None, match.start()])
+		return remotes
+
+	def _build_index(self):
+		cached = self._load_cache()
+		files = {}
+		for dirpath, dirnames, filenames in os.walk(self.directory):
+			dirnames.sort()
+			for filename in sorted(filenames):
+				abs_filename = os.path.join(dirpath, filename)
+				if self.cache_filename is not None and \
+				   abs_filename.startswith(self.cache_filename):
+					continue
+				path = os.path.relpath(abs_filename, self.directory).replace(os.sep, '/')
+				mtime = os.path.getmtime(abs_filename)
+				if path in cached and cached[path]['mtime'] == mtime:
+					files[path] = cached[path]
+				else:
+					files[path] = {'mtime': mtime, 'remotes': self._index_file(abs_filename)}
+		if files != cached:
+			self._save_cache(files)
+
+		index = {}
+		for path in sorted(files.keys()):
+			remotes = files[path]['remotes']
+			if len(remotes) > 0:
+				index[path] = (path, remotes[0][1])
+			for name, offset in remotes:
+				if name is None:
+					continue
+				index['%s:%s' % (path, name)] = (path, offset)
+				# the first file with this remote name wins
+				index.setdefault(name, (path, offset))
+		return index
+
+	def names(self):
+		""" All of the names that remotes can be looked up by """
+		with self._lock:
+			if self._index is None:
+				self._index = self._build_index()
+			return self._index.keys()
+
+	def get(self, name):
+		""" Returns the understood config of a remote, or raises KeyError """
+		with self._lock:
+			if name not in self._configs:
+				if self._index is None:
+					self._index = self._build_index()
+				location = self._index.get(name)
+				if location is None and os.path.isabs(name) and os.path.isfile(name):
+					location = (name, 0)
+				if location is None:
+					raise KeyError(name)
+				path, offset = location
+				with open(os.path.join(self.directory, path), 'r') as config_file:
+					config_file.seek(offset)
+					parsed = _parse_lirc_config(None, config_file, first_only=True)
+				self._configs[name] = _understand_lirc_config(parsed)
+			# callers can change the top-level settings of their copy
+			return dict(self._configs[name])
+
+# the remotes that come with restful_rfcat
+default_library = LircLibrary(LIRC_REMOTES_DIR)
+
 def _understand_lirc_config(config):
 	# common types
 	decimal_integer = int
@@ -55,6 +190,7 @@ def _understand_lirc_config(config):
 	duple_ints = lambda s: tuple([decimal_integer(i) for i in s.split(' ', 1)])
 	flags = lambda s: [f.strip() for f in s.split('|')]
 	dict_hexadecimal_numbers = lambda c: dict([(k, hexadecimal_number(v)) for k,v in c.items()])
+	dict_integer_lists = lambda c: dict([(k, [decimal_integer(i) for i in v.split()]) for k,v in c.items()])
 	# field definitions
 	parsers = {
 		# taken from http://winlirc.sourceforge.net/technicaldetails.html
@@ -81,10 +217,11 @@ def _understand_lirc_config(config):
 		'repeat_gap': decimal_integer,
 		'min_repeat': decimal_integer,
 		'toggle_bit': decimal_integer,
+		'toggle_bit_mask': hexadecimal_number,
 		'frequency': decimal_integer,
 		'duty_cycle': decimal_integer,
 		'codes': dict_hexadecimal_numbers,
-		'raw_codes': dict_hexadecimal_numbers,
+		'raw_codes': dict_integer_lists,
 	}
 	result = {}
 	for k,v in config['remote'].items():
@@ -94,14 +231,219 @@ def _understand_lirc_config(config):
 			result[k] = v
 	return result
 
+def _symbol_runs(symbols, symbol_length):
+	"""
+	Turn a string of radio symbols into a list of (level, microseconds) runs
+
+	>>> _symbol_runs('1110011', 100)
+	[('1', 300), ('0', 200), ('1', 200)]
+	>>> _symbol_runs('', 100)
+	[]
+	"""
+	return [(run[0], len(run) * symbol_length) for run in re.findall('0+|1+', symbols)]
+
+class LircDecoder(object):
+	""" Matches received radio symbols against every button of a LircRemote
+
+	Each button is encoded once, the same way it would be transmitted,
+	and remembered as a list of (level, microseconds) runs
+	Received packets are then compared run by run against the buttons
+	with the same number of runs, allowing for the remote's eps/aeps
+	timing error, the same as LIRC's own receiver
+	"""
+	def __init__(self, remote):
+		self.eps = remote.config.get('eps', 30)
+		self.aeps = remote.config.get('aeps', 100)
+		self.templates = {}
+		frames = itertools.chain(remote.frames.items(), remote.toggled_frames.items())
+		for command, frame in frames:
+			# the leading and trailing spaces blend into the inter-packet gap
+			symbols = str(frame.frame.strip())
+			runs = _symbol_runs(symbols, remote.baud_divisor)
+			self.templates.setdefault(len(runs), []).append((command, runs))
+
+	def _run_error(self, expected, received, resolution):
+		""" Returns how far off a received run length is
+		    or None if it is outside of the tolerance
+		"""
+		error = abs(expected - received)
+		# the receiver can be off by up to half of one of its symbols
+		if error <= expected * self.eps / 100.0 or \
+		   error <= self.aeps + resolution / 2.0:
+			return error
+		return None
+
+	def decode(self, symbols, symbol_length):
+		""" Returns the name of the button that was pressed, or None
+
+		symbols is a packet of received radio symbols, and symbol_length
+		is how many microseconds each symbol lasted at the receiving baudrate
+		"""
+		if symbols is None:
+			return None
+		runs = _symbol_runs(str(symbols).strip('0'), symbol_length)
+		best_command = None
+		best_error = None
+		for command, template in self.templates.get(len(runs), []):
+			total_error = 0
+			for (level, expected), (received_level, received) in zip(template, runs):
+				error = None
+				if level == received_level:
+					error = self._run_error(expected, received, symbol_length)
+				if error is None:
+					break
+				total_error = total_error + error
+			else:
+				if best_error is None or total_error < best_error:
+					best_command = command
+					best_error = total_error
+		return best_command
+
+class LircConfig(dict):
+	""" The understood settings of a remote
+	Counts every change, so that anything compiled from it can be refreshed
+
+	>>> config = LircConfig(bits=7)
+	>>> config.version
+	0
+	>>> config['pre_data'] = 0x0b
+	>>> config.update(pre_data_bits=4)
+	>>> config.version
+	2
+	"""
+	version = 0
+
+	def _changed(self):
+		self.version = self.version + 1
+
+	def __setitem__(self, key, value):
+		dict.__setitem__(self, key, value)
+		self._changed()
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self._changed()
+
+	def update(self, *args, **kwargs):
+		dict.update(self, *args, **kwargs)
+		self._changed()
+
+	def setdefault(self, key, default=None):
+		self._changed()
+		return dict.setdefault(self, key, default)
+
+	def pop(self, *args):
+		self._changed()
+		return dict.pop(self, *args)
+
+	def clear(self):
+		dict.clear(self)
+		self._changed()
+
+# The encoded transmission of a button
+# frame is sent first, and repeat_frame for any further repeats
+LircFrames = namedtuple('LircFrames', ['frame', 'repeat_frame'])
+
 class LircRemote(object):
-	def __init__(self, config_filename, **kwargs):
+	__slots__ = ('config', 'baud_divisor', 'frames', 'toggled_frames',
+	             '_presses', '_decoder', '_compiled_version', '_toggle_state',
+	             '_fixed_divisor')
+
+	def __init__(self, config_filename, library=None, **kwargs):
 		if config_filename != None:
-			self.config = _understand_lirc_config(_parse_lirc_config(config_filename))
+			library = library or default_library
+			self.config = LircConfig(library.get(config_filename))
 		else:
-			self.config = {}	# specify everything with kwargs
+			self.config = LircConfig()	# specify everything with kwargs
+		baud_divisor = kwargs.pop('baud_divisor', None)
 		self.config.update(kwargs)	# any custom things, like remote-specific predata
-		self.baud_divisor = self.guess_baudrate_divisor(self.config)
+		# otherwise it is solved from the config, each time the config changes
+		self._fixed_divisor = baud_divisor is not None
+		self.baud_divisor = baud_divisor
+		self._decoder = None
+		self._compile()
+
+	def set_baud_divisor(self, baud_divisor):
+		""" Change the microseconds per symbol, such as to share a radio
+		    with other remotes, and encode all the buttons again
+		"""
+		self._fixed_divisor = True
+		if baud_divisor != self.baud_divisor:
+			self.baud_divisor = baud_divisor
+			self._compile()
+
+	# the range of baudrates that the radio can comfortably send
+	MIN_BAUDRATE = 600
+	MAX_BAUDRATE = 250000
+
+	@staticmethod
+	def _timing_weights(config):
+		"""
+		Collect each microsecond time value of a config,
+		along with about how many times it is sent in each press
+
+		>>> sorted(LircRemote._timing_weights({'header': (400, 300), 'zero': (300, 700), 'one': (700, 300), 'bits': 2, 'gap': 12000}).items())
+		[(300, 3.0), (400, 1.0), (700, 2.0), (12000, 1.0)]
+		"""
+		weights = {}
+		def add(time, weight):
+			if time > 0:
+				weights[time] = weights.get(time, 0) + weight
+		data_bits = config.get('bits', 0)
+		if 'pre_data' in config:
+			data_bits = data_bits + config.get('pre_data_bits', 0)
+		if 'post_data' in config:
+			data_bits = data_bits + config.get('post_data_bits', 0)
+		repeats = max(1, config.get('min_repeat', 0))
+		# about half of the data bits are ones, and half are zeros
+		symbol_keys = ['zero', 'one', 'two', 'three']
+		symbol_count = len([k for k in symbol_keys if k in config]) or 1
+		for k in symbol_keys:
+			if k in config:
+				add(config[k][0], 1.0 * data_bits / symbol_count)
+				add(config[k][1], 1.0 * data_bits / symbol_count)
+		for k in ['header', 'foot', 'pre', 'post']:
+			if k in config:
+				add(config[k][0], 1.0)
+				add(config[k][1], 1.0)
+		for k in ['plead', 'ptrail', 'gap']:
+			if k in config:
+				add(config[k], 1.0)
+		if 'repeat' in config:
+			add(config['repeat'][0], repeats)
+			add(config['repeat'][1], repeats)
+		if 'repeat_gap' in config:
+			add(config['repeat_gap'], repeats)
+		raw_codes = config.get('raw_codes', {})
+		for durations in raw_codes.values():
+			for time in durations:
+				add(time, 1.0 / len(raw_codes))
+		return weights
+
+	@classmethod
+	def _pulse_timing(klass, config):
+		symbols = [config[k] for k in ['zero', 'one', 'two', 'three'] if k in config]
+		return PulseTiming(klass._timing_weights(config),
+		                   eps=config.get('eps', 30), aeps=config.get('aeps', 100),
+		                   distinct=symbols)
+
+	@classmethod
+	def solve_baudrate_divisor(klass, configs):
+		"""
+		Given a list of remote configs, with microsecond times entered in
+		Find the longest microseconds per symbol that can send all of them,
+		keeping each time within the remotes' eps/aeps tolerance,
+		while balancing the total frame length against the timing error
+
+		>>> LircRemote.solve_baudrate_divisor([{'zero': (300, 700), 'one': (700, 300), 'gap': 12000}])
+		324
+		>>> LircRemote.solve_baudrate_divisor([{'zero': (190, 380), 'one': (380, 190), 'gap': 6650}])
+		190
+		>>> LircRemote.solve_baudrate_divisor([{'gap': 2000000}])
+		1665
+		"""
+		timings = [klass._pulse_timing(c) for c in configs]
+		return solve_symbol_length(timings, klass.MIN_BAUDRATE, klass.MAX_BAUDRATE)
 
 	@classmethod
 	def guess_baudrate_divisor(klass, config):
@@ -126,6 +468,8 @@ class LircRemote(object):
 		for k in times_keys:
 			if k in config:
 				times.append(config[k])
+		for durations in config.get('raw_codes', {}).values():
+			times.extend(durations)
 		# try finding a common factor among them all
 		total_factor = 1
 		factored = True
@@ -155,44 +499,44 @@ class LircRemote(object):
 		Using this remote's guessed baudrate,
 		turn the millisecond length into a sequence of repeated bits
 
-		>>> LircRemote(config_filename=None, one=(300, 700))._encode_bit('0', 300)
-		'000'
-		>>> LircRemote(config_filename=None, one=(300, 700))._encode_bit('0', 260)
-		'000'
-		>>> LircRemote(config_filename=None, one=(300, 700))._encode_bit('0', 340)
-		'000'
+		>>> LircRemote(config_filename=None, one=(300, 700), baud_divisor=100)._encode_bit('0', 300)
+		BitBuffer('000')
+		>>> LircRemote(config_filename=None, one=(300, 700), baud_divisor=100)._encode_bit('0', 260)
+		BitBuffer('000')
+		>>> LircRemote(config_filename=None, one=(300, 700), baud_divisor=100)._encode_bit('0', 340)
+		BitBuffer('000')
 		"""
 		periods = int(round(length * 1.0 / self.baud_divisor))
-		return bit * periods
+		return BitBuffer().append_run(bit, periods)
 
 	def _encode_tuple(self, time_tuple):
 		"""
 		Given a tuple of (pulse_ms, space_ms)
 		Return the encoded bits
 
-		>>> LircRemote(config_filename=None, one=(300, 700))._encode_tuple((300, 400))
-		'1110000'
+		>>> LircRemote(config_filename=None, one=(300, 700), baud_divisor=100)._encode_tuple((300, 400))
+		BitBuffer('1110000')
 		"""
-		return self._encode_bit('1', time_tuple[0]) + self._encode_bit('0', time_tuple[1])
+		return self._encode_bit('1', time_tuple[0]).extend(self._encode_bit('0', time_tuple[1]))
 
 	def _encode_pwm_bit(self, bit):
 		"""
 		When inside _encode_data, encode a 0 or a 1 by using the
 		configured zero/one lengths
 
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300))._encode_pwm_bit('0')
-		'1110000000'
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300))._encode_pwm_bit('1')
-		'1111111000'
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['SPACE_FIRST'])._encode_pwm_bit('0')
-		'0000000111'
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['SPACE_FIRST'])._encode_pwm_bit('1')
-		'0001111111'
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), baud_divisor=100)._encode_pwm_bit('0')
+		BitBuffer('1110000000')
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), baud_divisor=100)._encode_pwm_bit('1')
+		BitBuffer('1111111000')
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['SPACE_FIRST'], baud_divisor=100)._encode_pwm_bit('0')
+		BitBuffer('0000000111')
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['SPACE_FIRST'], baud_divisor=100)._encode_pwm_bit('1')
+		BitBuffer('0001111111')
 		"""
 		mode = {"0": "zero", "1": "one"}[bit]
 		time_tuple = self.config[mode]
 		if 'SPACE_FIRST' in self.config.get('flags', []):
-			return ''.join(reversed(self._encode_tuple(time_tuple)))
+			return self._encode_tuple(time_tuple).reverse()
 		else:
 			return self._encode_tuple(time_tuple)
 
@@ -206,32 +550,31 @@ class LircRemote(object):
 		If the REVERSE flag is set, then it pre-reverses all the commands as it loads the config
 		This means that the data_len starts counting at the right-most bit and extends to the left
 		
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300))._encode_data(0x0b, 4)
-		'1111111000111000000011111110001111111000'
-		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100))._encode_data(0x0b, 16)
-		'100100100100100100100100100100100100110100110110'
-
-		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['REVERSE'])._encode_data(0x0b, 4)
-		'1111111000111111100011100000001111111000'
-		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), flags=['REVERSE'])._encode_data(0x0b, 16)
-		'110110100110100100100100100100100100100100100100'
-		"""
-		conf_bitstring = bin(data)
-		if conf_bitstring.startswith('0b'):
-			conf_bitstring = conf_bitstring[2:]
-		given_length = len(conf_bitstring)
-		extra_length = max(0, data_len-given_length)
-		bitstring = '0'*extra_length + conf_bitstring
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), baud_divisor=100)._encode_data(0x0b, 4)
+		BitBuffer('1111111000111000000011111110001111111000')
+		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), baud_divisor=100)._encode_data(0x0b, 16)
+		BitBuffer('100100100100100100100100100100100100110100110110')
+
+		>>> LircRemote(config_filename=None, zero=(300, 700), one=(700, 300), flags=['REVERSE'], baud_divisor=100)._encode_data(0x0b, 4)
+		BitBuffer('1111111000111111100011100000001111111000')
+		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), flags=['REVERSE'], baud_divisor=100)._encode_data(0x0b, 16)
+		BitBuffer('110110100110100100100100100100100100100100100100')
+		"""
+		length = max(data_len, bit_length(data))
+		positions = range(length - 1, -1, -1)	# most significant bit first
 		if 'REVERSE' in self.config.get('flags', []):
-			bitstring = reversed(bitstring)
-		encoded_data_bits = (self._encode_pwm_bit(b) for b in bitstring)
-		return ''.join(itertools.chain(*encoded_data_bits))
+			positions = reversed(positions)
+		encoded_bits = (self._encode_pwm_bit('0'), self._encode_pwm_bit('1'))
+		encoded_data = BitBuffer()
+		for position in positions:
+			encoded_data.extend(encoded_bits[(data >> position) & 1])
+		return encoded_data
 
 	def _encode_header(self):
 		"""
 		>>> LircRemote(config_filename=None)._encode_header()
 		>>> LircRemote(config_filename=None, header=(100, 200))._encode_header()
-		'100'
+		BitBuffer('100')
 		"""
 		header = self.config.get('header')
 		if header is not None:
@@ -241,53 +584,53 @@ class LircRemote(object):
 		"""
 		>>> LircRemote(config_filename=None)._encode_lead()
 		>>> LircRemote(config_filename=None, one=(200, 100), plead=100)._encode_lead()
-		'1'
+		BitBuffer('1')
 		"""
 		plead = self.config.get('plead')
 		if plead is not None:
 			return self._encode_bit('1', plead)
 
-	def _encode_pre(self):
+	def _encode_pre(self, mask=0):
 		"""
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100))._encode_pre()
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), pre_data=0x0b, pre_data_bits=4)._encode_pre()
-		'110100110110'
+		BitBuffer('110100110110')
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), pre_data=0x0b, pre_data_bits=4, pre=(300, 200))._encode_pre()
-		'11010011011011100'
+		BitBuffer('11010011011011100')
 
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), pre_data=0x0b, pre_data_bits=4, flags=['REVERSE'])._encode_pre()
-		'110110100110'
+		BitBuffer('110110100110')
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), pre_data=0x0b, pre_data_bits=4, pre=(300, 200), flags=['REVERSE'])._encode_pre()
-		'11011010011011100'
+		BitBuffer('11011010011011100')
 		"""
 		pre_data = self.config.get('pre_data')
 		if pre_data is not None:
-			pre_data = self._encode_data(pre_data, self.config.get('pre_data_bits'))
+			pre_data = self._encode_data(pre_data ^ mask, self.config.get('pre_data_bits'))
 			if self.config.get('pre'):
 				pre_pulse = self._encode_tuple(self.config['pre'])
-				return pre_data + pre_pulse
+				return pre_data.extend(pre_pulse)
 			else:
 				return pre_data
 
-	def _encode_post(self):
+	def _encode_post(self, mask=0):
 		"""
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100))._encode_post()
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), post_data=0x0b, post_data_bits=4)._encode_post()
-		'110100110110'
+		BitBuffer('110100110110')
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), post_data=0x0b, post_data_bits=4, post=(300, 200))._encode_post()
-		'11100110100110110'
+		BitBuffer('11100110100110110')
 
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), post_data=0x0b, post_data_bits=4, flags=['REVERSE'])._encode_post()
-		'110110100110'
+		BitBuffer('110110100110')
 		>>> LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), post_data=0x0b, post_data_bits=4, post=(300, 200), flags=['REVERSE'])._encode_post()
-		'11100110110100110'
+		BitBuffer('11100110110100110')
 		"""
 		post_data = self.config.get('post_data')
 		if post_data is not None:
-			post_data = self._encode_data(post_data, self.config.get('post_data_bits'))
+			post_data = self._encode_data(post_data ^ mask, self.config.get('post_data_bits'))
 			if self.config.get('post'):
 				post_pulse = self._encode_tuple(self.config['post'])
-				return post_pulse + post_data
+				return post_pulse.extend(post_data)
 			else:
 				return post_data
 
@@ -295,7 +638,7 @@ class LircRemote(object):
 		"""
 		>>> LircRemote(config_filename=None)._encode_trail()
 		>>> LircRemote(config_filename=None, one=(200, 100), ptrail=100)._encode_trail()
-		'1'
+		BitBuffer('1')
 		"""
 		ptrail = self.config.get('ptrail')
 		if ptrail is not None:
@@ -305,74 +648,259 @@ class LircRemote(object):
 		"""
 		>>> LircRemote(config_filename=None)._encode_foot()
 		>>> LircRemote(config_filename=None, foot=(100, 200))._encode_foot()
-		'100'
+		BitBuffer('100')
 		"""
 		foot = self.config.get('foot')
 		if foot is not None:
 			return self._encode_tuple(foot)
 
-	def _encode_gap(self):
+	def _encode_gap(self, repeating=False):
 		"""
+		The space after a frame, repeat_gap is used between repeat frames
+
 		>>> LircRemote(config_filename=None)._encode_gap()
-		''
+		BitBuffer('')
 		>>> LircRemote(config_filename=None, foot=(100, 200), repeat_gap=1500)._encode_gap()
-		'000000000000000'
+		BitBuffer('000000000000000')
 		>>> LircRemote(config_filename=None, foot=(100, 200), gap=200)._encode_gap()
-		'00'
+		BitBuffer('00')
 		>>> LircRemote(config_filename=None, foot=(100, 200), gap=200, repeat_gap=1500)._encode_gap()
-		'000000000000000'
+		BitBuffer('00')
+		>>> LircRemote(config_filename=None, foot=(100, 200), gap=200, repeat_gap=1500)._encode_gap(repeating=True)
+		BitBuffer('000000000000000')
 		"""
-		gap_length = self.config.get('repeat_gap',
-		             self.config.get('gap',
-		             0))
+		if repeating:
+			gap_length = self.config.get('repeat_gap', self.config.get('gap', 0))
+		else:
+			gap_length = self.config.get('gap', self.config.get('repeat_gap', 0))
 		return self._encode_bit('0', gap_length)
 
-	def _encode_button(self, command):
+	def _encode_raw(self, durations):
 		"""
-		Yields bitstrings to represent a button press
-		Each yielded string contains a single transmission
-		Fetch the next generated string for the next repeat
-		Depending on the remote settings, it might be different!
+		Raw codes are alternating pulse and space lengths, starting with a pulse
+
+		>>> LircRemote(config_filename=None, one=(200, 100), baud_divisor=100)._encode_raw([300, 200, 100])
+		BitBuffer('111001')
+		"""
+		encoded = BitBuffer()
+		for index, length in enumerate(durations):
+			encoded.extend(self._encode_bit('1' if index % 2 == 0 else '0', length))
+		return encoded
+
+	def _encode_repeat(self):
+		"""
+		The short code that some remotes send while a button is held down
+
+		>>> LircRemote(config_filename=None)._encode_repeat()
+		>>> LircRemote(config_filename=None, repeat=(900, 200), ptrail=100)._encode_repeat()
+		BitBuffer('111111111001')
+		"""
+		repeat = self.config.get('repeat')
+		if repeat is not None:
+			pieces = [self._encode_lead(), self._encode_tuple(repeat), self._encode_trail()]
+			if 'REPEAT_HEADER' in self.config.get('flags', []):
+				pieces.insert(0, self._encode_header())
+			return self._join(pieces)
+
+	def _toggle_mask(self):
+		"""
+		Which bits of the whole pre_data+code+post_data flip on every new press
+		toggle_bit counts from 1 at the first bit of the code
+
+		>>> LircRemote(config_filename=None)._toggle_mask()
+		0
+		>>> LircRemote(config_filename=None, pre_data_bits=4, bits=8, toggle_bit=3)._toggle_mask() == 0b001000000000
+		True
+		>>> LircRemote(config_filename=None, toggle_bit_mask=0x800)._toggle_mask()
+		2048
+		"""
+		if 'toggle_bit_mask' in self.config:
+			return self.config['toggle_bit_mask']
+		toggle_bit = self.config.get('toggle_bit', 0)
+		if toggle_bit > 0:
+			total_bits = self.config.get('pre_data_bits', 0) + \
+			             self.config.get('bits', 0) + \
+			             self.config.get('post_data_bits', 0)
+			return 1 << (total_bits - toggle_bit)
+		return 0
+
+	def _compile(self):
+		"""
+		Encode every button of the remote into a table of LircFrames
+		The pieces surrounding the data are the same for every button,
+		so they are only encoded once
+		Buttons of remotes with a toggle bit are also encoded with the bit flipped
 		Roughly based on https://sourceforge.net/p/lirc/git/ci/master/tree/lib/transmit.c
+		"""
+		if not self._fixed_divisor:
+			self.baud_divisor = self.solve_baudrate_divisor([self.config])
+		self.frames = {}
+		self.toggled_frames = {}
+		self._presses = {}
+		self._decoder = None
+		self._compiled_version = self.config.version
+		codes = self.config.get('codes', {})
+		raw_codes = self.config.get('raw_codes', {})
+		if len(codes) == 0 and len(raw_codes) == 0:
+			return
+		gap = self._encode_gap()
+		repeat_gap = self._encode_gap(repeating=True)
+		repeat_code = self._encode_repeat()
+		if repeat_code is not None:
+			repeat_code.extend(repeat_gap)
+
+		if len(codes) > 0:
+			flags = self.config.get('flags', [])
+			bits = self.config['bits']
+			post_bits = self.config.get('post_data_bits', 0) if 'post_data' in self.config else 0
+			header = self._encode_header()
+			lead = self._encode_lead()
+			trail = self._encode_trail()
+			foot = self._encode_foot()
+			# if flags are in place to not send head/foot when repeating
+			# leave the segments out of the repeat frame
+			repeat_header = None if 'NO_HEAD_REP' in flags else header
+			repeat_foot = None if 'NO_FOOT_REP' in flags else foot
+			toggle_mask = self._toggle_mask()
+			masks = [(self.frames, 0)]
+			if toggle_mask:
+				masks.append((self.toggled_frames, toggle_mask))
+			for table, mask in masks:
+				pre = self._encode_pre(mask >> (bits + post_bits))
+				post = self._encode_post(mask & ((1 << post_bits) - 1))
+				code_mask = (mask >> post_bits) & ((1 << bits) - 1)
+				for command, code in codes.items():
+					data = self._encode_data(code ^ code_mask, bits)
+					frame = self._join([header, lead, pre, data, post, trail, foot, gap])
+					if repeat_code is not None:
+						repeat_frame = repeat_code
+					else:
+						repeat_frame = self._join([repeat_header, lead, pre, data, post, trail, repeat_foot, repeat_gap])
+					table[command] = LircFrames(frame=frame, repeat_frame=repeat_frame)
+
+		for command, durations in raw_codes.items():
+			raw = self._encode_raw(durations)
+			self.frames[command] = LircFrames(
+				frame=self._join([raw, gap]),
+				repeat_frame=repeat_code if repeat_code is not None else self._join([raw, repeat_gap])
+			)
+
+	@staticmethod
+	def _join(pieces):
+		joined = BitBuffer()
+		for piece in pieces:
+			if piece is not None:
+				joined.extend(piece)
+		return joined
+
+	def get_frames(self, command):
+		"""
+		Returns the precompiled LircFrames for a button
+		The table is compiled again if the config has changed since
 
 		>>> remote = LircRemote(config_filename='hampton_bay_UC7078T', gap=500)
-		>>> remote.encode_button('FAN_HIGH')
-		'111100011111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000'
+		>>> remote.get_frames('FAN_HIGH').frame
+		BitBuffer('111100011111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000')
+		>>> remote.config['pre_data'] = 0x00
+		>>> remote.get_frames('FAN_HIGH').frame
+		BitBuffer('111100011111110000000111000000011100000001110000000111000000011100011111110000000111000000011100000001110000000111000000011100000')
+		"""
+		if self._compiled_version != self.config.version:
+			self._compile()
+		return self.frames[command]
+
+	def _encode_button(self, command):
+		"""
+		Yields BitBuffers to represent a button press
+		Each yielded buffer contains a single transmission
+		Fetch the next generated buffer for the next repeat
+		Depending on the remote settings, it might be different!
 
+		>>> remote = LircRemote(config_filename='hampton_bay_UC7078T', gap=500, flags=['SPACE_FIRST', 'REVERSE', 'NO_HEAD_REP'])
+		>>> presses = remote._encode_button('FAN_HIGH')
+		>>> next(presses)
+		BitBuffer('111100011111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000')
+		>>> next(presses)
+		BitBuffer('11111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000')
 		"""
 		max_repeat = 20
-		order = ['header', 'lead', 'pre', 'data', 'post', 'trail', 'foot', 'gap']
-		# if flags are in place to not send head/foot when repeating
-		# clear the segments out
-		if 'NO_HEAD_REP' in self.config['flags']:
-			order.remove('header')
-		if 'NO_FOOT_REP' in self.config['flags']:
-			order.remove('foot')
-		pieces = []
-		for step_name in order:
-			step_func = getattr(self, '_encode_%s' % (step_name,))
-			if step_name == 'data':
-				piece = self._encode_data(self.config['codes'][command], self.config['bits'])
-			else:
-				piece = step_func()
-			if piece is not None:
-				pieces.append(piece)
-		for encoded in itertools.repeat(''.join(pieces), max_repeat):
+		frames = self.get_frames(command)
+		yield frames.frame
+		for encoded in itertools.repeat(frames.repeat_frame, max_repeat - 1):
 			yield encoded
 
 	def encode_button(self, command):
-		""" Like _encode_button, but as a simple string instead of iterator """
-		return next(self._encode_button(command))
+		""" Like _encode_button, but only the first frame
+		    The returned BitBuffer is shared, and should not be changed
+		"""
+		return self.get_frames(command).frame
+
+	def encode_press(self, command, repeats=0):
+		"""
+		The whole transmission of a button press, as a single BitBuffer
+		The first frame is followed by the shorter repeat frames,
+		at least as many as the remote's min_repeat
+		Buttons of remotes with a toggle bit alternate on every press
+
+		>>> remote = LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), bits=2, gap=300, repeat=(400, 100), codes={'A': 0b10})
+		>>> remote.encode_press('A', 2)
+		BitBuffer('1101000001111000011110000')
+		>>> remote = LircRemote(config_filename=None, zero=(100, 200), one=(200, 100), bits=2, gap=300, toggle_bit=1, codes={'A': 0b10})
+		>>> remote.encode_press('A')
+		BitBuffer('110100000')
+		>>> remote.encode_press('A')
+		BitBuffer('100100000')
+		"""
+		frames = self.get_frames(command)
+		toggled = False
+		if command in self.toggled_frames:
+			toggled = getattr(self, '_toggle_state', False)
+			self._toggle_state = not toggled
+			if toggled:
+				frames = self.toggled_frames[command]
+		repeats = max(repeats, self.config.get('min_repeat', 0))
+		key = (command, toggled, repeats)
+		if key not in self._presses:
+			self._presses[key] = frames.frame + frames.repeat_frame.repeat(repeats)
+		return self._presses[key]
+
+	def decode_button(self, symbols, symbol_length):
+		"""
+		Find which button of this remote was pressed to send the given symbols
+		symbol_length is the microseconds per symbol of the receiving radio
+
+		>>> remote = LircRemote(config_filename='hampton_bay_UC7078T')
+		>>> remote.decode_button(remote.encode_button('FAN_HIGH'), remote.baud_divisor)
+		'FAN_HIGH'
+		>>> remote.decode_button('1111000111', remote.baud_divisor)
+		"""
+		if self._compiled_version != self.config.version:
+			self._compile()
+		if self._decoder is None:
+			self._decoder = LircDecoder(self)
+		return self._decoder.decode(symbols, symbol_length)
 
 class Lirc(DeviceDriver):
+	__slots__ = ('remote', 'radio')
+
 	devices = {}
+	# which devices share a radio, by frequency
+	shared_radios = {}
+	# the distinct timings of the remotes sharing each radio, by frequency
+	shared_timings = {}
+	# radio receivers need to hear a few repeats to notice a press
+	MIN_REPEATS = 5
 
-	def __init__(self, config_filename, radio_frequency=None, custom_radio=None, **kwargs):
+	def __init__(self, config_filename, radio_frequency=None, custom_radio=None, shared_radio=False, **kwargs):
 		""" Controls a device as described by an LIRC remote control config
 
 		config_filename is a file relative to lirc_remotes configuration, or absolute path
 		that describes a remote control's protocol
+		library can be a LircLibrary to look up the config_filename in, such as
+		the LIRC remotes database, where it can also be the name of a remote
 		radio_frequency is the hz to send the commands, or a custom_radio can be given
+		shared_radio solves one baudrate for every shared_radio device on the same
+		radio_frequency, so that switching between them doesn't reconfigure the radio
 		Extra options can be passed to override the configuration, such as specifying
 		custom pre_data options for different remote control dip switch settings
 		"""
@@ -380,10 +908,16 @@ class Lirc(DeviceDriver):
 			'name': kwargs.pop('name'),
 			'label': kwargs.pop('label')
 		}
+		macros = kwargs.pop('macros', None)
 		super(Lirc, self).__init__(**parent_kwargs)
 		self.remote = LircRemote(config_filename, **kwargs)
+		# the buttons are only known once the remote is loaded
+		self.macros = macros or {}
+		self._check_macros()
 		baudrate = 1000000 / self.remote.baud_divisor
-		if radio_frequency is not None:
+		if radio_frequency is not None and shared_radio:
+			self._share_radio(radio_frequency)
+		elif radio_frequency is not None:
 			self.radio = radio.OOKRadio(radio_frequency, baudrate)
 		elif custom_radio is not None:
 			self.radio = custom_radio
@@ -391,6 +925,35 @@ class Lirc(DeviceDriver):
 			raise ValueError("LIRC devices require a radio_frequency or custom_radio")
 		self._remember_device()
 
+	def _share_radio(self, radio_frequency):
+		""" Join the other devices sharing a radio on this frequency,
+		    and pick a new baudrate that works for all of their remotes
+		    A remote that can't share the radio raises ValueError without joining
+		"""
+		devices = self.shared_radios.get(radio_frequency, [])
+		timings = self.shared_timings.get(radio_frequency, [])
+		timing = LircRemote._pulse_timing(self.remote.config)
+		if timing.key() in [t.key() for t in timings]:
+			# the same protocol as another remote, which already fits
+			baud_divisor = devices[0].remote.baud_divisor
+		else:
+			# raises ValueError before joining if it doesn't fit with the others
+			timings = timings + [timing]
+			baud_divisor = solve_symbol_length(timings, LircRemote.MIN_BAUDRATE, LircRemote.MAX_BAUDRATE)
+			self.shared_timings[radio_frequency] = timings
+		devices.append(self)
+		self.shared_radios[radio_frequency] = devices
+		if devices[0].remote.baud_divisor != baud_divisor:
+			for device in devices:
+				device.remote.set_baud_divisor(baud_divisor)
+		else:
+			self.remote.set_baud_divisor(baud_divisor)
+		if len(devices) == 1:
+			self.radio = radio.OOKRadio(radio_frequency, 1000000 / baud_divisor)
+		else:
+			self.radio = devices[0].radio
+			self.radio.set_baudrate(1000000 / baud_divisor)
+
 	def _remember_device(self):
 		# magical registration of devices for eavesdropping
 		class_name = self.__class__.__name__
@@ -403,51 +966,40 @@ class Lirc(DeviceDriver):
 		device_name = '%s-%s' % (device_type.lower(), name)
 		return klass.devices.get(device_name)
 
-	@staticmethod
-	def _chunk(iterable, size, fillvalue=None):
-		"""
-		Iterate through a list in multiple chunks
-		Based on https://stackoverflow.com/a/434411
-
-		>>> Lirc._chunk("01234567", 3, "x")
-		['012', '345', '67x']
-		"""
-		args = [iter(iterable)] * size
-		return [''.join(x) for x in itertools.izip_longest(*args, fillvalue=fillvalue)]
-
 	@classmethod
-	def _encode(klass, pwm_str_key):
+	def _encode(klass, pwm_key):
 		"""
-		Convert a bitstring into a byte array for rflib to send
-		#>>> Lirc._encode("01110011")
-		#'s'
-		>>> Lirc._encode("00000001001001011011001001011011")
+		Convert a BitBuffer into a byte array for rflib to send
+		>>> Lirc._encode(BitBuffer.from_string("01110011"))
+		's'
+		>>> Lirc._encode(BitBuffer.from_string("00000001001001011011001001011011"))
 		'\\x01%\\xb2['
-		>>> Lirc._encode("000111000110100001110011")
+		>>> Lirc._encode(BitBuffer.from_string("000111000110100001110011"))
 		'\\x1chs'
 		"""
-		#print("Encoding pwm key %s" % (pwm_str_key,))
-		dec_pwm_key = int(pwm_str_key, 2)
-		#print "Decimal (PWN) key:",dec_pwm_key
-		key_packed = ''
-		for byte in Lirc._chunk(pwm_str_key, 8, '0'):
-			dec_pwm_key = int(byte, 2)
-			key_packed = key_packed + struct.pack(">B", dec_pwm_key)
-		return key_packed
+		return pwm_key.tobytes()
 
 	def _send(self, bits):
+		# the repeats are already part of the transmission
 		symbols = self._encode(bits)
-		self.radio.send(symbols, repeat=5)
+		# the remote solves a new baudrate if its config has changed
+		baudrate = 1000000 / self.remote.baud_divisor
+		if self.radio.baudrate != baudrate:
+			self.radio.set_baudrate(baudrate)
+		self.radio.send(symbols, repeat=0)
 
 	def _send_command(self, command):
 		logger.info("Sending command %s with LIRC remote %s" % (command,self.name))
-		bitstring = self._get_bin_key(command)
+		bitstring = self.remote.encode_press(command, self.MIN_REPEATS)
 		self._send(bitstring)
 
+	def _press_symbols(self, command):
+		return self.remote.encode_press(command, self.MIN_REPEATS)
+
 	def _get_bin_key(self, command):
 		"""
 		>>> Lirc(name='test', label='Test', config_filename='hampton_bay_UC7078T', radio_frequency=303000000, gap=500)._get_bin_key('FAN_HIGH')
-		'111100011111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000'
+		BitBuffer('111100011111110001111111000111111100000001110001111111000000011100011111110000000111000000011100000001110000000111000000011100000')
 
 		Based on the code in https://sourceforge.net/p/lirc/git/ci/master/tree/lib/transmit.c
 		"""
@@ -464,17 +1016,39 @@ class Lirc(DeviceDriver):
 		return self._get()
 
 	def _get_available_commands(self):
-		return self.remote.config['codes'].keys()
+		return self.remote.frames.keys()
+
+	def _has_command(self, command):
+		return command in self.remote.frames
+
+	def _button_to_state(self, command):	# pragma: no cover
+		""" Translate an overheard remote button into a new device state """
+		return None
+
+	def _handle_button(self, command, source='eavesdrop'):
+		""" Handle a button press that was eavesdropped from a physical remote """
+		state = self._button_to_state(command)
+		if state is not None:
+			logger.info("Button %s turned %s to %s" % (command, self.name, state))
+			if hasattr(self, '_handle_state_update'):
+				self._handle_state_update(state, source)
+			else:
+				self._set(state, source=source)
+
+	def _pressed(self, command):
+		self._handle_button(command, source='command')
 
 
 class LircLight(LightMixin, Lirc):
+	__slots__ = ()
+
 	def _send_command(self, command):
 		# LightMixin will send a command of ON/OFF
 		# Try to find the lirc command to handle it
 		commands = self._get_available_commands()
 		code = None
 
-		code_name = 'LIGHT_%s' % (state.upper(),)  # look for LIGHT_ON or LIGHT_OFF
+		code_name = 'LIGHT_%s' % (command.upper(),)  # look for LIGHT_ON or LIGHT_OFF
 		if code_name in commands:
 			code = code_name
 
@@ -488,7 +1062,27 @@ class LircLight(LightMixin, Lirc):
 			raise ValueError("Could not determine remote control command for logical command %s" % (command,))
 		super(LircLight, self)._send_command(code)
 
+	def _button_to_state(self, command):
+		if command in ('LIGHT_ON', 'LIGHT_OFF'):
+			return command[len('LIGHT_'):]
+		if command.endswith('_TOGGLE'):
+			# toggle light
+			old_state = self._get()
+			available_states = self.get_available_states()
+			try:
+				old_state_index = available_states.index(old_state)
+			except ValueError:
+				# don't know current state, don't guess new state
+				return None
+			return available_states[len(available_states) - 1 - old_state_index]
+		return None
+
 class LircThreeWayFan(ThreeSpeedFanMixin, Lirc):
+	__slots__ = ()
+
+	# each speed has its own button, unlike lights that may only have a toggle
+	RESEND_INTERVAL = 600
+
 	COMMAND_NAMES = {
 		'0': 'FAN_OFF',
 		'1': 'FAN_LOW',
@@ -500,3 +1094,90 @@ class LircThreeWayFan(ThreeSpeedFanMixin, Lirc):
 		# ThreeSpeedFanMixin will send a command of 0,1,2,3
 		# Change this to LIRC command names
 		super(LircThreeWayFan, self)._send_command(self.COMMAND_NAMES[command])
+
+	def _button_to_state(self, command):
+		for state, name in self.COMMAND_NAMES.items():
+			if name == command:
+				return state
+		return None
+
+class LircEavesdropper(object):
+	""" Listens for physical LIRC remotes on a frequency
+
+	Every Lirc device that transmits on the same radio_frequency
+	gets a chance to decode each received packet, and the matching
+	device is updated with the button that was pressed
+	"""
+	def __init__(self, radio_frequency, baudrate=None, bandwidth=250000, limiter=None):
+		self.radio_frequency = radio_frequency
+		self.baudrate = baudrate
+		self.bandwidth = bandwidth
+		self.radio = None
+		self.limiter = limiter if limiter is not None else EavesdropLimiter()
+		# which (device, button) were seen during the current transmission
+		self.packets_seen = {}
+		# how long ago we saw a packet
+		self.packet_last_seen = 9
+
+	def _get_devices(self):
+		return [d for d in Lirc.devices.values()
+		        if getattr(d.radio, 'frequency', None) == self.radio_frequency]
+
+	def _prepare_radio(self):
+		""" Pick a receiving baudrate fine enough for every remote on this frequency
+		    and a packet gap shorter than any of their repeat gaps
+		"""
+		devices = self._get_devices()
+		baudrate = self.baudrate
+		if baudrate is None:
+			divisors = [d.remote.baud_divisor for d in devices]
+			baudrate = 1000000 / min(divisors) if divisors else 5000
+		self.symbol_length = 1000000.0 / baudrate
+		gaps = [d.remote.config.get('gap') for d in devices if d.remote.config.get('gap')]
+		self.packet_gap = max(20, int(min(gaps) / 2 / self.symbol_length)) if gaps else 20
+		self.radio = radio.OOKRadio(self.radio_frequency, baudrate, self.bandwidth)
+
+	def _decode_packet(self, packet):
+		""" Returns the (device, button) that sent this packet, or None """
+		for device in self._get_devices():
+			command = device.remote.decode_button(packet, self.symbol_length)
+			if command is not None:
+				return (device, command)
+		return None
+
+	def eavesdrop(self):
+		if self.radio is None:
+			self._prepare_radio()
+		packets = self.radio.receive_packets(self.packet_gap)
+		if packets is None:
+			# error, try again next time
+			return None
+		self.packet_last_seen = min(9, self.packet_last_seen + 1)
+		for p in packets:
+			found = self._decode_packet(p)
+			if found is None:
+				continue
+			count = self.packets_seen.get(found, 0)
+			self.packets_seen[found] = count + 1
+			self.packet_last_seen = 0
+
+		if self.packet_last_seen > 3:
+			if len(self.packets_seen) > 0:
+				# end of an existing transmission
+				(device, command), count = max(self.packets_seen.items(), key=itemgetter(1))
+				logger.info("Overheard command %s to %s, %s times" % (command, device.name, count))
+				toggle = command.endswith('_TOGGLE')
+				if self.limiter.allow(device._state_path(), command, toggle):
+					# don't hold up receiving while the device is busy
+					device.mailbox.send(device._handle_button, command)
+				self.packets_seen.clear()
+
+	def run(self):
+		self.request_stop = threading.Event()
+		while not self.request_stop.is_set():
+			self.eavesdrop()
+		if self.radio is not None:
+			self.radio.reset_device()
+
+	def stop(self):
+		self.request_stop.set()
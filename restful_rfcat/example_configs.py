@@ -9,10 +9,6 @@ except:
 
 from restful_rfcat import config, mqtt, persistence
 
-# used for testing
-from restful_rfcat.drivers import FakeFan, FakeLight
-import mock
-
 def _inclusive_devices():
 	for d in config.DEVICES:
 		yield d
@@ -38,13 +34,15 @@ def get_curl(http_host):
 
 def _openhab_item(d):
 	"""
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> print(_openhab_item(FakeFan(name="fake", label="Fake")))
 	Dimmer rfcat_fans_fake "Fake" <fan_ceiling> [Switchable]
 	>>> print(_openhab_item(FakeLight(name="fake", label="Fake")))
 	Switch rfcat_lights_fake "Fake" <light> [Lighting]
 
-	>>> weird = FakeLight(name="fake", label="Fake")
-	>>> weird.CLASS = "custom"
+	>>> class WeirdLight(FakeLight):
+	...     CLASS = "custom"
+	>>> weird = WeirdLight(name="fake", label="Fake")
 	>>> print(_openhab_item(weird))
 	Switch rfcat_custom_fake "Fake"
 	"""
@@ -56,6 +54,7 @@ def _openhab_item(d):
 
 def _openhab_http_get(http_host, d):
 	"""
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> print(_openhab_http_get("localhost:3350", FakeFan(name="fake", label="Fake")))
 	<[http://localhost:3350/fans/fake/command:300:REGEX((.*))]
 	>>> print(_openhab_http_get("localhost:3350", FakeLight(name="fake", label="Fake")))
@@ -70,6 +69,7 @@ def _openhab_http_get(http_host, d):
 
 def _openhab_http_post(http_host, d):
 	"""
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> print(_openhab_http_post("localhost:3350", FakeFan(name="fake", label="Fake")))
 	>[0:POST:http://localhost:3350/fans/fake/command:0] >[1:POST:http://localhost:3350/fans/fake/command:1] >[2:POST:http://localhost:3350/fans/fake/command:2] >[3:POST:http://localhost:3350/fans/fake/command:3]
 	>>> print(_openhab_http_post("localhost:3350", FakeLight(name="fake", label="Fake")))
@@ -88,6 +88,7 @@ def _openhab_http_post(http_host, d):
 
 def get_openhab_poll(http_host):
 	"""
+	>>> from restful_rfcat.drivers import FakeLight
 	>>> config.DEVICES = [FakeLight(name="fake", label="Fake")]
 	>>> print(get_openhab_poll('localhost:3350')['HTTP Polling'])
 	Switch rfcat_lights_fake "Fake" <light> [Lighting] { http="<[http://localhost:3350/lights/fake:300:REGEX((.*))] >[OFF:POST:http://localhost:3350/lights/fake:OFF] >[ON:POST:http://localhost:3350/lights/fake:ON]" }
@@ -104,6 +105,8 @@ def get_openhab_poll(http_host):
 
 def _openhab_mqtt_get(mqtt, d):
 	"""
+	>>> import mock
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> mqtt = mock.Mock()
 	>>> mqtt._set_topic = lambda x: x
 	>>> print(_openhab_mqtt_get(mqtt, FakeFan(name="fake", label="Fake")))
@@ -117,6 +120,8 @@ def _openhab_mqtt_get(mqtt, d):
 
 def _openhab_mqtt_post(mqtt_commanding, d):
 	"""
+	>>> import mock
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> mqtt = mock.Mock()
 	>>> mqtt.prefix = "command"
 	>>> print(_openhab_mqtt_post(mqtt, FakeFan(name="fake", label="Fake")))
@@ -141,6 +146,8 @@ def _openhab_mqtt_post(mqtt_commanding, d):
 
 def get_openhab_mqtt(http_host, mqtt):
 	"""
+	>>> import mock
+	>>> from restful_rfcat.drivers import FakeLight
 	>>> mqtt = mock.Mock()
 	>>> mqtt._set_topic = lambda x: x
 	>>> config.DEVICES = [FakeLight(name="fake", label="Fake")]
@@ -159,6 +166,8 @@ def get_openhab_mqtt(http_host, mqtt):
 
 def get_openhab_mqtt_commanding(mqtt, mqtt_commanding):
 	"""
+	>>> import mock
+	>>> from restful_rfcat.drivers import FakeLight
 	>>> mqtt = mock.Mock()
 	>>> mqtt._set_topic = lambda x: x
 	>>> mqtt_commanding = mock.Mock()
@@ -179,6 +188,7 @@ def get_openhab_mqtt_commanding(mqtt, mqtt_commanding):
 
 def get_hass_http_switches(http_host):
 	"""
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> config.DEVICES = [FakeLight(name="fake", label="Fake Light"), FakeFan(name="fake", label="Fake Fan")]
 	>>> print(get_hass_http_switches("localhost:3350"))['Restful Switches']
 	switch:
@@ -199,6 +209,8 @@ def get_hass_http_switches(http_host):
 
 def get_hass(hass):
 	"""
+	>>> import mock
+	>>> from restful_rfcat.drivers import FakeFan, FakeLight
 	>>> config.DEVICES = [FakeLight(name="fake", label="Fake"), FakeFan(name="fake", label="Fake")]
 	>>> from restful_rfcat.persistence import MQTTHomeAssistant
 	>>> print(get_hass(MQTTHomeAssistant(_publish=mock.Mock())))['MQTT PubSub']  # doctest: +SKIP
@@ -4,14 +4,14 @@ import threading
 import traceback
 import restful_rfcat.config
 import restful_rfcat.drivers
+import restful_rfcat.persistence
 import restful_rfcat.radio
+import restful_rfcat.state
 import restful_rfcat.web
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
-import raven
-
 threads = []
 
 def check_preconditions():
@@ -32,16 +32,20 @@ def check_preconditions():
 	return True
 
 def thread_logger(target):
-	""" Automatically adds a raven client to a thread """
-	client = raven.Client(restful_rfcat.config.SENTRY_DSN)
-	threading.local().raven_client = client
+	""" Automatically adds a raven client to a thread, if Sentry is configured """
+	client = None
+	if restful_rfcat.config.SENTRY_DSN is not None:
+		import raven
+		client = raven.Client(restful_rfcat.config.SENTRY_DSN)
+		threading.local().raven_client = client
 	running = True
 	while running:
 		try:
 			target()
 			running = False
 		except:
-			client.captureException()
+			if client is not None:
+				client.captureException()
 			traceback.print_exc()
 
 def shutdown(*args):
@@ -51,11 +55,16 @@ def shutdown(*args):
 			thread_info['runnable'].stop()
 	for thread_info in threads:
 		thread_info['thread'].join(1)
+	# save any states that are still waiting to be written
+	restful_rfcat.persistence.flush(timeout=5)
 	sys.exit()
 
 if __name__ == '__main__':
 	if check_preconditions():
 		signal.signal(signal.SIGINT, shutdown)
+		# connect the persistence backends in the background
+		# and load the last known states from them
+		restful_rfcat.state.start(restful_rfcat.config.DEVICES)
 		for runnable_object in restful_rfcat.config.THREADS:
 			runner = runnable_object.run
 			thread = threading.Thread(target=thread_logger, args=(runner,))
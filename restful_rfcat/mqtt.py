@@ -1,8 +1,5 @@
 """ This module implements commanding over MQTT """
 
-import paho.mqtt as mqtt
-import paho.mqtt.client
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -16,7 +13,8 @@ class MQTTCommanding(object):
 		self.port = port
 		self.prefix = prefix
 
-		self.client = mqtt.client.Client()
+		import paho.mqtt.client
+		self.client = paho.mqtt.client.Client()
 		self.client.on_message = self._on_message
 		if username is not None:
 			self.client.username_pw_set(username, password)
@@ -25,7 +23,8 @@ class MQTTCommanding(object):
 
 	def _on_connect(self, client, userdata, flags, rc):
 		if rc != 0:
-			raise mqtt.MQTTException(mqtt.client.connack_string(rc))
+			import paho.mqtt.client
+			raise paho.mqtt.MQTTException(paho.mqtt.client.connack_string(rc))
 
 	def _find_device(self, path):
 		from restful_rfcat.web import device_list
@@ -43,7 +42,7 @@ class MQTTCommanding(object):
 		if device is not None:
 			try:
 				logger.info("Setting state for %s to %s" % (path, state))
-				device.set_state(state)
+				device.mailbox.call(device.set_state, state)
 			except ValueError:
 				logger.warning("Invalid state for %s: %s" % (path, state))
 		else:
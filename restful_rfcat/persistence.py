@@ -1,7 +1,9 @@
 import json
 import logging
-import mock
+import os
 import os.path
+import threading
+import time
 
 try:
 	import collections
@@ -11,28 +13,327 @@ except:
 
 logger = logging.getLogger(__name__)
 
+# Backends that need to connect to something do so in a start() method,
+# instead of while the config is loading, and BackendStartup calls them
+# Writes to each backend are queued in a WriteQueue and made in the
+# background, unless the backend sets write_behind = False
+
 class HideyHole(object):
-	""" A simple object that stores state in individual files in a directory """
-	def __init__(self, basepath):
+	""" A simple object that stores state in individual files in a directory
+
+	The files are cached in memory, and checked for changes made by
+	something else, such as a person editing them
+	Until start() is called, each read checks the file's modification time
+	Once started, the directory is watched with inotify, if pyinotify
+	is installed, or else scanned every poll_interval seconds,
+	and reads come straight from the cache
+	Any changes that are noticed are passed on to the state store
+	"""
+	# local files are quick enough to write directly
+	write_behind = False
+
+	def __init__(self, basepath, poll_interval=2.0):
 		self.basepath = basepath
+		self.poll_interval = poll_interval
+		self.lock = threading.Lock()
+		# the (modification time, size) and contents of each file, by key
+		self.cache = {}
+		self.watching = False
+		self.request_stop = threading.Event()
 
 	def _key_path(self, key):
 		safe_name = key.replace('/', u'\uff0f')
 		return os.path.join(self.basepath, safe_name)
 
+	@staticmethod
+	def _file_key(filename):
+		""" The key saved in a file, or None if it isn't a saved state
+
+		>>> HideyHole._file_key(u'fans\\uff0ftest'.encode('utf-8'))
+		'fans/test'
+		>>> HideyHole._file_key('README') is None
+		True
+		"""
+		try:
+			name = filename.decode('utf-8')
+		except UnicodeError:
+			return None
+		if u'\uff0f' not in name:
+			return None
+		return name.replace(u'\uff0f', u'/').encode('utf-8')
+
+	def _stat(self, key):
+		try:
+			stat = os.stat(self._key_path(key))
+			return (stat.st_mtime, stat.st_size)
+		except OSError:
+			return None
+
+	def _read(self, key):
+		""" Load a file into the cache, returning whether it changed """
+		signature = self._stat(key)
+		with self.lock:
+			cached = self.cache.get(key)
+			if cached is not None and cached[0] == signature:
+				return False
+		value = None
+		if signature is not None:
+			try:
+				with open(self._key_path(key), 'r') as handle:
+					value = handle.read()
+			except IOError:
+				signature = None
+		with self.lock:
+			self.cache[key] = (signature, value)
+		if cached is None:
+			# only new files that appear while watching are changes,
+			# rather than files that are being loaded for the first time
+			return self.watching and value is not None
+		return cached[1] != value
+
 	def set(self, key, value):
 		try:
-			with open(self._key_path(key), 'w') as handle:
-				handle.write(value)
+			with self.lock:
+				with open(self._key_path(key), 'w') as handle:
+					handle.write(value)
+				self.cache[key] = (self._stat(key), value)
 		except Exception as e:
 			logger.warning("Failure to persist to HideyHole: %s" % (e.message,))
 
 	def get(self, key, default=None):
-		try:
-			with open(self._key_path(key), 'r') as handle:
-				return handle.read()
-		except:
+		if not self.watching:
+			self._read(key)
+		elif key not in self.cache:
 			return default
+		value = self.cache[key][1]
+		return default if value is None else value
+
+	def _changed(self, key):
+		if self._read(key):
+			value = self.cache[key][1]
+			cache.put(key, value)
+			logger.info("Noticed %s changed to %s in HideyHole" % (key, value))
+			# deferred import to sidestep circular import
+			from restful_rfcat.state import store
+			store.changed_elsewhere(key, value)
+
+	def _scan(self):
+		""" Check every file in the directory for changes """
+		# this module's set() hides the builtin, so use a dict's keys
+		keys = dict.fromkeys(self.cache.keys())
+		for filename in os.listdir(self.basepath):
+			key = self._file_key(filename)
+			if key is not None:
+				keys[key] = None
+		for key in keys:
+			self._changed(key)
+
+	def _poll(self):
+		while True:
+			# Event.wait() only says whether it was set from python 2.7
+			self.request_stop.wait(self.poll_interval)
+			if self.request_stop.is_set():
+				return
+			try:
+				self._scan()
+			except Exception as e:
+				logger.warning("Failure to scan HideyHole: %s" % (e,))
+
+	def _watch_inotify(self, pyinotify):
+		hidey_hole = self
+		class Handler(pyinotify.ProcessEvent):
+			def process_default(self, event):
+				key = hidey_hole._file_key(event.name)
+				if key is not None:
+					hidey_hole._changed(key)
+		manager = pyinotify.WatchManager()
+		mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+		manager.add_watch(self.basepath, mask)
+		notifier = pyinotify.Notifier(manager, Handler(), timeout=1000)
+		notifier.loop(callback=lambda notifier: self.request_stop.is_set())
+
+	def start(self):
+		""" Load the whole directory, and then watch it for changes """
+		self._scan()
+		self.watching = True
+		try:
+			import pyinotify
+			target, args = self._watch_inotify, (pyinotify,)
+		except ImportError:
+			target, args = self._poll, ()
+		thread = threading.Thread(target=target, args=args, name='hideyhole-watcher')
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		self.request_stop.set()
+
+class Journal(object):
+	""" Stores state in a single append-only log file, kept in memory
+
+	Each change is appended to the log as a JSON [key, value] line
+	Changes within commit_window seconds of each other are written together,
+	and the log is synced to disk at most every fsync_interval seconds,
+	or after every write if it is 0, or never if it is None
+	Writes that are too soon to sync are synced once the interval is up,
+	or by sync(), such as when shutting down
+	Once the log has compact_after lines, the current states are saved
+	as a snapshot and the log starts over
+	At startup, the snapshot is loaded and the log is replayed on top of it
+
+	>>> import tempfile
+	>>> journal = Journal(tempfile.mkdtemp(), commit_window=0)
+	>>> journal.set('fans/test', 'ON')
+	>>> Journal(journal.basepath).get('fans/test')
+	'ON'
+	"""
+	SNAPSHOT = 'restful_rfcat.snapshot'
+	LOG = 'restful_rfcat.journal'
+	# writes only go to memory, and are already batched up by the commit timer
+	write_behind = False
+
+	def __init__(self, basepath, commit_window=0.05, fsync_interval=5.0, compact_after=1000, _timer=threading.Timer, _time=time.time):
+		self.basepath = basepath
+		self.commit_window = commit_window
+		self.fsync_interval = fsync_interval
+		self.compact_after = compact_after
+		self._timer = _timer
+		self._time = _time
+		self.lock = threading.Lock()
+		self.values = None	# loaded when first used
+		self.pending = []
+		self.timer = None
+		self.sync_timer = None
+		self.log = None
+		self.log_lines = 0
+		self.last_fsync = 0
+		self.unsynced = False	# whether the log has writes that aren't on disk yet
+
+	def _path(self, name):
+		return os.path.join(self.basepath, name)
+
+	@staticmethod
+	def _encode(value):
+		# json loads unicode, but states are saved as strings
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		return value
+
+	def _load(self):
+		""" Read the snapshot and replay the log, while holding the lock """
+		values = {}
+		try:
+			with open(self._path(self.SNAPSHOT), 'r') as handle:
+				for key, value in json.load(handle).items():
+					values[self._encode(key)] = self._encode(value)
+		except (IOError, ValueError):
+			pass
+		self.log_lines = 0
+		try:
+			with open(self._path(self.LOG), 'r+') as handle:
+				complete = 0	# the length of the log's whole lines
+				for line in iter(handle.readline, ''):
+					if not line.endswith('\n'):
+						# a write that was cut off, such as by a power failure
+						break
+					complete = complete + len(line)
+					try:
+						key, value = json.loads(line)
+					except ValueError:
+						continue
+					values[self._encode(key)] = self._encode(value)
+					self.log_lines = self.log_lines + 1
+				if handle.tell() > complete:
+					# otherwise the next write would be joined onto it
+					logger.warning("Removing a partial write from the end of the Journal")
+					handle.truncate(complete)
+		except IOError:
+			pass
+		self.values = values
+
+	def _loaded(self):
+		if self.values is None:
+			with self.lock:
+				if self.values is None:
+					self._load()
+		return self.values
+
+	def get(self, key, default=None):
+		return self._loaded().get(key, default)
+
+	def set(self, key, value):
+		self._loaded()
+		with self.lock:
+			self.values[key] = value
+			self.pending.append(json.dumps([key, value]) + '\n')
+			if self.commit_window and self._timer is not None:
+				if self.timer is None:
+					self.timer = self._timer(self.commit_window, self.flush)
+					self.timer.daemon = True
+					self.timer.start()
+				return
+		self.flush()
+
+	def flush(self, sync=False):
+		""" Write out any waiting changes now,
+		    and sync them to disk if sync is given or the interval is up
+		"""
+		with self.lock:
+			self.timer = None
+			try:
+				if self.pending:
+					lines, self.pending = self.pending, []
+					if self.log is None:
+						self.log = open(self._path(self.LOG), 'a')
+					self.log.write(''.join(lines))
+					self.log.flush()
+					self.log_lines = self.log_lines + len(lines)
+					self.unsynced = True
+				if self.unsynced and self.fsync_interval is not None:
+					self._sync(sync)
+				if self.log_lines >= self.compact_after:
+					self._compact()
+			except Exception as e:
+				logger.warning("Failure to persist to Journal: %s" % (e,))
+
+	def sync(self):
+		""" Write out any waiting changes and sync them to disk now """
+		self.flush(sync=True)
+
+	def _sync(self, now_anyway):
+		""" Sync the log if it is time to, or else make sure that a timer
+		    will sync it when it is, while holding the lock
+		"""
+		now = self._time()
+		due = self.last_fsync + self.fsync_interval
+		if now_anyway or now >= due:
+			os.fsync(self.log.fileno())
+			self.last_fsync = now
+			self.unsynced = False
+			if self.sync_timer is not None:
+				self.sync_timer.cancel()
+				self.sync_timer = None
+		elif self.sync_timer is None and self._timer is not None:
+			self.sync_timer = self._timer(due - now, self._sync_later)
+			self.sync_timer.daemon = True
+			self.sync_timer.start()
+
+	def _sync_later(self):
+		with self.lock:
+			self.sync_timer = None
+		self.sync()
+
+	def _compact(self):
+		""" Save every state as a new snapshot, and start an empty log """
+		snapshot_path = self._path(self.SNAPSHOT)
+		with open(snapshot_path + '.tmp', 'w') as handle:
+			json.dump(self.values, handle)
+			handle.flush()
+			os.fsync(handle.fileno())
+		os.rename(snapshot_path + '.tmp', snapshot_path)
+		self.log.close()
+		self.log = open(self._path(self.LOG), 'w')
+		self.log_lines = 0
 
 class MQTT(object):
 	""" Publishes state changes over MQTT
@@ -51,13 +352,15 @@ class MQTT(object):
 		if username is not None:
 			self.auth = {'username': username, 'password': password}
 		self.tls = tls
-		# test mqtt connectivity
 		if _publish is None:
 			import paho.mqtt.publish as publish
 			self._publish = publish
 		else:
 			# mock object
 			self._publish = _publish
+
+	def start(self):
+		# test mqtt connectivity
 		self._test_connect()
 
 	def _publish_multiple(self, msgs):
@@ -76,11 +379,15 @@ class MQTT(object):
 	def _test_connect(self):
 		self._publish_single('restful_rfcat', payload=None)
 
+	# only publishes, so get() never has anything
+	stores_values = False
+
 	def get(self, key, default=None):
 		return default
 
 	def _set_topic(self, key):
 		"""
+		>>> import mock
 		>>> print(MQTT(_publish=mock.Mock())._set_topic('fans/fake'))
 		fans/fake
 		>>> print(MQTT(prefix="test", _publish=mock.Mock())._set_topic('fans/fake'))
@@ -108,8 +415,12 @@ class MQTTHomeAssistant(MQTT):
 	def __init__(self, hostname="localhost", port=1883, username=None, password=None, tls=None, retain=True, discovery_prefix="homeassistant", discovery_devices=[], _publish=None):
 		super(MQTTHomeAssistant, self).__init__(hostname=hostname, port=port, retain=retain, username=username, password=password, tls=tls, _publish=_publish)
 		self.discovery_prefix = discovery_prefix
-		if len(discovery_devices) > 0:
-			self.initial_announcement(discovery_prefix, discovery_devices)
+		self.discovery_devices = discovery_devices
+
+	def start(self):
+		super(MQTTHomeAssistant, self).start()
+		if len(self.discovery_devices) > 0:
+			self.initial_announcement(self.discovery_prefix, self.discovery_devices)
 
 	def _device_config(self, device):
 		klass = device.get_class()
@@ -212,11 +523,16 @@ class MQTTStateful(object):
 
 		self.states = {}
 
+	def start(self):
 		self.run()
 
+	# loads states back from the retained topics, unlike MQTT
+	stores_values = True
+
 	# helper functions
 	def _set_topic(self, key):
 		"""
+		>>> import mock
 		>>> print(MQTTStateful(_client=mock.Mock())._set_topic('fans/fake'))
 		fans/fake
 		>>> print(MQTTStateful(prefix="test", _client=mock.Mock())._set_topic('fans/fake'))
@@ -230,6 +546,7 @@ class MQTTStateful(object):
 	def _subscription_topics(self):
 		"""
 		Returns a list of topics for this stateful mqtt client
+		>>> import mock
 		>>> MQTTStateful(_client=mock.Mock())._subscription_topics()
 		['+/+', '+/+/+']
 		>>> MQTTStateful(prefix="test", _client=mock.Mock())._subscription_topics()
@@ -259,11 +576,31 @@ class MQTTStateful(object):
 		if rc != 0:
 			raise mqtt.MQTTException(mqtt.client.connack_string(rc))
 
+	def _topic_key(self, topic):
+		""" The state path of the known device that is saved to this topic """
+		# deferred import to sidestep circular import
+		from restful_rfcat.state import store
+		for key in list(store.devices.keys()):
+			if self._set_topic(key) == topic:
+				return key
+		return None
+
 	def _on_message(self, mqttc, obj, msg):
 		topic = msg.topic
 		data = msg.payload
 		logger.info("Incoming MQTT broadcast: %s %s" % (msg.topic, msg.payload))
+		previous = self.states.get(topic)
 		self.states[topic] = data
+		if data == previous:
+			# such as our own change coming back
+			return
+		# such as a retained state arriving after startup
+		key = self._topic_key(topic)
+		if key is not None:
+			# deferred import to sidestep circular import
+			from restful_rfcat.state import store
+			cache.put(key, data)
+			store.changed_elsewhere(key, data, source='mqtt')
 
 	# connect to the broker
 	def run(self):
@@ -282,6 +619,7 @@ class MQTTStateful(object):
 
 	def set(self, key, value):
 		topic = self._set_topic(key)
+		self.states[topic] = value
 		self._publish_single(topic, value)
 
 class MQTTStatefulHomeAssistant(MQTTStateful, MQTTHomeAssistant):
@@ -309,6 +647,7 @@ class MQTTStatefulHomeAssistant(MQTTStateful, MQTTHomeAssistant):
 	def _subscription_topics(self):
 		"""
 		Returns a list of topics for this stateful mqtt client
+		>>> import mock
 		>>> MQTTStatefulHomeAssistant(_client=mock.Mock())._subscription_topics()
 		['homeassistant/+/+/state']
 		>>> MQTTStatefulHomeAssistant(discovery_prefix="test", _client=mock.Mock())._subscription_topics()
@@ -341,6 +680,10 @@ class Redis(object):
 			return self.prefix + '/' + key
 		return key
 
+	@property
+	def stores_values(self):
+		return self.db is not None
+
 	def get(self, key, default=None):
 		if self.db is not None:
 			found = None
@@ -364,19 +707,402 @@ class Redis(object):
 			except Exception as e:
 				logger.warning("Failure to publish to Redis: %s" % (e.message,))
 
+class BackendStartup(object):
+	""" Starts each persistence backend on its own thread, so that slow
+	    brokers don't hold up the web server or each other,
+	    and keeps track of which backends are ready
+
+	>>> import tempfile
+	>>> hidey_hole = HideyHole(tempfile.mkdtemp())
+	>>> startup = BackendStartup()
+	>>> startup.start([hidey_hole])
+	>>> startup.wait()
+	>>> startup.readiness()
+	[('HideyHole', 'ready')]
+	>>> hidey_hole.stop()
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.threads = []
+		# the name and status of each backend, in order
+		self.backends = []
+		# id() of each backend that has been started, to start them only once
+		self.started = []
+
+	def start(self, backends, on_ready=None):
+		""" Start these backends, calling on_ready(backend) after each one
+		    is ready, such as to load any states that it has
+		"""
+		for backend in backends:
+			with self.lock:
+				if id(backend) in self.started:
+					continue
+				self.started.append(id(backend))
+				entry = {'name': backend.__class__.__name__, 'status': 'starting'}
+				self.backends.append(entry)
+			if not hasattr(backend, 'start'):
+				entry['status'] = 'ready'
+				continue
+			thread = threading.Thread(target=self._start_backend, args=(backend, entry, on_ready),
+			                          name='persistence-%s' % (entry['name'],))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def _start_backend(self, backend, entry, on_ready):
+		try:
+			backend.start()
+			entry['status'] = 'ready'
+			logger.info("Started %s" % (entry['name'],))
+		except Exception as e:
+			entry['status'] = 'failed'
+			logger.warning("Failure to start %s: %s" % (entry['name'], e))
+			return
+		if on_ready is not None:
+			try:
+				on_ready(backend)
+			except Exception as e:
+				logger.warning("Failure after starting %s: %s" % (entry['name'], e))
+
+	def wait(self, timeout=None):
+		""" Wait for every backend to finish starting """
+		for thread in self.threads:
+			thread.join(timeout)
+
+	def ready(self):
+		""" Whether every backend has finished starting, or failed to """
+		with self.lock:
+			return all((e['status'] != 'starting' for e in self.backends))
+
+	def readiness(self):
+		""" The (name, status) of each backend, where the status
+		    is one of starting, ready or failed
+		"""
+		with self.lock:
+			return [(e['name'], e['status']) for e in self.backends]
+
+startup = BackendStartup()
+
+class _InsertionOrderedDict(object):
+	""" Enough of collections.OrderedDict for python 2.6, which lacks it:
+	    keys remember the order they were first set in
+
+	>>> values = _InsertionOrderedDict()
+	>>> values['a'] = '1'
+	>>> values['b'] = '2'
+	>>> values['a'] = '3'
+	>>> values.pop('b')
+	'2'
+	>>> values['b'] = '4'
+	>>> values.popitem(last=False)
+	('a', '3')
+	>>> len(values), values.get('b'), 'a' in values
+	(1, '4', False)
+	"""
+	def __init__(self):
+		self.values = {}	# (serial, value) by key
+		# (key, serial) in order, including keys that have since been
+		# removed, which are skipped when they come to the front
+		self.order = collections.deque()
+		self.serial = 0
+
+	def __setitem__(self, key, value):
+		entry = self.values.get(key)
+		if entry is not None:
+			self.values[key] = (entry[0], value)
+			return
+		self.serial = self.serial + 1
+		self.values[key] = (self.serial, value)
+		self.order.append((key, self.serial))
+		if len(self.order) > 2 * len(self.values) + 16:
+			self.order = collections.deque([o for o in self.order if self._current(*o)])
+
+	def _current(self, key, serial):
+		entry = self.values.get(key)
+		return entry is not None and entry[0] == serial
+
+	def get(self, key, default=None):
+		entry = self.values.get(key)
+		return default if entry is None else entry[1]
+
+	def pop(self, key, *default):
+		if key in self.values:
+			return self.values.pop(key)[1]
+		if default:
+			return default[0]
+		raise KeyError(key)
+
+	def popitem(self, last=True):
+		if last:
+			raise NotImplementedError("Only the oldest item can be popped")
+		while self.order:
+			key, serial = self.order.popleft()
+			if self._current(key, serial):
+				return (key, self.values.pop(key)[1])
+		raise KeyError("popitem(): dictionary is empty")
+
+	def clear(self):
+		self.values.clear()
+		self.order.clear()
+
+	def __contains__(self, key):
+		return key in self.values
+
+	def __len__(self):
+		return len(self.values)
+
+_OrderedDict = getattr(collections, 'OrderedDict', _InsertionOrderedDict)
+
+class ReadCache(object):
+	""" The most recently used values of the PERSISTENCE chain
+
+	Values are kept for the keys that were most recently set or found,
+	up to maxsize of them, and counts are kept of how many reads
+	were answered by the cache and how many had to ask the backends
+
+	>>> cache = ReadCache(maxsize=2)
+	>>> cache.put('a', '1')
+	>>> cache.put('b', '2')
+	>>> cache.lookup('a')
+	'1'
+	>>> cache.put('c', '3')
+	>>> cache.lookup('b') is None
+	True
+	>>> cache.hits, cache.misses
+	(1, 1)
+	"""
+	def __init__(self, maxsize=1024):
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		self.values = _OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self._backends = None
+
+	def check_backends(self, backends):
+		""" Forget everything if the backends have been replaced """
+		if backends is not self._backends:
+			with self.lock:
+				self._backends = backends
+				self.values.clear()
+
+	def lookup(self, key):
+		""" The cached value, or None if the backends need to be asked """
+		with self.lock:
+			value = self.values.pop(key, None)
+			if value is None:
+				self.misses = self.misses + 1
+				return None
+			# mark it as the most recently used
+			self.values[key] = value
+			self.hits = self.hits + 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.values.pop(key, None)
+			if value is None:
+				return
+			self.values[key] = value
+			while len(self.values) > self.maxsize:
+				self.values.popitem(last=False)
+
+	def discard(self, key):
+		with self.lock:
+			self.values.pop(key, None)
+
+	def __len__(self):
+		return len(self.values)
+
+cache = ReadCache()
+
+class WriteQueue(object):
+	""" Holds the writes for a backend and makes them on a background thread,
+	    so that a slow backend doesn't hold up whoever changed the state
+
+	Writes to a key that is still waiting replace the waiting value
+	Once maxsize different keys are waiting, the overflow policy decides
+	what to do with a write to another key:
+	    block - wait for the backend to catch up
+	    drop_oldest - forget the longest waiting write
+	    write_through - write it directly, on the caller's thread
+	The thread is started when needed, and ends when nothing is waiting
+
+	>>> import mock
+	>>> backend = mock.Mock()
+	>>> queue = WriteQueue(backend)
+	>>> queue.put('fans/test', 'ON')
+	>>> queue.flush(timeout=5)
+	True
+	>>> backend.set.call_args
+	call('fans/test', 'ON')
+	"""
+	OVERFLOW_POLICIES = ('block', 'drop_oldest', 'write_through')
+
+	def __init__(self, backend, maxsize=1000, overflow='block'):
+		if overflow not in self.OVERFLOW_POLICIES:
+			raise ValueError("Unknown overflow policy %r, expected one of %s" % (overflow, ', '.join(self.OVERFLOW_POLICIES)))
+		self.backend = backend
+		self.maxsize = maxsize
+		self.overflow = overflow
+		self.condition = threading.Condition()
+		# the waiting values, by key, in the order they were first written
+		self.pending = _OrderedDict()
+		self.thread = None
+		self.dropped = 0
+
+	def put(self, key, value):
+		with self.condition:
+			if key not in self.pending and len(self.pending) >= self.maxsize:
+				if self.overflow == 'write_through':
+					self.condition.release()
+					try:
+						self._write(key, value)
+					finally:
+						self.condition.acquire()
+					return
+				if self.overflow == 'drop_oldest':
+					dropped_key, _ = self.pending.popitem(last=False)
+					self.dropped = self.dropped + 1
+					logger.warning("Dropped the write of %s to %s, too many are waiting" % (dropped_key, self.backend.__class__.__name__))
+				else:
+					while key not in self.pending and len(self.pending) >= self.maxsize:
+						self.condition.wait()
+			self.pending[key] = value
+			if self.thread is None:
+				self.thread = threading.Thread(target=self._work,
+				                               name='persistence-writes-%s' % (self.backend.__class__.__name__,))
+				self.thread.daemon = True
+				self.thread.start()
+
+	def lookup(self, key):
+		""" The waiting value of this key, or None if nothing is waiting """
+		with self.condition:
+			return self.pending.get(key)
+
+	def depth(self):
+		with self.condition:
+			return len(self.pending)
+
+	def _write(self, key, value):
+		try:
+			self.backend.set(key, value)
+		except Exception as e:
+			logger.warning("Failure to persist %s to %s: %s" % (key, self.backend.__class__.__name__, e))
+
+	def _work(self):
+		while True:
+			with self.condition:
+				if not self.pending:
+					self.thread = None
+					self.condition.notify_all()
+					return
+				key, value = self.pending.popitem(last=False)
+				# there is room for any blocked writers
+				self.condition.notify_all()
+			self._write(key, value)
+
+	def flush(self, timeout=None):
+		""" Wait for every waiting write to be made, or for timeout seconds
+		    Returns whether everything was written
+		"""
+		deadline = None
+		if timeout is not None:
+			deadline = time.time() + timeout
+		with self.condition:
+			while self.thread is not None:
+				if deadline is None:
+					self.condition.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self.condition.wait(remaining)
+			return True
+
+# default settings of each backend's WriteQueue, which a backend can change
+# by setting write_queue_size or write_overflow on itself
+WRITE_QUEUE_SIZE = 1000
+WRITE_OVERFLOW = 'block'
+
+_write_queues = {}	# by id() of the backend
+_write_queues_lock = threading.Lock()
+
+def write_queue(backend):
+	""" The WriteQueue of this backend, or None if it is written directly """
+	if not getattr(backend, 'write_behind', True):
+		return None
+	with _write_queues_lock:
+		queue = _write_queues.get(id(backend))
+		if queue is None:
+			queue = WriteQueue(backend,
+			                   maxsize=getattr(backend, 'write_queue_size', WRITE_QUEUE_SIZE),
+			                   overflow=getattr(backend, 'write_overflow', WRITE_OVERFLOW))
+			_write_queues[id(backend)] = queue
+		return queue
+
+def flush(timeout=None):
+	""" Finish every waiting write, such as before shutting down,
+	    giving up after timeout seconds
+	    Returns whether everything was written
+	"""
+	# deferred import to sidestep circular import
+	from restful_rfcat.config import PERSISTENCE
+	deadline = None
+	if timeout is not None:
+		deadline = time.time() + timeout
+	with _write_queues_lock:
+		queues = list(_write_queues.values())
+	finished = True
+	for queue in queues:
+		remaining = None
+		if deadline is not None:
+			remaining = max(0, deadline - time.time())
+		if not queue.flush(remaining):
+			logger.warning("Gave up waiting for %s writes to %s" % (queue.depth(), queue.backend.__class__.__name__))
+			finished = False
+	for driver in PERSISTENCE:
+		if hasattr(driver, 'sync'):
+			driver.sync()
+		elif hasattr(driver, 'flush'):
+			driver.flush()
+	return finished
+
 def set(key, value):
 	# module level accessor method
 	# deferred import to sidestep circular import
 	from restful_rfcat.config import PERSISTENCE
+	cache.check_backends(PERSISTENCE)
+	# only remember values that a backend could have given back
+	if any((getattr(driver, 'stores_values', True) for driver in PERSISTENCE)):
+		cache.put(key, value)
+	else:
+		cache.discard(key)
 	for driver in PERSISTENCE:
-		driver.set(key, value)
+		queue = write_queue(driver)
+		if queue is None:
+			driver.set(key, value)
+		else:
+			queue.put(key, value)
 
 def get(key):
 	# module level accessor method
 	# deferred import to sidestep circular import
 	from restful_rfcat.config import PERSISTENCE
+	cache.check_backends(PERSISTENCE)
+	found_value = cache.lookup(key)
+	if found_value is not None:
+		return found_value
 	for driver in PERSISTENCE:
-		found_value = driver.get(key)
+		found_value = None
+		if getattr(driver, 'stores_values', True):
+			# a write that hasn't been made yet
+			queue = _write_queues.get(id(driver))
+			if queue is not None:
+				found_value = queue.lookup(key)
+		if found_value is None:
+			found_value = driver.get(key)
 		if found_value is not None:
+			cache.put(key, found_value)
 			return found_value
 	return None
@@ -1,8 +1,6 @@
 import re
 import threading
 import time
-import rflib
-from rflib import RfCat, MOD_ASK_OOK
 
 import logging
 logger = logging.getLogger(__name__)
@@ -18,6 +16,8 @@ class Radio(object):
 	@staticmethod
 	def _create_device():
 		if Radio.device is None:
+			# rflib is slow to import, so only load it once a radio is needed
+			import rflib
 			Radio.device = rflib.RfCat()
 
 	@staticmethod
@@ -38,6 +38,7 @@ class OOKRadio(Radio):
 		self.bandwidth = bandwidth
 
 	def _prepare_device(self):
+		import rflib
 		Radio._create_device()
 		Radio.device.setMdmModulation(rflib.MOD_ASK_OOK)
 		Radio.device.setFreq(self.frequency)
@@ -64,6 +65,18 @@ class OOKRadio(Radio):
 			pass
 		Radio.claimed = None
 
+	def set_baudrate(self, baudrate):
+		""" Changes the baudrate, and lets go of the radio if this config has it
+		    claimed, so that the next send or receive programs the new baudrate
+		"""
+		with Radio.lock:
+			if self.baudrate == baudrate:
+				return
+			self.baudrate = baudrate
+			if Radio.claimed is self:
+				logger.info("Reprogramming radio for baudrate %s" % (baudrate,))
+				self.reset_device()
+
 	def _change_mode(self, mode):
 		if Radio.claimed == self and \
 		   Radio.mode == mode:
@@ -106,6 +119,7 @@ class OOKRadio(Radio):
 		self.device.setModeIDLE()
 
 	def send(self, bytes, repeat=10):
+		import rflib
 		with Radio.lock:
 			try:
 				self._change_mode('send')
@@ -116,6 +130,7 @@ class OOKRadio(Radio):
 				raise Exception("RFCat failure")
 
 	def receive(self):
+		import rflib
 		acquired = Radio.lock.acquire(False)
 		data = None
 		timestamp = None
@@ -152,6 +167,7 @@ class OOKRadioChannelHack(OOKRadio):
 		self.bandwidth = bandwidth
 
 	def _prepare_device(self):
+		import rflib
 		Radio._create_device()
 		Radio.device.setMdmModulation(rflib.MOD_ASK_OOK)
 		Radio.device.setFreq(self.frequency)
@@ -0,0 +1,175 @@
+"""
+This module holds the authoritative state of every device in memory.
+Each device has one DeviceRecord, with the state of the device and
+each of its subdevices, along with when and how it last changed.
+Reads come straight from the records, and the persistence backends
+are replicas: they are written after each change, and only read to
+fill in the records, at startup or the first time a device is used.
+"""
+import threading
+import time
+from restful_rfcat import persistence, pubsub
+
+class DeviceRecord(object):
+	""" Everything known about the state of a device
+
+	>>> record = DeviceRecord()
+	>>> record.subdevices['speed'] = '2'
+	>>> record.speed, record.power
+	('2', None)
+	"""
+	__slots__ = ('state', 'subdevices', 'updated', 'source')
+
+	def __init__(self):
+		self.state = None
+		self.subdevices = {}
+		self.updated = None	# time.time() of the last change
+		self.source = None	# what made the last change, like 'command' or 'eavesdrop'
+
+	@property
+	def power(self):
+		return self.subdevices.get('power')
+
+	@property
+	def speed(self):
+		return self.subdevices.get('speed')
+
+	@property
+	def command(self):
+		return self.subdevices.get('command')
+
+	def __repr__(self):
+		return 'DeviceRecord(state=%r, subdevices=%r, updated=%r, source=%r)' % (
+			self.state, self.subdevices, self.updated, self.source)
+
+class StateStore(object):
+	""" The DeviceRecords of every device, by the device's state path
+
+	Subdevice states are kept in their parent's record, by the subdevice's name
+	If the configured persistence backends are replaced, the records are
+	forgotten and loaded again from the new backends
+	"""
+	def __init__(self, _time=time.time):
+		self._time = _time
+		self._lock = threading.Lock()
+		self._backends = None
+		self.records = {}
+		# (path, field) pairs that have been read from the backends
+		self._loaded = set()
+		# the hydrated devices and subdevices, by state path
+		self.devices = {}
+
+	def _check_backends(self):
+		# deferred import to sidestep circular import
+		from restful_rfcat.config import PERSISTENCE
+		if PERSISTENCE is not self._backends:
+			with self._lock:
+				self._backends = PERSISTENCE
+				self.records = {}
+				self._loaded = set()
+
+	@staticmethod
+	def _full_path(path, field):
+		if field is None:
+			return path
+		return '%s/%s' % (path, field)
+
+	def _load(self, path, field):
+		value = persistence.get(self._full_path(path, field))
+		if value is None and not persistence.startup.ready():
+			# keep asking until every backend has finished starting
+			return
+		with self._lock:
+			if (path, field) not in self._loaded:
+				record = self.records.setdefault(path, DeviceRecord())
+				if field is None:
+					record.state = value
+				else:
+					record.subdevices[field] = value
+				self._loaded.add((path, field))
+
+	def record(self, path):
+		""" The DeviceRecord of the device with this state path """
+		self._check_backends()
+		with self._lock:
+			return self.records.setdefault(path, DeviceRecord())
+
+	def get(self, path, field=None):
+		""" The state of a device, or of its subdevice named field """
+		self._check_backends()
+		if (path, field) not in self._loaded:
+			self._load(path, field)
+		record = self.records.get(path) or DeviceRecord()
+		if field is None:
+			return record.state
+		return record.subdevices.get(field)
+
+	def set(self, path, value, field=None, source=None):
+		""" Change the state of a device, or of its subdevice named field,
+		    and then copy it to the persistence backends
+		"""
+		self._check_backends()
+		with self._lock:
+			record = self.records.setdefault(path, DeviceRecord())
+			if field is None:
+				record.state = value
+			else:
+				record.subdevices[field] = value
+			record.updated = self._time()
+			record.source = source
+			self._loaded.add((path, field))
+		persistence.set(self._full_path(path, field), value)
+
+	def mark_unsent(self, path):
+		""" The device's last change couldn't be sent, so forget when it
+		    changed, and the next request for that state isn't skipped
+		"""
+		self._check_backends()
+		with self._lock:
+			record = self.records.setdefault(path, DeviceRecord())
+			record.updated = None
+			record.source = 'unsent'
+
+	def changed_elsewhere(self, key, value, source='external'):
+		""" A backend noticed that something else changed a state,
+		    so update the record without saving it again,
+		    and announce the change if the device is known
+		"""
+		parts = key.split('/')
+		path = '/'.join(parts[:2])
+		field = parts[2] if len(parts) > 2 else None
+		self._check_backends()
+		with self._lock:
+			record = self.records.setdefault(path, DeviceRecord())
+			if field is None:
+				record.state = value
+			else:
+				record.subdevices[field] = value
+			record.updated = self._time()
+			record.source = source
+			self._loaded.add((path, field))
+			device = self.devices.get(key)
+		if device is not None:
+			pubsub.publish({'device': device, 'state': value})
+
+	def hydrate(self, devices):
+		""" Load the state of these devices and their subdevices from the backends """
+		for device in devices:
+			path = device._state_path()
+			self.devices[path] = device
+			self.get(path)
+			for name, subdevice in device.subdevices.items():
+				self.devices[subdevice._state_path()] = subdevice
+				self.get(path, name)
+
+store = StateStore()
+
+def start(devices):
+	""" Start the configured persistence backends in the background
+	    and load the states of these devices, loading them again
+	    as each backend becomes ready
+	"""
+	# deferred import to sidestep circular import
+	from restful_rfcat.config import PERSISTENCE
+	persistence.startup.start(PERSISTENCE, on_ready=lambda backend: store.hydrate(devices))
+	store.hydrate(devices)
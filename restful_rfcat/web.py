@@ -1,17 +1,13 @@
 import bottle
 import os
 import time
-from markup import markup
 from restful_rfcat.config import DEVICES, SENTRY_DSN
-import restful_rfcat.example_configs
+import restful_rfcat.persistence
 import restful_rfcat.pubsub
 import restful_rfcat.radio
+import restful_rfcat.state
 import Queue
 
-# sentry integration
-import raven
-from raven.contrib.bottle import Sentry
-
 device_list = {}
 
 script_path = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -30,25 +26,99 @@ def cli_output(output):
 	else:
 		return output
 
+def etag(state):
+	""" A device's current state, as an HTTP entity tag """
+	return '"%s"' % (state,)
+
+def etag_matches(header, state):
+	""" Whether an If-Match or If-None-Match header matches the state
+	    The tags can also be given without quotes, for easier typing
+
+	>>> etag_matches('"ON"', 'ON')
+	True
+	>>> etag_matches('"OFF", W/"ON"', 'ON')
+	True
+	>>> etag_matches('OFF', 'ON')
+	False
+	>>> etag_matches('*', 'OFF')
+	True
+	>>> etag_matches('*', None)
+	False
+	"""
+	if state is None:
+		return False
+	for tag in header.split(','):
+		tag = tag.strip()
+		if tag.startswith('W/'):
+			tag = tag[2:]
+		if tag == '*' or tag.strip('"') == state:
+			return True
+	return False
+
+def precondition_failed(current, if_match, if_none_match):
+	""" Check the If-Match and If-None-Match headers of a request
+	    against the current state, before changing it
+
+	>>> precondition_failed('ON', '"ON"', None)
+	False
+	>>> precondition_failed('ON', None, '"ON"')
+	True
+	"""
+	if if_match is not None and not etag_matches(if_match, current):
+		return True
+	if if_none_match is not None and etag_matches(if_none_match, current):
+		return True
+	return False
+
 # define all the devices
 def rest_get_state(device):
 	""" Inside an HTTP GET, return a device's state """
 	def _wrapped(*args, **kwargs):
 		bottle.response.content_type = 'text/plain'
-		return cli_output(device.get_state())
+		state = device.get_state()
+		if state is not None:
+			bottle.response.set_header('ETag', etag(state))
+		return cli_output(state)
 	_wrapped.__name__ = 'get_%s' % (device.get_name(),)
 	return _wrapped
 def rest_set_state(device):
-	""" Inside an HTTP PUT, set a device's state """
+	""" Inside an HTTP PUT, set a device's state
+	    If-Match only changes the state from the given states,
+	    and If-None-Match only if it isn't already one of them
+	"""
 	def _wrapped(*args, **kwargs):
 		state = bottle.request.body.read()
+		if_match = bottle.request.headers.get('If-Match')
+		if_none_match = bottle.request.headers.get('If-None-Match')
 		bottle.response.content_type = 'text/plain'
+		def _conditional_set():
+			# runs in the device's mailbox, so the check and change happen together
+			current = device.get_state()
+			if precondition_failed(current, if_match, if_none_match):
+				return (False, None, current)
+			new_state = device.set_state(state)
+			return (True, new_state, device.get_state())
 		try:
-			return cli_output(device.set_state(state))
+			changed, new_state, current = device.mailbox.call(_conditional_set)
 		except ValueError:
 			return bottle.HTTPError(400, "Invalid state: %s" % (state,))
+		if not changed:
+			return bottle.HTTPError(412, "Current state: %s" % (current,))
+		bottle.response.set_header('ETag', etag(current))
+		return cli_output(new_state)
 	_wrapped.__name__ = 'put_%s' % (device.get_name(),)
 	return _wrapped
+def rest_run_macro(device):
+	""" Inside an HTTP POST, send one of a device's macros """
+	def _wrapped(macro, *args, **kwargs):
+		bottle.response.content_type = 'text/plain'
+		if macro not in device.macros:
+			return bottle.HTTPError(404, "Unknown macro: %s" % (macro,))
+		# in turn with the device's other changes, since it changes states too
+		device.mailbox.call(device.run_macro, macro)
+		return cli_output(macro)
+	_wrapped.__name__ = 'macro_%s' % (device.get_name(),)
+	return _wrapped
 def rest_list_states(device):
 	""" Inside an HTTP OPTIONS, list a device's acceptable inputs """
 	def _wrapped(*args, **kwargs):
@@ -62,6 +132,8 @@ for device in DEVICES:
 	bottle.post(path)(rest_set_state(device))  # openhab can only post
 	bottle.put(path)(rest_set_state(device))
 	bottle.route(path, method='OPTIONS')(rest_list_states(device))
+	if device.macros:
+		bottle.post(path + '/macros/<macro>')(rest_run_macro(device))
 	# check for subdevices
 	for name,subdev in device.subdevices.items():
 		subpath = '/' + subdev._state_path()
@@ -99,6 +171,7 @@ def index():
 		lines.append('')
 		return '\n'.join(lines)
 	else:
+		from markup import markup
 		page = markup.page()
 		page.init(script=['app.js'], css=['style.css'])
 		for klass in sorted(device_list.keys()):
@@ -129,6 +202,7 @@ def index():
 
 @bottle.get('/examples')
 def examples():
+	import restful_rfcat.example_configs
 	http_host = bottle.request.environ.get('HTTP_HOST', 'localhost:3350')
 	configs = restful_rfcat.example_configs.get(http_host)
 	if is_cli():
@@ -142,6 +216,7 @@ def examples():
 				lines.append('')
 		return '\n'.join(lines)
 	else:
+		from markup import markup
 		page = markup.page()
 		page.init(script=['app.js'], css=['style.css'])
 		for software, software_configs in configs.items():
@@ -196,20 +271,60 @@ def stream():
 			path = device._state_path()
 			yield 'data: %s=%s\n\n' % (path, data['state'])
 
+@bottle.get('/metrics')
+def metrics():
+	bottle.response.content_type = 'text/plain'
+	lines = [
+		'# HELP restful_rfcat_mailbox_depth Changes waiting for each device',
+		'# TYPE restful_rfcat_mailbox_depth gauge',
+	]
+	for device in DEVICES:
+		lines.append('restful_rfcat_mailbox_depth{device="%s"} %i' % (device._state_path(), device.get_mailbox_depth()))
+	cache = restful_rfcat.persistence.cache
+	lines.extend([
+		'# HELP restful_rfcat_persistence_cache_hits_total Persistence reads answered from memory',
+		'# TYPE restful_rfcat_persistence_cache_hits_total counter',
+		'restful_rfcat_persistence_cache_hits_total %i' % (cache.hits,),
+		'# HELP restful_rfcat_persistence_cache_misses_total Persistence reads that asked the backends',
+		'# TYPE restful_rfcat_persistence_cache_misses_total counter',
+		'restful_rfcat_persistence_cache_misses_total %i' % (cache.misses,),
+		'# HELP restful_rfcat_persistence_cache_size Keys held by the persistence cache',
+		'# TYPE restful_rfcat_persistence_cache_size gauge',
+		'restful_rfcat_persistence_cache_size %i' % (len(cache),),
+		'# HELP restful_rfcat_persistence_write_queue_depth Writes waiting for each backend',
+		'# TYPE restful_rfcat_persistence_write_queue_depth gauge',
+	])
+	for backend in restful_rfcat.config.PERSISTENCE:
+		queue = restful_rfcat.persistence.write_queue(backend)
+		if queue is not None:
+			lines.append('restful_rfcat_persistence_write_queue_depth{backend="%s"} %i' % (backend.__class__.__name__, queue.depth()))
+	lines.append('')
+	return '\n'.join(lines)
+
 @bottle.get('/ping')
 def ping():
+	""" Checks the radio, and lists whether each persistence backend has started """
 	radio = restful_rfcat.radio.Radio()
 	working = radio.ping()
+	backends = ''.join(('%s: %s\n' % (name, status)
+		for name, status in restful_rfcat.persistence.startup.readiness()))
 	if working:
-		return "OK\n"
+		bottle.response.content_type = 'text/plain'
+		return "OK\n" + backends
 	else:
-		return bottle.HTTPError(500, "Unresponsive radio")
+		return bottle.HTTPError(500, "Unresponsive radio\n" + backends)
 
 def run_webserver():
 	app = bottle.app()
 	app.catchall = False
-	app = Sentry(app, raven.Client(SENTRY_DSN))
+	if SENTRY_DSN is not None:
+		# sentry integration
+		import raven
+		from raven.contrib.bottle import Sentry
+		app = Sentry(app, raven.Client(SENTRY_DSN))
 	bottle.run(app, server='paste', host='0.0.0.0', port=3350)
 
 if __name__ == '__main__':
+	# connect the persistence backends and load the last known states
+	restful_rfcat.state.start(DEVICES)
 	run_webserver()
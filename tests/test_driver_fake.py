@@ -1,6 +1,8 @@
 from restful_rfcat import config, drivers, persistence, pubsub
+import operator
 import shutil
 import tempfile
+import threading
 import unittest
 
 def events_summary(queue):
@@ -162,3 +164,59 @@ class TestDriverFake(unittest.TestCase):
 		self.assertEqual("ON", events['fans/test/power'])
 		self.assertEqual("2", events['fans/test/speed'])
 		self.assertEqual("2", events['fans/test/command'])
+
+	def test_subdevices_cached(self):
+		fan = drivers.FakeFan(name="test", label="Test")
+		self.assertTrue(fan.subdevices is fan.subdevices)
+		self.assertTrue(fan.subdevices['speed'] is fan.subdevices['speed'])
+		self.assertTrue(fan.subdevices['speed'].parent is fan)
+		self.assertEqual(set(['command', 'power', 'speed']), set(fan.subdevices.keys()))
+		other = drivers.FakeFan(name="other", label="Other")
+		self.assertFalse(fan.subdevices['speed'] is other.subdevices['speed'])
+		self.assertRaises(TypeError, operator.setitem, fan.subdevices, 'speed', None)
+
+	def test_compact_devices(self):
+		fan = drivers.FakeFan(name="test", label="Test")
+		self.assertFalse(hasattr(fan, '__dict__'))
+		self.assertFalse(hasattr(fan.subdevices['speed'], '__dict__'))
+		# state paths are worked out once and shared
+		other = drivers.FakeFan(name="test", label="Test")
+		self.assertTrue(fan._state_path() is other._state_path())
+		self.assertEqual('fans/test/speed', fan.subdevices['speed']._state_path())
+		self.assertTrue(fan.subdevices['speed']._state_path() is other.subdevices['speed']._state_path())
+
+	def test_mailbox(self):
+		fan = drivers.FakeFan(name="test", label="Test")
+		self.assertEqual(0, fan.get_mailbox_depth())
+		self.assertTrue(fan.mailbox is fan.subdevices['speed'].mailbox)
+		self.assertEqual('HIGH', fan.mailbox.call(fan.set_state, 'HIGH'))
+		self.assertEqual('3', fan.subdevices['command'].get_state())
+		self.assertRaises(ValueError, fan.mailbox.call, fan.set_state, 'BLUE')
+		self.assertEqual(0, fan.get_mailbox_depth())
+
+	def test_mailbox_order(self):
+		fan = drivers.FakeFan(name="test", label="Test")
+		light = drivers.FakeLight(name="test", label="Test")
+		release = threading.Event()
+		fan.mailbox.send(release.wait)
+		replies = [fan.mailbox.send(fan.set_state, state) for state in ['LOW', 'MED', 'HIGH']]
+		self.assertEqual(4, fan.get_mailbox_depth())
+		# other devices aren't held up
+		self.assertEqual('ON', light.mailbox.call(light.set_state, 'ON'))
+		release.set()
+		self.assertEqual(['LOW', 'MED', 'HIGH'], [r.get(5) for r in replies])
+		self.assertEqual('3', fan.subdevices['command'].get_state())
+
+	def test_registry(self):
+		self.assertTrue('FakeFan' in drivers.__all__)
+		self.assertTrue(drivers.FakeFan is drivers.fake.FakeFan)
+		self.assertRaises(AttributeError, getattr, drivers, 'LightMixin')
+		drivers.register('LightMixin', 'restful_rfcat.drivers._utils')
+		try:
+			self.assertTrue('LightMixin' in drivers.__all__)
+			from restful_rfcat.drivers import LightMixin
+			self.assertTrue(LightMixin is drivers._utils.LightMixin)
+		finally:
+			drivers.DRIVERS.pop('LightMixin')
+			if 'LightMixin' in vars(drivers):
+				delattr(drivers, 'LightMixin')
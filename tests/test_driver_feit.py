@@ -0,0 +1,87 @@
+from restful_rfcat import config, persistence
+from restful_rfcat.drivers._utils import BitBuffer
+from restful_rfcat.drivers.feit import FeitElectric, FeitElectricLights
+import mock
+import shutil
+import tempfile
+import unittest
+
+class TestFeitMacros(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname)]
+		self.lights = FeitElectricLights(name='test', label='Test', address='0110110111110101011110101111',
+		                                 macros={'party': ['on', ('red', 200), 'plus']})
+		self.patcher = mock.patch.object(FeitElectric.radio, 'send')
+		self.send = self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		shutil.rmtree(self._dirname)
+
+	def test_compile(self):
+		baudrate = FeitElectric.radio.baudrate
+		expected = BitBuffer()
+		expected.extend(self.lights._press_symbols('on'))
+		expected.append_run(0, int(round(FeitElectric.MACRO_GAP * baudrate / 1000.0)))
+		expected.extend(self.lights._press_symbols('red'))
+		expected.append_run(0, int(round(200 * baudrate / 1000.0)))
+		expected.extend(self.lights._press_symbols('plus'))
+		self.assertEqual(expected.tobytes(), self.lights.compile_macro('party'))
+
+	def test_compiled_once(self):
+		with mock.patch.object(FeitElectricLights, '_press_symbols', return_value=BitBuffer.from_string('101')) as press:
+			self.lights.compile_macro('party')
+			self.lights.compile_macro('party')
+			self.assertEqual(3, press.call_count)
+
+	def test_run(self):
+		self.lights.run_macro('party')
+		self.send.assert_called_once_with(self.lights.compile_macro('party'), repeat=0)
+
+	def test_states(self):
+		self.lights.subdevices['brightness']._set('4')
+		self.lights.run_macro('party')
+		self.assertEqual('ON', self.lights.get_state())
+		self.assertEqual('RED', self.lights.subdevices['color'].get_state())
+		self.assertEqual('5', self.lights.subdevices['brightness'].get_state())
+
+	def test_unknown_command(self):
+		self.assertRaises(ValueError, FeitElectricLights, name='test', label='Test',
+		                  address='0110110111110101011110101111', macros={'party': ['on', 'disco']})
+
+	def test_unknown(self):
+		self.assertEqual(['party'], self.lights.get_macros())
+		self.assertRaises(ValueError, self.lights.run_macro, 'disco')
+		self.assertEqual(0, self.send.call_count)
+
+class TestFeitBrightness(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname)]
+		self.lights = FeitElectricLights(name='test', label='Test', address='0110110111110101011110101111')
+		self.patcher = mock.patch.object(FeitElectric.radio, 'send')
+		self.send = self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		shutil.rmtree(self._dirname)
+
+	def test_one_transmission(self):
+		brightness = self.lights.subdevices['brightness']
+		brightness._set('3')
+		self.assertEqual('6', self.lights.set_state('6'))
+		self.assertEqual('6', brightness.get_state())
+		self.assertEqual(1, self.send.call_count)
+		bin_key = self.lights._get_bin_key('plus')
+		expected = FeitElectric._encode_presses([bin_key] * 3, FeitElectric.FRAME_COUNT)
+		self.send.assert_called_once_with(expected, repeat=0)
+
+	def test_unchanged(self):
+		brightness = self.lights.subdevices['brightness']
+		brightness._set('3')
+		brightness.set_state('3')
+		self.assertEqual(0, self.send.call_count)
+
+	def test_invalid(self):
+		self.assertRaises(ValueError, self.lights.subdevices['brightness'].set_state, '11')
@@ -0,0 +1,122 @@
+from restful_rfcat import config, persistence, state
+from restful_rfcat.drivers.hamptonbay import HamptonCeiling, HamptonCeilingFan, HamptonCeilingLight
+import mock
+import shutil
+import tempfile
+import unittest
+
+class FakeTimer(object):
+	""" Collects the started timers, to be run by the test """
+	started = []
+
+	def __init__(self, interval, function):
+		self.function = function
+		self.daemon = False
+
+	def start(self):
+		self.started.append(self)
+
+class TestHamptonCoalescing(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname)]
+		FakeTimer.started = []
+		self.patchers = [
+			mock.patch.object(HamptonCeiling, '_timer', FakeTimer),
+			mock.patch.object(HamptonCeiling, 'pending', {}),
+			mock.patch.object(HamptonCeiling, 'devices', {}),
+			mock.patch.object(HamptonCeiling, '_send'),
+		]
+		self.send = [patcher.start() for patcher in self.patchers][-1]
+		self.light = HamptonCeilingLight(name='test', label='Test', dip_switch='1011')
+		self.fan = HamptonCeilingFan(name='test', label='Test', dip_switch='1011')
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+		shutil.rmtree(self._dirname)
+
+	def run_timers(self):
+		started, FakeTimer.started = FakeTimer.started, []
+		for timer in started:
+			timer.function()
+		# wait for the sends to leave the mailboxes
+		for device in (self.light, self.fan):
+			device.mailbox.call(lambda: None)
+
+	def test_combined(self):
+		self.light.set_state('ON')
+		self.fan.set_state('HIGH')
+		self.assertEqual(1, len(FakeTimer.started))
+		self.assertEqual(0, self.send.call_count)
+		self.run_timers()
+		self.send.assert_called_once_with(self.light._get_bin_key('0' + '101'))
+
+	def test_latest_wins(self):
+		self.fan.set_state('LOW')
+		self.fan.set_state('MED')
+		self.run_timers()
+		# the light hasn't been set, so it is sent as on
+		self.send.assert_called_once_with(self.fan._get_bin_key('0' + '011'))
+
+	def test_separate_windows(self):
+		self.light.set_state('OFF')
+		self.run_timers()
+		self.fan.set_state('LOW')
+		self.run_timers()
+		self.assertEqual(2, self.send.call_count)
+		self.send.assert_called_with(self.fan._get_bin_key('1' + '001'))
+
+	def test_separate_remotes(self):
+		other = HamptonCeilingLight(name='other', label='Other', dip_switch='0010')
+		self.light.set_state('ON')
+		other.set_state('ON')
+		self.assertEqual(2, len(FakeTimer.started))
+
+	def test_resend_skipped(self):
+		self.fan.set_state('HIGH')
+		self.fan.set_state('HIGH')
+		self.fan.subdevices['speed'].set_state('3')
+		self.assertEqual(1, len(FakeTimer.started))
+		self.light.set_state('ON')
+		self.run_timers()
+		self.light.set_state('1')
+		self.assertEqual(1, self.send.call_count)
+
+	def test_resend_after_interval(self):
+		self.light.set_state('ON')
+		self.run_timers()
+		record = state.store.record(self.light._state_path())
+		record.updated = record.updated - HamptonCeiling.RESEND_INTERVAL
+		self.light.set_state('ON')
+		self.run_timers()
+		self.assertEqual(2, self.send.call_count)
+
+	def test_no_window(self):
+		with mock.patch.object(HamptonCeiling, 'COALESCE_WINDOW', 0):
+			self.light.set_state('OFF')
+		self.assertEqual(0, len(FakeTimer.started))
+		self.assertEqual(1, self.send.call_count)
+
+	def test_failed_send(self):
+		self.send.side_effect = IOError("RFCat failure")
+		self.light.set_state('ON')
+		self.run_timers()
+		record = state.store.record(self.light._state_path())
+		self.assertEqual(('unsent', None), (record.source, record.updated))
+		# asking again isn't skipped as a resend
+		self.send.side_effect = None
+		self.light.set_state('ON')
+		self.run_timers()
+		self.assertEqual(2, self.send.call_count)
+		self.assertEqual('command', record.source)
+
+	def test_macro_states(self):
+		light = HamptonCeilingLight(name='macro', label='Macro', dip_switch='0110', macros={'cool': ['lighton', 'fan3']})
+		fan = HamptonCeilingFan(name='macro', label='Macro', dip_switch='0110')
+		with mock.patch.object(HamptonCeiling.radio, 'send'):
+			light.run_macro('cool')
+		# fan3 also carries the light bit, which turns it off
+		self.assertEqual('OFF', light.get_state())
+		self.assertEqual('3', fan.subdevices['command'].get_state())
+		self.assertEqual('command', state.store.record(fan._state_path()).source)
@@ -0,0 +1,121 @@
+from restful_rfcat import config, persistence
+from restful_rfcat.drivers._utils import EavesdropLimiter, ToggleReconciler
+from restful_rfcat.drivers.hunter import HunterCeilingEavesdropper, HunterCeilingLight
+import mock
+import shutil
+import tempfile
+import threading
+import unittest
+
+class TestHunterLight(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname)]
+		self.now = 1000
+		self.light = HunterCeilingLight(name='test', label='Test', dip_switch='1011')
+		self.light.reconciler = ToggleReconciler(self.light._toggle, self.light._force, self.light._rollback,
+		                                         _timer=None, _time=lambda: self.now)
+		self.patcher = mock.patch.object(HunterCeilingLight, '_send_command')
+		self.send = self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		shutil.rmtree(self._dirname)
+
+	def test_single_toggle(self):
+		self.light.set_state('ON')
+		self.assertEqual('ON', self.light.get_state())
+		self.assertEqual(0, self.send.call_count)
+		self.light.reconciler.flush()
+		self.send.assert_called_once_with('light')
+
+	def test_cancelled_toggle(self):
+		self.light.set_state('ON')
+		self.light.set_state('OFF')
+		self.light.reconciler.flush()
+		self.assertEqual(0, self.send.call_count)
+		self.assertEqual('OFF', self.light.get_state())
+
+	def test_repeated_request(self):
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.assertEqual(1, self.send.call_count)
+
+	def test_force_on(self):
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.now = self.now + 60
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.send.assert_called_with('light', 100)
+
+	def test_observed(self):
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		# the remote turned it off
+		self.light.reconciler.observe('OFF')
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.assertEqual(['light', 'light'], [c[0][0] for c in self.send.call_args_list])
+
+	def test_invalid(self):
+		self.assertRaises(ValueError, self.light.set_state, 'DIM')
+
+	def test_failed_send(self):
+		self.send.side_effect = IOError("RFCat failure")
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.assertEqual('OFF', self.light.get_state())
+		# trying again sends the toggle again
+		self.send.side_effect = None
+		self.light.set_state('ON')
+		self.light.reconciler.flush()
+		self.assertEqual(2, self.send.call_count)
+		self.assertEqual('ON', self.light.get_state())
+
+	def test_mailbox(self):
+		timers = []
+		light = HunterCeilingLight(name='mailbox', label='Mailbox', dip_switch='1011')
+		light.reconciler._timer = lambda delay, function: timers.append(function) or mock.Mock()
+		light.set_state('ON')
+		with mock.patch.object(light.mailbox, 'send') as send:
+			timers[0]()
+			send.assert_called_once_with(light.reconciler.flush)
+
+	def test_eavesdrop_after_waiting_changes(self):
+		self.light.set_state('OFF')
+		release = threading.Event()
+		self.light.mailbox.send(release.wait, 5)
+		try:
+			self.light.mailbox.send(self.light.set_state, 'ON')
+			# the remote's toggle waits its turn, without holding up receiving
+			HunterCeilingEavesdropper.handle_packet(self.light._get_bin_key('light'), 5)
+			self.assertEqual(3, self.light.get_mailbox_depth())
+		finally:
+			release.set()
+		self.light.mailbox.call(lambda: None)
+		self.assertEqual('OFF', self.light.get_state())
+		self.assertEqual('OFF', self.light.reconciler.physical)
+
+	def test_eavesdrop_toggle_twice(self):
+		self.light.set_state('OFF')
+		self.light.reconciler.flush()
+		limiter = EavesdropLimiter(_time=lambda: self.now)
+		with mock.patch.object(HunterCeilingEavesdropper, 'limiter', limiter):
+			HunterCeilingEavesdropper.handle_packet(self.light._get_bin_key('light'), 5)
+			self.now = self.now + 1
+			HunterCeilingEavesdropper.handle_packet(self.light._get_bin_key('light'), 5)
+		self.light.mailbox.call(lambda: None)
+		self.assertEqual('OFF', self.light.get_state())
+		self.assertEqual('OFF', self.light.reconciler.physical)
+
+	def test_macro_toggle(self):
+		self.light.set_state('OFF')
+		self.light.reconciler.flush()
+		self.light.macros = {'flash': ['light', 'light', 'light']}
+		with mock.patch.object(HunterCeilingLight.radio, 'send'):
+			self.light.run_macro('flash')
+		self.assertEqual('ON', self.light.get_state())
+		self.assertEqual('ON', self.light.reconciler.physical)
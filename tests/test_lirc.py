@@ -1,4 +1,10 @@
+from restful_rfcat import config, persistence, radio
 from restful_rfcat.drivers import lirc
+import mock
+import os
+import shutil
+import StringIO
+import tempfile
 import unittest
 
 class TestLircConfig(unittest.TestCase):
@@ -85,6 +91,85 @@ class TestLircConfig(unittest.TestCase):
 		understood = lirc._understand_lirc_config(conf)
 		self.assertEqual(desired, understood)
 
+MULTI_REMOTE = """
+# two remotes in one file
+begin remote
+  name  FIRST
+  bits  4
+  codes
+begin codes
+    KEY_POWER 0x1
+end codes
+end remote
+
+begin remote
+  name  SECOND
+  bits  8
+begin codes
+    KEY_POWER 0x2
+end codes
+end remote
+"""
+
+class TestLircLibrary(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		os.mkdir(os.path.join(self.directory, 'vendor'))
+		self.filename = os.path.join(self.directory, 'vendor', 'remotes.conf')
+		with open(self.filename, 'w') as config_file:
+			config_file.write(MULTI_REMOTE)
+		self.cache_filename = os.path.join(self.directory, 'index.json')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_default_library(self):
+		conf = lirc._understand_lirc_config(lirc._parse_lirc_config('hampton_bay_UC7078T'))
+		self.assertEqual(conf, lirc.default_library.get('hampton_bay_UC7078T'))
+		self.assertEqual(conf, lirc.default_library.get('UC7078T'))
+
+	def test_multiple_remotes(self):
+		library = lirc.LircLibrary(self.directory)
+		self.assertEqual(4, library.get('vendor/remotes.conf')['bits'])
+		self.assertEqual(4, library.get('FIRST')['bits'])
+		self.assertEqual(8, library.get('SECOND')['bits'])
+		self.assertEqual({'KEY_POWER': 2}, library.get('vendor/remotes.conf:SECOND')['codes'])
+		self.assertRaises(KeyError, library.get, 'THIRD')
+
+	def test_lazy_parsing(self):
+		library = lirc.LircLibrary(self.directory)
+		with mock.patch.object(lirc, '_parse_lirc_config', wraps=lirc._parse_lirc_config) as parse:
+			self.assertTrue('SECOND' in library.names())
+			self.assertEqual(0, parse.call_count)
+			library.get('SECOND')
+			library.get('SECOND')
+			self.assertEqual(1, parse.call_count)
+		# changes to one copy don't leak into the next
+		library.get('SECOND')['bits'] = 2
+		self.assertEqual(8, library.get('SECOND')['bits'])
+
+	def test_cached_index(self):
+		lirc.LircLibrary(self.directory, cache_filename=self.cache_filename).names()
+		self.assertTrue(os.path.exists(self.cache_filename))
+		library = lirc.LircLibrary(self.directory, cache_filename=self.cache_filename)
+		with mock.patch.object(library, '_index_file') as index_file:
+			self.assertEqual(8, library.get('SECOND')['bits'])
+			self.assertEqual(0, index_file.call_count)
+
+	def test_cache_invalidated_by_mtime(self):
+		lirc.LircLibrary(self.directory, cache_filename=self.cache_filename).names()
+		with open(self.filename, 'w') as config_file:
+			config_file.write(MULTI_REMOTE.replace('SECOND', 'OTHER'))
+		os.utime(self.filename, (0, 0))
+		library = lirc.LircLibrary(self.directory, cache_filename=self.cache_filename)
+		self.assertEqual(8, library.get('OTHER')['bits'])
+		self.assertRaises(KeyError, library.get, 'SECOND')
+
+	def test_remote_from_library(self):
+		library = lirc.LircLibrary(self.directory)
+		remote = lirc.LircRemote('SECOND', library=library, zero=(300, 700), one=(700, 300))
+		self.assertEqual(['KEY_POWER'], remote.frames.keys())
+
 class TestLircBaudrate(unittest.TestCase):
 	def test_guess_hampton_baudrate(self):
 		conf = lirc._parse_lirc_config('hampton_bay_UC7078T')
@@ -113,3 +198,259 @@ class TestLircBaudrate(unittest.TestCase):
 		})
 		self.assertEqual(100000, baudrate_divisor)
 
+	def _assert_within_tolerance(self, config, divisor):
+		eps = config.get('eps', 30)
+		aeps = config.get('aeps', 100)
+		for time in lirc.LircRemote._timing_weights(config):
+			sent = max(1, int(round(time * 1.0 / divisor))) * divisor
+			self.assertTrue(abs(sent - time) <= max(time * eps / 100.0, aeps), (time, sent))
+
+	def test_solve_hampton_baudrate(self):
+		conf = lirc._parse_lirc_config('hampton_bay_UC7078T')
+		understood = lirc._understand_lirc_config(conf)
+		baudrate_divisor = lirc.LircRemote.solve_baudrate_divisor([understood])
+		# much slower than the greedy guess, so frames are shorter
+		self.assertTrue(baudrate_divisor > lirc.LircRemote.guess_baudrate_divisor(understood))
+		self._assert_within_tolerance(understood, baudrate_divisor)
+
+	def test_solve_hunter_baudrate(self):
+		conf = lirc._parse_lirc_config('hunter_fan_TX28')
+		understood = lirc._understand_lirc_config(conf)
+		self.assertEqual(190, lirc.LircRemote.solve_baudrate_divisor([understood]))
+
+	def test_solve_shared_baudrate(self):
+		hampton = lirc._understand_lirc_config(lirc._parse_lirc_config('hampton_bay_UC7078T'))
+		hunter = lirc._understand_lirc_config(lirc._parse_lirc_config('hunter_fan_TX28'))
+		baudrate_divisor = lirc.LircRemote.solve_baudrate_divisor([hampton, hunter])
+		self._assert_within_tolerance(hampton, baudrate_divisor)
+		self._assert_within_tolerance(hunter, baudrate_divisor)
+
+	def test_pinned_baudrate(self):
+		remote = lirc.LircRemote('hampton_bay_UC7078T', baud_divisor=100)
+		self.assertEqual(100, remote.baud_divisor)
+		self.assertEqual('FAN_HIGH', remote.decode_button(remote.encode_button('FAN_HIGH'), 100))
+
+	def test_shared_radio(self):
+		fan = lirc.LircThreeWayFan(name='shared_fan', label='Fan', config_filename='hampton_bay_UC7078T', radio_frequency=303875101, shared_radio=True)
+		first_divisor = fan.remote.baud_divisor
+		light = lirc.LircLight(name='shared_light', label='Light', config_filename='hunter_fan_TX28', radio_frequency=303875101, shared_radio=True)
+		self.assertTrue(fan.radio is light.radio)
+		self.assertEqual(fan.remote.baud_divisor, light.remote.baud_divisor)
+		self.assertEqual(1000000 / light.remote.baud_divisor, fan.radio.baudrate)
+		self.assertNotEqual(first_divisor, fan.remote.baud_divisor)
+		# the fan's buttons were encoded again at the new baudrate
+		self.assertEqual('FAN_HIGH', fan.remote.decode_button(fan.remote.encode_button('FAN_HIGH'), fan.remote.baud_divisor))
+
+	def _shared_light(self, name, radio_frequency, **timing):
+		return lirc.LircLight(name=name, label=name, config_filename=None, radio_frequency=radio_frequency, shared_radio=True,
+		                      bits=4, codes={'KEY_LIGHTS_TOGGLE': 1}, eps=0, aeps=1, **timing)
+
+	def test_shared_radio_mismatch(self):
+		first = self._shared_light('shared_first', 303875102, zero=(300, 600), one=(600, 300), gap=12000)
+		self.assertRaises(ValueError, self._shared_light, 'shared_odd', 303875102, zero=(301, 602), one=(602, 301), gap=12040)
+		# the mismatched remote didn't join, so the others can still share
+		second = self._shared_light('shared_second', 303875102, zero=(300, 600), one=(600, 300), gap=12000)
+		self.assertTrue(first.radio is second.radio)
+		self.assertEqual([first, second], lirc.Lirc.shared_radios[303875102])
+
+	def test_shared_radio_same_timing(self):
+		lights = [self._shared_light('shared_same%i' % i, 303875103, zero=(300, 600), one=(600, 300), gap=12000)
+		          for i in range(50)]
+		self.assertEqual(1, len(lirc.Lirc.shared_timings[303875103]))
+		self.assertEqual(set([300]), set([l.remote.baud_divisor for l in lights]))
+
+class TestLircFrames(unittest.TestCase):
+	def test_compiled_on_load(self):
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		self.assertEqual(set(remote.config['codes'].keys()), set(remote.frames.keys()))
+		for command in remote.config['codes']:
+			frames = remote.frames[command]
+			self.assertEqual(frames.frame, remote.encode_button(command))
+			self.assertEqual(frames.frame, frames.repeat_frame)
+
+	def test_recompiled_on_change(self):
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		old_frame = remote.encode_button('FAN_LOW')
+		remote.config.update(pre_data=0x04)
+		new_frame = remote.encode_button('FAN_LOW')
+		self.assertNotEqual(old_frame, new_frame)
+		self.assertEqual(lirc.LircRemote('hampton_bay_UC7078T', pre_data=0x04).encode_button('FAN_LOW'), new_frame)
+		# the decoder follows along
+		self.assertEqual('FAN_LOW', remote.decode_button(new_frame, remote.baud_divisor))
+		self.assertEqual(None, remote.decode_button(old_frame, remote.baud_divisor))
+
+	def test_baudrate_solved_on_change(self):
+		remote = lirc.LircRemote(None, bits=4, zero=(300, 700), one=(700, 300), gap=12000, codes={'ON': 0x5})
+		self.assertEqual(324, remote.baud_divisor)
+		remote.config.update(zero=(190, 380), one=(380, 190), gap=6650)
+		remote.encode_button('ON')
+		self.assertEqual(lirc.LircRemote.solve_baudrate_divisor([remote.config]), remote.baud_divisor)
+		self.assertNotEqual(324, remote.baud_divisor)
+
+	def test_pinned_baudrate_on_change(self):
+		remote = lirc.LircRemote(None, bits=4, zero=(300, 700), one=(700, 300), gap=12000, codes={'ON': 0x5}, baud_divisor=100)
+		remote.config.update(zero=(190, 380), one=(380, 190), gap=6650)
+		remote.encode_button('ON')
+		self.assertEqual(100, remote.baud_divisor)
+		remote.set_baud_divisor(150)
+		remote.config.update(gap=7000)
+		remote.encode_button('ON')
+		self.assertEqual(150, remote.baud_divisor)
+
+	def test_no_foot_repeat(self):
+		remote = lirc.LircRemote('hunter_fan_TX28', foot=(190, 380), flags=['SPACE_FIRST', 'NO_FOOT_REP'])
+		frames = remote.get_frames('FAN_OFF')
+		self.assertEqual(len(frames.frame), len(frames.repeat_frame) + 3)
+
+RAW_REMOTE = """
+begin remote
+  name  RAWTEST
+  flags RAW_CODES
+  eps   30
+  aeps  100
+  gap   4000
+  min_repeat 2
+      begin raw_codes
+          name KEY_POWER
+              900 400 200 400
+              200
+          name KEY_MUTE
+              900 400 400 200
+              200
+      end raw_codes
+end remote
+"""
+
+class TestLircTransmission(unittest.TestCase):
+	def _raw_remote(self):
+		conf = lirc._parse_lirc_config(None, StringIO.StringIO(RAW_REMOTE))
+		return lirc.LircRemote(None, baud_divisor=100, **lirc._understand_lirc_config(conf))
+
+	def test_parse_raw_codes(self):
+		conf = lirc._parse_lirc_config(None, StringIO.StringIO(RAW_REMOTE))
+		understood = lirc._understand_lirc_config(conf)
+		self.assertEqual({
+			'KEY_POWER': [900, 400, 200, 400, 200],
+			'KEY_MUTE': [900, 400, 400, 200, 200],
+		}, understood['raw_codes'])
+
+	def test_raw_codes(self):
+		remote = self._raw_remote()
+		self.assertEqual(100, remote.baud_divisor)
+		frame = remote.encode_button('KEY_POWER')
+		self.assertEqual('111111111000011000011' + '0'*40, str(frame))
+		self.assertEqual('KEY_POWER', remote.decode_button(frame, remote.baud_divisor))
+		# min_repeat extra frames
+		self.assertEqual(frame.repeat(3), remote.encode_press('KEY_POWER'))
+
+	def test_single_transmission(self):
+		fan = lirc.LircThreeWayFan(name='test', label='Test', config_filename='hampton_bay_UC7078T', radio_frequency=303875003)
+		fan.radio = mock.Mock()
+		fan._send_command('3')
+		self.assertEqual(1, fan.radio.send.call_count)
+		symbols = fan.radio.send.call_args[0][0]
+		expected = fan.remote.get_frames('FAN_HIGH').frame.repeat(1 + lirc.Lirc.MIN_REPEATS)
+		self.assertEqual(expected.tobytes(), symbols)
+		self.assertEqual(0, fan.radio.send.call_args[1]['repeat'])
+
+	def test_new_baudrate_reprograms_radio(self):
+		fan = lirc.LircThreeWayFan(name='test', label='Test', config_filename='hampton_bay_UC7078T', radio_frequency=303875004)
+		with mock.patch.multiple(radio.Radio, device=mock.DEFAULT, claimed=None, mode=None) as patched:
+			fan._send_command('3')
+			old_baudrate = fan.radio.baudrate
+			fan.remote.config.update(zero=(190, 380), one=(380, 190))
+			fan._send_command('3')
+		new_baudrate = 1000000 / fan.remote.baud_divisor
+		self.assertNotEqual(old_baudrate, new_baudrate)
+		self.assertEqual([mock.call(old_baudrate), mock.call(new_baudrate)],
+		                 patched['device'].setMdmDRate.call_args_list)
+
+	def test_toggle_bit(self):
+		remote = lirc.LircRemote('hunter_fan_TX28', toggle_bit=11)
+		first = remote.encode_press('FAN_LOW')
+		second = remote.encode_press('FAN_LOW')
+		third = remote.encode_press('FAN_LOW')
+		self.assertNotEqual(first, second)
+		self.assertEqual(first, third)
+		# the last bit of the code flipped
+		flipped = lirc.LircRemote('hunter_fan_TX28', codes={'FAN_HIGH': 0x75})
+		self.assertEqual(flipped.encode_button('FAN_HIGH'), remote.toggled_frames['FAN_HIGH'].frame)
+		self.assertEqual('FAN_LOW', remote.decode_button(remote.frames['FAN_LOW'].frame, remote.baud_divisor))
+		self.assertEqual('FAN_LOW', remote.decode_button(remote.toggled_frames['FAN_LOW'].frame, remote.baud_divisor))
+
+class TestLircDecode(unittest.TestCase):
+	def test_decode_every_button(self):
+		remote = lirc.LircRemote('hunter_fan_TX28')
+		for command in remote.config['codes']:
+			symbols = remote.encode_button(command)
+			self.assertEqual(command, remote.decode_button(symbols, remote.baud_divisor))
+
+	def test_decode_other_baudrate(self):
+		# receive at twice the transmitting baudrate
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		symbols = ''.join(s*2 for s in str(remote.encode_button('FAN_LOW')))
+		self.assertEqual('FAN_LOW', remote.decode_button(symbols, remote.baud_divisor / 2))
+
+	def test_decode_timing_error(self):
+		# physical remotes hold some pulses a little longer
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		symbols = str(remote.encode_button('FAN_MED')).replace('0001', '00001')
+		self.assertEqual('FAN_MED', remote.decode_button(symbols, remote.baud_divisor))
+
+	def test_decode_wrong_pre_data(self):
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		other_remote = lirc.LircRemote('hampton_bay_UC7078T', pre_data=0x04)
+		symbols = other_remote.encode_button('FAN_MED')
+		self.assertEqual(None, remote.decode_button(symbols, remote.baud_divisor))
+		self.assertEqual('FAN_MED', other_remote.decode_button(symbols, remote.baud_divisor))
+
+	def test_decode_garbage(self):
+		remote = lirc.LircRemote('hampton_bay_UC7078T')
+		self.assertEqual(None, remote.decode_button(None, remote.baud_divisor))
+		self.assertEqual(None, remote.decode_button('', remote.baud_divisor))
+		self.assertEqual(None, remote.decode_button('1'*200, remote.baud_divisor))
+
+class TestLircEavesdrop(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname)]
+
+	def tearDown(self):
+		shutil.rmtree(self._dirname)
+
+	def _overhear(self, eavesdropper, device, symbols):
+		eavesdropper._prepare_radio()
+		eavesdropper.radio = mock.Mock()
+		eavesdropper.radio.receive_packets.return_value = [symbols, symbols]
+		eavesdropper.eavesdrop()
+		# silence marks the end of the transmission
+		eavesdropper.radio.receive_packets.return_value = []
+		for i in range(4):
+			eavesdropper.eavesdrop()
+		# wait for the device to handle it
+		device.mailbox.call(lambda: None)
+
+	def test_eavesdrop_fan(self):
+		fan = lirc.LircThreeWayFan(name='test', label='Test', config_filename='hunter_fan_TX28', radio_frequency=350000001)
+		eavesdropper = lirc.LircEavesdropper(350000001)
+		self._overhear(eavesdropper, fan, fan._get_bin_key('FAN_MED'))
+		self.assertEqual('ON', fan.get_state())
+		self.assertEqual('2', fan.subdevices['speed'].get_state())
+
+	def test_eavesdrop_light_toggle(self):
+		light = lirc.LircLight(name='test', label='Test', config_filename='hampton_bay_UC7078T', radio_frequency=303875001)
+		eavesdropper = lirc.LircEavesdropper(303875001)
+		light._set('OFF')
+		self._overhear(eavesdropper, light, light._get_bin_key('KEY_LIGHTS_TOGGLE'))
+		self.assertEqual('ON', light.get_state())
+
+	def test_eavesdrop_storm(self):
+		light = lirc.LircLight(name='test', label='Test', config_filename='hampton_bay_UC7078T', radio_frequency=303875002)
+		eavesdropper = lirc.LircEavesdropper(303875002)
+		light._set('OFF')
+		# a stuck button keeps sending separate transmissions
+		for i in range(10):
+			self._overhear(eavesdropper, light, light._get_bin_key('KEY_LIGHTS_TOGGLE'))
+		# toggles aren't duplicates of each other, but are limited in rate
+		self.assertEqual('ON', light.get_state())
+		self.assertEqual(7, eavesdropper.limiter.get_suppressed_count())
@@ -1,9 +1,10 @@
-from restful_rfcat import config, drivers, persistence
+from restful_rfcat import config, drivers, persistence, pubsub, state
 import json
 import mock
 import os
 import shutil
 import tempfile
+import threading
 import Queue
 import unittest
 
@@ -37,6 +38,222 @@ class TestHideyHole(unittest.TestCase):
 		dir_contents = os.listdir(self._dirname)
 		self.assertEqual(set([key]), set(dir_contents))
 
+class TestReadCache(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		self.backend = persistence.HideyHole(self._dirname)
+		config.PERSISTENCE = [self.backend]
+		self.patcher = mock.patch.object(persistence, 'cache', persistence.ReadCache(maxsize=2))
+		self.cache = self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+		shutil.rmtree(self._dirname)
+
+	def test_set_then_get(self):
+		persistence.set('lights/test', 'ON')
+		with mock.patch.object(self.backend, 'get') as backend_get:
+			self.assertEqual('ON', persistence.get('lights/test'))
+			self.assertEqual(0, backend_get.call_count)
+		self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+	def test_read_through(self):
+		self.backend.set('lights/test', 'ON')
+		self.assertEqual('ON', persistence.get('lights/test'))
+		self.assertEqual('ON', persistence.get('lights/test'))
+		self.assertEqual(None, persistence.get('lights/missing'))
+		self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+
+	def test_eviction(self):
+		for name in ['a', 'b', 'c']:
+			persistence.set('lights/%s' % (name,), 'ON')
+		self.assertEqual(2, len(self.cache))
+		with mock.patch.object(self.backend, 'get', return_value='OFF') as backend_get:
+			self.assertEqual('OFF', persistence.get('lights/a'))
+			self.assertEqual('ON', persistence.get('lights/c'))
+			self.assertEqual(1, backend_get.call_count)
+
+	def test_publish_only(self):
+		config.PERSISTENCE = [persistence.MQTT(_publish=mock.Mock())]
+		self.cache.check_backends(config.PERSISTENCE)
+		self.cache.put('lights/test', 'ON')
+		persistence.set('lights/test', 'OFF')
+		self.assertEqual(None, persistence.get('lights/test'))
+
+	def test_new_backends(self):
+		persistence.set('lights/test', 'ON')
+		other_dirname = tempfile.mkdtemp()
+		try:
+			config.PERSISTENCE = [persistence.HideyHole(other_dirname)]
+			self.assertEqual(None, persistence.get('lights/test'))
+		finally:
+			shutil.rmtree(other_dirname)
+
+class TestHideyHoleCache(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		self.backend = persistence.HideyHole(self._dirname, poll_interval=60)
+		config.PERSISTENCE = [self.backend]
+
+	def tearDown(self):
+		self.backend.stop()
+		shutil.rmtree(self._dirname)
+
+	def _edit(self, key, value):
+		# something other than restful_rfcat changing the file
+		with open(self.backend._key_path(key), 'w') as handle:
+			handle.write(value)
+
+	def test_external_edit(self):
+		self.backend.set('lights/test', 'ON')
+		self._edit('lights/test', 'OFF')
+		self.assertEqual('OFF', self.backend.get('lights/test'))
+
+	def test_watching(self):
+		self.backend.set('lights/test', 'ON')
+		self.backend.start()
+		os.remove(self.backend._key_path('lights/test'))
+		# read from the cache, until the next scan
+		self.assertEqual('ON', self.backend.get('lights/test'))
+		self.backend._scan()
+		self.assertEqual(None, self.backend.get('lights/test'))
+
+	def test_announced(self):
+		light = drivers.FakeLight(name='test', label='Test')
+		state.store.hydrate([light])
+		self.backend.start()
+		with pubsub.subscribe() as events:
+			self._edit('lights/test', 'ON')
+			self.backend._scan()
+			self.assertEqual('ON', light.get_state())
+			self.assertEqual('external', state.store.record('lights/test').source)
+			event = events.get(False)
+			self.assertEqual(light, event['device'])
+			self.assertEqual('ON', event['state'])
+			# its own changes aren't announced again
+			light.set_state('OFF')
+			events.get(False)
+			self.backend._scan()
+			self.assertTrue(events.empty())
+
+class FakeTimer(object):
+	""" A timer that only runs when the test says so """
+	def __init__(self, interval, function):
+		self.function = function
+		self.daemon = False
+
+	def start(self):
+		pass
+
+	def cancel(self):
+		pass
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		self.now = 1000
+		self.journal = self._journal()
+		config.PERSISTENCE = [self.journal]
+
+	def tearDown(self):
+		shutil.rmtree(self._dirname)
+
+	def _journal(self, **kwargs):
+		kwargs.setdefault('_timer', FakeTimer)
+		return persistence.Journal(self._dirname, _time=lambda: self.now, **kwargs)
+
+	def _log_lines(self):
+		with open(os.path.join(self._dirname, persistence.Journal.LOG)) as handle:
+			return handle.readlines()
+
+	def test_empty(self):
+		self.assertEqual(None, persistence.get('nonexistent'))
+
+	def test_group_commit(self):
+		persistence.set('fans/test', 'ON')
+		persistence.set('fans/test/speed', '2')
+		self.assertEqual('2', persistence.get('fans/test/speed'))
+		self.assertFalse(os.path.exists(os.path.join(self._dirname, persistence.Journal.LOG)))
+		self.journal.timer.function()
+		self.assertEqual(2, len(self._log_lines()))
+
+	def test_replay(self):
+		persistence.set('fans/test', 'ON')
+		persistence.set('fans/test', 'OFF')
+		persistence.set('lights/test', 'ON')
+		self.journal.flush()
+		with open(os.path.join(self._dirname, persistence.Journal.LOG), 'a') as handle:
+			handle.write('["lights/test", "OF')	# cut off by a power failure
+		replayed = self._journal()
+		self.assertEqual('OFF', replayed.get('fans/test'))
+		self.assertEqual('ON', replayed.get('lights/test'))
+		self.assertTrue(isinstance(replayed.get('lights/test'), str))
+
+	def test_write_after_partial_line(self):
+		persistence.set('fans/test', 'ON')
+		self.journal.flush()
+		with open(os.path.join(self._dirname, persistence.Journal.LOG), 'a') as handle:
+			handle.write('["fans/test", "O')	# cut off by a power failure
+		restarted = self._journal(commit_window=0)
+		restarted.set('lights/test', 'ON')
+		replayed = self._journal()
+		self.assertEqual('ON', replayed.get('fans/test'))
+		self.assertEqual('ON', replayed.get('lights/test'))
+		self.assertEqual(2, len(self._log_lines()))
+
+	def test_compaction(self):
+		journal = self._journal(commit_window=0, compact_after=3)
+		for state in ['1', '2', '3', '0']:
+			journal.set('fans/test/command', state)
+		self.assertEqual(1, len(self._log_lines()))
+		self.assertTrue(os.path.exists(os.path.join(self._dirname, persistence.Journal.SNAPSHOT)))
+		self.assertEqual('0', self._journal().get('fans/test/command'))
+
+	def test_fsync_interval(self):
+		journal = self._journal(commit_window=0, fsync_interval=5)
+		with mock.patch('os.fsync') as fsync:
+			journal.set('lights/test', 'ON')
+			journal.set('lights/test', 'OFF')
+			self.assertEqual(1, fsync.call_count)
+			self.now = self.now + 5
+			journal.set('lights/test', 'ON')
+			self.assertEqual(2, fsync.call_count)
+
+	def test_trailing_fsync(self):
+		timers = []
+		def timer(interval, function):
+			timers.append((interval, function))
+			return FakeTimer(interval, function)
+		journal = self._journal(commit_window=0, fsync_interval=5, _timer=timer)
+		with mock.patch('os.fsync') as fsync:
+			journal.set('lights/test', 'ON')
+			self.now = self.now + 1
+			journal.set('lights/test', 'OFF')
+			self.assertEqual(1, fsync.call_count)
+			# the last write is synced once the interval is up
+			self.assertEqual([4], [interval for interval, function in timers])
+			self.now = self.now + 4
+			timers[0][1]()
+			self.assertEqual(2, fsync.call_count)
+			journal.flush()
+			self.assertEqual(2, fsync.call_count)
+
+	def test_sync_at_shutdown(self):
+		journal = self._journal(commit_window=0, fsync_interval=5)
+		config.PERSISTENCE = [journal]
+		with mock.patch('os.fsync') as fsync:
+			journal.set('lights/test', 'ON')
+			journal.set('lights/test', 'OFF')
+			self.assertEqual(1, fsync.call_count)
+			persistence.flush()
+			self.assertEqual(2, fsync.call_count)
+
+	def test_no_fsync(self):
+		journal = self._journal(commit_window=0, fsync_interval=None)
+		with mock.patch('os.fsync') as fsync:
+			journal.set('lights/test', 'ON')
+			self.assertEqual(0, fsync.call_count)
+
 class TestMQTT(unittest.TestCase):
 	def setUp(self):
 		self.mock = mock.Mock()
@@ -50,6 +267,7 @@ class TestMQTT(unittest.TestCase):
 
 	def test_set(self):
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "lights/fan")
 		self.assertEqual(call_args[1]['payload'], "value")
@@ -61,6 +279,7 @@ class TestMQTT(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.MQTT(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "testname/lights/fan")
 		self.assertEqual(call_args[1]['payload'], "value")
@@ -71,6 +290,7 @@ class TestMQTT(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.MQTT(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "lights/fan")
 		self.assertEqual(call_args[1]['retain'], True)
@@ -82,6 +302,7 @@ class TestMQTT(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.MQTT(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "lights/fan")
 		self.assertEqual(call_args[1]['retain'], False)
@@ -93,6 +314,7 @@ class TestMQTT(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.MQTT(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "/testname/lights/fan")
 		self.assertEqual(call_args[1]['payload'], "value")
@@ -102,6 +324,7 @@ class TestMQTT(unittest.TestCase):
 		import paho.mqtt
 		self.mock.single.side_effect = paho.mqtt.MQTTException("Failure")
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 
 class TestMQTTHomeAssistant(unittest.TestCase):
 	def setUp(self):
@@ -128,6 +351,8 @@ class TestMQTTHomeAssistant(unittest.TestCase):
 			]
 		}
 		config.PERSISTENCE = [persistence.MQTTHomeAssistant(**settings)]
+		self.mock.multiple.assert_not_called()
+		config.PERSISTENCE[0].start()
 		msgs = self.mock.multiple.call_args[0][0]
 		self.assertEqual(2, len(msgs))	# two devices were announced
 		self.assertEqual('homeassistant/fan/fans_fake/config', msgs[0]['topic'])
@@ -161,6 +386,8 @@ class TestMQTTHomeAssistant(unittest.TestCase):
 			]
 		}
 		config.PERSISTENCE = [persistence.MQTTHomeAssistant(**settings)]
+		self.mock.multiple.assert_not_called()
+		config.PERSISTENCE[0].start()
 		msgs = self.mock.multiple.call_args[0][0]
 		self.assertEqual(2, len(msgs))	# two devices were announced
 		self.assertEqual('myhass/fan/fans_fake/config', msgs[0]['topic'])
@@ -185,6 +412,7 @@ class TestMQTTHomeAssistant(unittest.TestCase):
 
 	def test_set(self):
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "homeassistant/light/lights_fan/state")
 		self.assertEqual(call_args[1]['payload'], "value")
@@ -196,6 +424,7 @@ class TestMQTTHomeAssistant(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.MQTTHomeAssistant(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		call_args = self.mock.single.call_args
 		self.assertEqual(call_args[0][0], "myhass/light/lights_fan/state")
 		self.assertEqual(call_args[1]['payload'], "value")
@@ -205,6 +434,186 @@ class TestMQTTHomeAssistant(unittest.TestCase):
 		import paho.mqtt
 		self.mock.single.side_effect = paho.mqtt.MQTTException("Failure")
 		persistence.set("lights/fan", "value")
+		persistence.flush()
+
+class TestBackendStartup(unittest.TestCase):
+	def test_background(self):
+		release = threading.Event()
+		slow = mock.Mock()
+		slow.start.side_effect = lambda: release.wait(5)
+		broken = mock.Mock()
+		broken.start.side_effect = IOError("Connection refused")
+		startup = persistence.BackendStartup()
+		startup.start([persistence.Redis(client=mock.Mock()), slow, broken])
+		self.assertEqual(('Redis', 'ready'), startup.readiness()[0])
+		self.assertEqual(('Mock', 'starting'), startup.readiness()[1])
+		release.set()
+		startup.wait(5)
+		self.assertEqual(['ready', 'ready', 'failed'], [s for n, s in startup.readiness()])
+
+	def test_once(self):
+		backend = mock.Mock()
+		ready = []
+		startup = persistence.BackendStartup()
+		startup.start([backend], on_ready=ready.append)
+		startup.start([backend], on_ready=ready.append)
+		startup.wait(5)
+		self.assertEqual(1, backend.start.call_count)
+		self.assertEqual([backend], ready)
+		self.assertTrue(startup.ready())
+
+	def test_mqtt(self):
+		publish = mock.Mock()
+		startup = persistence.BackendStartup()
+		startup.start([persistence.MQTT(_publish=publish)])
+		startup.wait(5)
+		self.assertEqual([('MQTT', 'ready')], startup.readiness())
+		self.assertEqual('restful_rfcat', publish.single.call_args[0][0])
+
+class SlowBackend(object):
+	""" Records writes, but holds up the first one until released """
+	def __init__(self):
+		self.started = threading.Event()
+		self.release = threading.Event()
+		self.written = []
+
+	def set(self, key, value):
+		if key == 'lights/first':
+			self.started.set()
+			self.release.wait(5)
+		self.written.append((key, value))
+
+	def get(self, key, default=None):
+		return dict(self.written).get(key, default)
+
+class TestWriteQueue(unittest.TestCase):
+	def setUp(self):
+		self.backend = SlowBackend()
+
+	def tearDown(self):
+		self.backend.release.set()
+
+	def _started(self):
+		# Event.wait() only says whether it was set from python 2.7
+		self.backend.started.wait(5)
+		return self.backend.started.is_set()
+
+	def _hold(self, queue):
+		# keep the worker busy with a first write
+		queue.put('lights/first', 'ON')
+		self.assertTrue(self._started())
+
+	def test_background(self):
+		config.PERSISTENCE = [self.backend]
+		persistence.set('lights/first', 'ON')
+		self.assertTrue(self._started())
+		self.assertEqual([], self.backend.written)
+		self.backend.release.set()
+		self.assertTrue(persistence.flush(timeout=5))
+		self.assertEqual([('lights/first', 'ON')], self.backend.written)
+
+	def test_latest_wins(self):
+		queue = persistence.WriteQueue(self.backend)
+		self._hold(queue)
+		queue.put('lights/test', 'ON')
+		queue.put('lights/other', 'ON')
+		queue.put('lights/test', 'OFF')
+		self.assertEqual(2, queue.depth())
+		self.backend.release.set()
+		self.assertTrue(queue.flush(timeout=5))
+		self.assertEqual([('lights/first', 'ON'), ('lights/test', 'OFF'), ('lights/other', 'ON')], self.backend.written)
+
+	def test_reads_waiting_writes(self):
+		config.PERSISTENCE = [self.backend]
+		persistence.write_queue(self.backend).put('lights/first', 'ON')
+		self.assertTrue(self._started())
+		persistence.set('lights/test', 'ON')
+		persistence.cache.discard('lights/test')
+		self.assertEqual('ON', persistence.get('lights/test'))
+
+	def test_drop_oldest(self):
+		queue = persistence.WriteQueue(self.backend, maxsize=2, overflow='drop_oldest')
+		self._hold(queue)
+		for name in ['a', 'b', 'c']:
+			queue.put('lights/%s' % (name,), 'ON')
+		self.assertEqual(1, queue.dropped)
+		self.backend.release.set()
+		self.assertTrue(queue.flush(timeout=5))
+		self.assertEqual(['lights/first', 'lights/b', 'lights/c'], [k for k, v in self.backend.written])
+
+	def test_write_through(self):
+		queue = persistence.WriteQueue(self.backend, maxsize=1, overflow='write_through')
+		self._hold(queue)
+		queue.put('lights/a', 'ON')
+		queue.put('lights/b', 'ON')
+		# written straight away, while the worker is still held up
+		self.assertEqual([('lights/b', 'ON')], self.backend.written)
+		self.backend.release.set()
+		self.assertTrue(queue.flush(timeout=5))
+		self.assertEqual(3, len(self.backend.written))
+
+	def test_block(self):
+		queue = persistence.WriteQueue(self.backend, maxsize=1)
+		self._hold(queue)
+		queue.put('lights/a', 'ON')
+		# another write to a waiting key fits, a new key has to wait
+		queue.put('lights/a', 'OFF')
+		blocked = threading.Thread(target=queue.put, args=('lights/b', 'ON'))
+		blocked.start()
+		blocked.join(0.1)
+		self.assertTrue(blocked.is_alive())
+		self.backend.release.set()
+		blocked.join(5)
+		self.assertTrue(queue.flush(timeout=5))
+		self.assertEqual([('lights/first', 'ON'), ('lights/a', 'OFF'), ('lights/b', 'ON')], self.backend.written)
+
+	def test_flush_timeout(self):
+		queue = persistence.WriteQueue(self.backend)
+		self._hold(queue)
+		self.assertFalse(queue.flush(timeout=0.05))
+
+	def test_overflow_policy(self):
+		self.assertRaises(ValueError, persistence.WriteQueue, self.backend, overflow='shrug')
+
+	def test_backend_settings(self):
+		self.backend.write_queue_size = 5
+		self.backend.write_overflow = 'drop_oldest'
+		queue = persistence.write_queue(self.backend)
+		self.assertEqual((5, 'drop_oldest'), (queue.maxsize, queue.overflow))
+		self.assertEqual(None, persistence.write_queue(persistence.HideyHole('/tmp/')))
+
+class TestMQTTStateful(unittest.TestCase):
+	def setUp(self):
+		self.backend = persistence.MQTTStateful(_client=mock.Mock())
+		config.PERSISTENCE = [self.backend]
+
+	def test_retained_after_hydrate(self):
+		light = drivers.FakeLight(name="test", label="Test")
+		state.store.hydrate([light])
+		self.assertEqual(None, light.get_state())
+		self.backend._on_message(None, None, mock.Mock(topic='lights/test', payload='ON'))
+		self.assertEqual('ON', light.get_state())
+		self.assertEqual('mqtt', state.store.record('lights/test').source)
+
+	def test_cache_replaced(self):
+		backend = persistence.MQTTStatefulHomeAssistant(_client=mock.Mock())
+		config.PERSISTENCE = [backend]
+		topic = backend._set_topic('lights/test')
+		backend._on_message(None, None, mock.Mock(topic=topic, payload='ON'))
+		self.assertEqual('ON', persistence.get('lights/test'))
+		persistence.set('lights/test', 'OFF')
+		self.assertEqual('OFF', persistence.cache.lookup('lights/test'))
+		persistence.flush()
+		self.assertEqual('OFF', persistence.get('lights/test'))
+
+	def test_own_changes(self):
+		light = drivers.FakeLight(name="test", label="Test")
+		state.store.hydrate([light])
+		light.set_state('ON')
+		persistence.flush()
+		with mock.patch.object(state.store, 'changed_elsewhere') as changed_elsewhere:
+			self.backend._on_message(None, None, mock.Mock(topic='lights/test', payload='ON'))
+			self.assertEqual(0, changed_elsewhere.call_count)
 
 class TestRedis(unittest.TestCase):
 	def setUp(self):
@@ -221,6 +630,7 @@ class TestRedis(unittest.TestCase):
 
 	def test_set(self):
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		self.mock.set.assert_called_once_with("lights/fan", "value")
 		self.mock.publish.assert_called_once_with("lights/fan", "value")
 
@@ -231,6 +641,7 @@ class TestRedis(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.Redis(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		self.mock.set.assert_called_once_with("lights/fan", "value")
 		self.mock.publish.assert_not_called()
 
@@ -241,6 +652,7 @@ class TestRedis(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.Redis(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		self.assertEqual(None, persistence.get("lights/fan"))
 		self.mock.set.assert_not_called()
 		self.mock.get.assert_not_called()
@@ -253,6 +665,7 @@ class TestRedis(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.Redis(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		self.mock.set.assert_called_once_with("testname/lights/fan", "value")
 		self.mock.publish.assert_called_once_with("testname/lights/fan", "value")
 
@@ -263,6 +676,7 @@ class TestRedis(unittest.TestCase):
 		}
 		config.PERSISTENCE = [persistence.Redis(**settings)]
 		persistence.set("lights/fan", "value")
+		persistence.flush()
 		self.mock.set.assert_called_once_with("/testname/lights/fan", "value")
 		self.mock.publish.assert_called_once_with("/testname/lights/fan", "value")
 
@@ -272,3 +686,4 @@ class TestRedis(unittest.TestCase):
 		self.mock.set.side_effect = IOError("Failure")
 		persistence.get("lights/fan")
 		persistence.set("lights/fan", "value")
+		persistence.flush()
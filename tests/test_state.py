@@ -0,0 +1,92 @@
+from restful_rfcat import config, drivers, persistence, state
+import mock
+import shutil
+import tempfile
+import threading
+import unittest
+
+class TestStateStore(unittest.TestCase):
+	def setUp(self):
+		self._dirname = tempfile.mkdtemp()
+		self.backend = persistence.HideyHole(self._dirname)
+		config.PERSISTENCE = [self.backend]
+		self.store = state.StateStore(_time=lambda: 1000)
+
+	def tearDown(self):
+		shutil.rmtree(self._dirname)
+
+	def test_empty(self):
+		self.assertEqual(None, self.store.get('fans/test'))
+		self.assertEqual(None, self.store.get('fans/test', 'speed'))
+
+	def test_record(self):
+		self.store.set('fans/test', 'ON', source='command')
+		self.store.set('fans/test', '2', field='speed', source='eavesdrop')
+		record = self.store.record('fans/test')
+		self.assertEqual('ON', record.state)
+		self.assertEqual('2', record.speed)
+		self.assertEqual(None, record.power)
+		self.assertEqual(1000, record.updated)
+		self.assertEqual('eavesdrop', record.source)
+
+	def test_replicated(self):
+		self.store.set('fans/test', '2', field='speed')
+		self.assertEqual('2', self.backend.get('fans/test/speed'))
+
+	def test_hydrate(self):
+		self.backend.set('fans/test', 'ON')
+		self.backend.set('fans/test/speed', '3')
+		fan = drivers.FakeFan(name="test", label="Test")
+		self.store.hydrate([fan])
+		with mock.patch.object(self.backend, 'get') as backend_get:
+			self.assertEqual('ON', self.store.get('fans/test'))
+			self.assertEqual('3', self.store.get('fans/test', 'speed'))
+			self.assertEqual(None, self.store.get('fans/test', 'power'))
+			self.assertEqual(0, backend_get.call_count)
+
+	def test_reads_from_memory(self):
+		self.store.set('lights/test', 'ON')
+		with mock.patch.object(self.backend, 'get') as backend_get:
+			self.assertEqual('ON', self.store.get('lights/test'))
+			self.assertEqual(0, backend_get.call_count)
+
+	def test_late_backend(self):
+		release = threading.Event()
+		late = mock.Mock()
+		late.start.side_effect = lambda: release.wait(5)
+		late.get.return_value = None
+		config.PERSISTENCE = [late]
+		startup = persistence.BackendStartup()
+		with mock.patch.object(persistence, 'startup', startup):
+			startup.start([late])
+			try:
+				self.store.hydrate([drivers.FakeLight(name="test", label="Test")])
+				self.assertEqual(None, self.store.get('lights/test'))
+				# the backend connects and finds the saved state
+				late.get.side_effect = lambda key: {'lights/test': 'ON'}.get(key)
+			finally:
+				release.set()
+			startup.wait(5)
+			self.assertEqual('ON', self.store.get('lights/test'))
+			late.get.side_effect = lambda key: None
+			self.assertEqual('ON', self.store.get('lights/test'))
+
+	def test_new_backends(self):
+		self.store.set('lights/test', 'ON')
+		config.PERSISTENCE = [persistence.HideyHole(self._dirname + '/')]
+		self.assertEqual('ON', self.store.get('lights/test'))
+		config.PERSISTENCE = []
+		self.assertEqual(None, self.store.get('lights/test'))
+
+	def test_device_accessors(self):
+		fan = drivers.FakeFan(name="test", label="Test")
+		fan.set_state('MED')
+		record = state.store.record('fans/test')
+		self.assertEqual('ON', record.state)
+		self.assertEqual('ON', record.power)
+		self.assertEqual('MED', record.speed)
+		self.assertEqual('2', record.command)
+		self.assertEqual('command', record.source)
+		fan._handle_state_update('1')
+		self.assertEqual('eavesdrop', record.source)
+		self.assertEqual('1', fan.subdevices['command'].get_state())